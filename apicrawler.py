@@ -16,7 +16,10 @@ urls = (
               '/crawl/add_direct/?', 'add_crawl_directly',
               '/crawl/([^/]+)/?', 'crawl_information_or_deletion',
               '/crawl/([^/]+)/stop/?', 'stop_crawl',
-              '/crawls/?', 'crawls_information'
+              '/crawls/?', 'crawls_information',
+              '/platforms/?', 'platforms_information',
+              '/outputs/?', 'outputs_information',
+              '/triples/?', 'triples_lookup'
               #     Deprecated
               #'/campaigns?/?', 'campaigns',
               #'/campaign/([^/]+)/crawls/?', 'crawls',
@@ -124,11 +127,46 @@ class stop_crawl:
 class crawls_information:
     def GET(self):
         """ Returns all crawls information """
-        crawls_list = [] 
-        for crawl in apicrawler_interface.crawls:
-            crawls_list.append(crawl.get_dict())
+        crawls_list = apicrawler_interface.get_crawls_information()
         return json.dumps(crawls_list, sort_keys=True, indent=4)
 
+
+class platforms_information:
+    def GET(self):
+        """ Returns the platforms' queue depth and next due date """
+        platforms_list = apicrawler_interface.get_platforms_information()
+        return json.dumps(platforms_list, sort_keys=True, indent=4)
+
+
+class outputs_information:
+    def GET(self):
+        """ Returns the state of the output modules, e.g. flush latency """
+        outputs = apicrawler_interface.get_outputs_information()
+        return json.dumps(outputs, sort_keys=True, indent=4)
+
+
+class triples_lookup:
+    def GET(self):
+        """ Returns the triples matching the subject, predicate, object,
+        crawl_id and campaign_id given, with limit and offset """
+        data = web.input(subject=None, predicate=None, object=None,
+                         crawl_id=None, campaign_id=None, limit=None,
+                         offset=0)
+        try:
+            limit = int(data.limit) if data.limit else None
+            offset = int(data.offset)
+        except Exception as e:
+            raise WrongFormat, e
+        found_triples = apicrawler_interface.find_triples(
+                            subject=data.subject, predicate=data.predicate,
+                            _object=data.object, crawl_id=data.crawl_id,
+                            campaign_id=data.campaign_id, limit=limit,
+                            offset=offset)
+        if found_triples is None:
+            raise TripleIndexDisabled
+        # Else ..
+        return json.dumps(found_triples, indent=4)
+
 #
 #       Error classes
 #
@@ -197,6 +235,15 @@ class CrawlNotStopped(GenericError):
                               error_data)
 
 
+class TripleIndexDisabled(GenericError):
+    def __init__(self):
+        status = '404 triples not indexed'
+        error_data = 'The triples are not indexed, see triple_index in'\
+                     ' config.py'
+        GenericError.__init__(self, status, self.__class__.__name__,
+                              error_data)
+
+
 class UnknownError(GenericError):
     def __init__(self):
         status = '500 unknow error'
@@ -0,0 +1,127 @@
+import collections
+import threading
+import time
+
+"""
+This module hands items over between threads by lists rather than one at a
+time, e.g. triples and outlinks to the output daemons.
+"""
+
+
+class BatchQueue:
+    """ Bounded queue of items: a whole list is added with one lock and the
+    consumer takes up to N items at once. put_many blocks while the queue is
+    full, which slows the producers down. """
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def put_many(self, items):
+        """ Adds a list of items, waits while the queue is full. The list is
+        added whole, so the queue can go over maxsize by one list. """
+        if not items:
+            return
+        # Else ..
+        with self.not_full:
+            while self.maxsize > 0 and len(self.items) >= self.maxsize:
+                self.not_full.wait()
+            self.items.extend(items)
+            self.not_empty.notify()
+
+    def get_many(self, max_items, timeout=None):
+        """ Returns up to max_items items, waits for at least one. Returns
+        an empty list if there is none after timeout seconds. """
+        with self.not_empty:
+            if timeout is None:
+                while not self.items:
+                    self.not_empty.wait()
+            else:
+                end_time = time.time() + timeout
+                while not self.items:
+                    remaining = end_time - time.time()
+                    if remaining <= 0:
+                        return []
+                    self.not_empty.wait(remaining)
+            popleft = self.items.popleft
+            items = [popleft() for i in xrange(0, min(max_items,
+                                                      len(self.items)))]
+            self.not_full.notify_all()
+            return items
+
+    def qsize(self):
+        """ Returns the number of items in the queue """
+        with self.mutex:
+            return len(self.items)
+
+
+class FlushPolicy:
+    """ Decides when a chunk is flushed: when it has max_items items or
+    max_bytes bytes, or when its first item is max_seconds old, whichever
+    comes first. Keeps statistics about the flush latency. """
+    def __init__(self, max_items, max_seconds, max_bytes):
+        self.max_items = max_items
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.start_chunk()
+        # Latency between the first item of a chunk and its flush
+        self.flushes = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_latency = None
+
+    def start_chunk(self):
+        """ Starts a new, empty chunk """
+        self.items = 0
+        self.bytes = 0
+        self.first_item_time = None
+
+    def add(self, items, nbytes):
+        """ Counts items and bytes added to the chunk """
+        if items and self.first_item_time is None:
+            self.first_item_time = time.time()
+        self.items += items
+        self.bytes += nbytes
+
+    def items_needed(self):
+        """ Returns the number of items needed to fill the chunk """
+        return max(1, self.max_items - self.items)
+
+    def timeout(self):
+        """ Returns how long to wait for new items before the chunk is due,
+        None if the chunk is empty """
+        if self.first_item_time is None:
+            return None
+        return max(0, self.first_item_time + self.max_seconds - time.time())
+
+    def is_due(self):
+        """ Returns True if the chunk has to be flushed """
+        if self.first_item_time is None:
+            return False
+        return self.items >= self.max_items or \
+               self.bytes >= self.max_bytes or \
+               time.time() - self.first_item_time >= self.max_seconds
+
+    def flushed(self):
+        """ Records the flush of the chunk, returns its latency """
+        latency = time.time() - self.first_item_time
+        self.flushes += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        self.last_latency = latency
+        self.start_chunk()
+        return latency
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the flush latency statistics """
+        mean_latency = None
+        if self.flushes:
+            mean_latency = self.total_latency / self.flushes
+        return {
+                "flushes": self.flushes,
+                "last_latency": self.last_latency,
+                "mean_latency": mean_latency,
+                "max_latency": self.max_latency
+               }
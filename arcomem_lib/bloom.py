@@ -0,0 +1,181 @@
+import logging
+import hashlib
+import struct
+import math
+import marshal
+import os
+import threading
+
+"""
+This module is about remembering what has already been seen, e.g. the
+outlinks already sent to the crawler, in a bounded amount of memory.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+
+def get_hashes(key):
+    """ Returns two 64 bits hashes of a key, the positions in a filter are
+    derived from them """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+    # An odd step goes through all the positions
+    return h1, h2 | 1
+
+
+def get_filter_size(capacity, error_rate):
+    """ Returns the number of bits of a filter """
+    return int(math.ceil(-capacity * math.log(error_rate) /
+                         math.log(2) ** 2))
+
+
+class BloomFilter:
+    """ Set of keys with false positives at error_rate once it has capacity
+    keys, and no false negative """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = get_filter_size(capacity, error_rate)
+        self.hashes = max(1, int(round(
+                            self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def get_positions(self, h1, h2):
+        size = self.size
+        return [(h1 + i * h2) % size for i in xrange(0, self.hashes)]
+
+    def contains(self, h1, h2):
+        bits = self.bits
+        for position in self.get_positions(h1, h2):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, h1, h2):
+        bits = self.bits
+        for position in self.get_positions(h1, h2):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class SlidingBloomFilter:
+    """ Bloom filter that forgets the oldest keys: keys are added to the
+    newest of a series of filters of capacity keys each, a new filter is
+    started when it is full and the oldest is dropped when the filters
+    would use more than max_bytes. The error rate is shared between the
+    filters so that the whole stays at error_rate. """
+    def __init__(self, capacity, error_rate, max_bytes):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.max_bytes = max_bytes
+        # As many filters as fit in max_bytes, at least one
+        self.max_filters = 1
+        while (self.max_filters + 1) * self.get_filter_bytes(
+                    self.max_filters + 1) <= max_bytes:
+            self.max_filters += 1
+        self.filter_error_rate = error_rate / self.max_filters
+        self.lock = threading.Lock()
+        self.filters = []
+        self.checked = 0
+        self.duplicates = 0
+        self.dropped_filters = 0
+
+    def get_filter_bytes(self, filters):
+        return (get_filter_size(self.capacity,
+                                self.error_rate / filters) + 7) // 8
+
+    def add(self, key):
+        """ Adds a key, returns True if it was (probably) already there """
+        h1, h2 = get_hashes(key)
+        with self.lock:
+            self.checked += 1
+            for bloom_filter in reversed(self.filters):
+                if bloom_filter.contains(h1, h2):
+                    self.duplicates += 1
+                    return True
+            # Else ..
+            if not self.filters or self.filters[-1].is_full():
+                self.start_filter()
+            self.filters[-1].add(h1, h2)
+            return False
+
+    def start_filter(self):
+        """ Starts a new filter, drops the oldest one if there are too many
+        """
+        if len(self.filters) >= self.max_filters:
+            del self.filters[0]
+            self.dropped_filters += 1
+        self.filters.append(BloomFilter(self.capacity,
+                                        self.filter_error_rate))
+
+    def get_parameters(self):
+        return (self.capacity, self.error_rate, self.max_bytes)
+
+    def save(self, file_path):
+        """ Writes the filters in a file, atomically. The filters are copied
+        first so that keys can be added while the file is written. """
+        with self.lock:
+            counts = [bloom_filter.count for bloom_filter in self.filters]
+            bits = [str(bloom_filter.bits) for bloom_filter in self.filters]
+        tmp_file = file_path + '.tmp'
+        with open(tmp_file, 'wb') as _f:
+            marshal.dump((self.get_parameters(), counts), _f)
+            for filter_bits in bits:
+                _f.write(filter_bits)
+        os.rename(tmp_file, file_path)
+
+    def load(self, file_path):
+        """ Reads the filters written by save, they are ignored if the
+        parameters have changed since. Returns True if they were loaded. """
+        try:
+            with open(file_path, 'rb') as _f:
+                parameters, counts = marshal.load(_f)
+                if parameters != self.get_parameters():
+                    logger.warning('[Bloom] %s has other parameters, '
+                                   'ignoring it' % file_path)
+                    return False
+                # Else ..
+                filters = []
+                for count in counts:
+                    bloom_filter = BloomFilter(self.capacity,
+                                               self.filter_error_rate)
+                    bits = _f.read(len(bloom_filter.bits))
+                    if len(bits) != len(bloom_filter.bits):
+                        raise ValueError('truncated file')
+                    bloom_filter.bits = bytearray(bits)
+                    bloom_filter.count = count
+                    filters.append(bloom_filter)
+        except IOError:
+            return False
+        except (ValueError, EOFError, TypeError) as e:
+            logger.warning('[Bloom] Could not load %s: %s' % (file_path, e))
+            return False
+        with self.lock:
+            self.filters = filters
+        logger.info('[Bloom] Loaded %d keys from %s' %
+                    (sum(counts), file_path))
+        return True
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the filter's state """
+        with self.lock:
+            hit_rate = None
+            if self.checked:
+                hit_rate = self.duplicates / float(self.checked)
+            return {
+                    "checked": self.checked,
+                    "duplicates": self.duplicates,
+                    "hit_rate": hit_rate,
+                    "keys": sum([bloom_filter.count for bloom_filter in
+                                 self.filters]),
+                    "filters": len(self.filters),
+                    "max_filters": self.max_filters,
+                    "dropped_filters": self.dropped_filters,
+                    "bytes": sum([len(bloom_filter.bits) for bloom_filter
+                                  in self.filters])
+                   }
@@ -1,6 +1,7 @@
 """ Contains the configuration parameters of the different modules """
 
 import os
+import multiprocessing
 
 ####################################
 ####            Generic         ####
@@ -36,6 +37,84 @@ spider_mapping = {
     ('twitter', 'search'):      'TwitterSearch'
 }
 
+# Number of spiders each platform runs at the same time, each one with its
+# own blender. The workers of a platform share its rate limit (see below).
+platform_concurrency = {
+    'facebook':     2,
+    'flickr':       2,
+    'google_plus':  2,
+    'twitter':      2,
+    'youtube':      2
+}
+
+# Rate limit of each platform, shared by all its spiders
+# Format is platform: (requests per second, burst size)
+# It is lowered automatically when the API sends rate limit headers.
+platform_rate_limits = {
+    'facebook':     (1.0, 10),
+    'flickr':       (1.0, 10),
+    'google_plus':  (0.1, 5),
+    'twitter':      (0.2, 5),
+    'youtube':      (1.0, 10)
+}
+
+# How many times a request throttled by the API is retried
+rate_limit_retries = 3
+
+# Fetch engine of each platform
+# 'blocking': each worker sends the requests of its spider with its own
+#   blender, one at a time
+# 'pool': the requests of all the spiders go through a pool of fetchers,
+#   pages known in advance are fetched concurrently
+platform_engines = {
+    'facebook':     'blocking',
+    'flickr':       'pool',
+    'google_plus':  'blocking',
+    'twitter':      'pool',
+    'youtube':      'pool'
+}
+
+# Number of fetchers of a platform using the 'pool' engine
+fetch_pool_size = 4
+
+# Number of pages a spider keeps in flight with the 'pool' engine, the next
+# pages are prefetched while the current one is handled
+fetch_window = 4
+
+# The spiders of a periodic crawl are made one at a time, when the previous
+# one is due. A crawl keeps its last crawl_kept_spiders spiders, the older
+# ones are only kept as records (dates, statistics and WARC files) once
+# they are done. The last crawl_kept_records records are kept, the older
+# ones are appended to <crawl id>.records (JSON lines) in crawls_path and
+# only counted in the statistics of the crawl.
+crawl_kept_spiders = 10
+crawl_kept_records = 10
+crawls_path = os.path.join(output_path, 'crawls')
+
+####################################
+####            Processing      ####
+####################################
+
+# Number of worker processes making the triples and outlinks of the
+# responses, 0 processes them in the responses handler thread
+processing_processes = multiprocessing.cpu_count()
+
+# Maximum number of responses waiting to be processed, the spiders wait
+# when it is reached
+processing_queue_size = 1000
+
+# Maximum number of responses sent at once to a worker process
+processing_batch_size = 20
+
+# The content items already processed are skipped, unless their content has
+# changed when item_index_content_hash is True. They are remembered in an
+# SQLite file using at most item_index_cache_kb KiB of memory.
+item_index = True
+item_index_file = os.path.join(output_path, 'items', 'items.sqlite')
+item_index_content_hash = True
+item_index_cache_kb = 16 * 1024
+
+
 ####################################
 ####            Triples         ####
 ####################################
@@ -46,8 +125,181 @@ triples_path = os.path.join(output_path, 'triples')
 # How often the triples rate will be logged in seconds
 triples_rate_period = 300
 
-# Size of the chunk sent to the triple store
+# A chunk is written in the triples file when it has triples_chunk_size
+# triples, triples_flush_bytes bytes or when its first triple is
+# triples_flush_seconds old, whichever comes first
 triples_chunk_size=100000
+triples_flush_seconds = 300
+triples_flush_bytes = 64 * 1024 * 1024
+
+# Maximum number of triples waiting for the chunk, the responses processing
+# waits when it is reached
+triples_queue_size = 200000
+
+# Compression level of the triples files, from 1 (fastest) to 9 (smallest)
+triples_backup_compression_level = 6
+
+# URIs of the N-Triples and N-Quads exports: a subject or an entity is
+# triples_base_uri + e.g. 'twitter/user/1234', a predicate is
+# triples_predicate_uri + e.g. 'from_user'
+triples_base_uri = 'http://www.arcomem.eu/apicrawler/'
+triples_predicate_uri = 'http://www.arcomem.eu/apicrawler/ontology#'
+
+# The N-Quads have one named graph per 'crawl' or per 'campaign'
+triples_graph_by = 'campaign'
+
+# Triples per block of the triples files, a block is sent to the triple
+# store in one request
+triples_block_size = 10000
+
+# Triple store endpoint the blocks of the triples files are sent to, the
+# triples files are only a backup if the host is None. The triples are sent
+# as N-Quads with the 'graph_store' protocol (SPARQL 1.1 Graph Store HTTP
+# Protocol) or as INSERT DATA requests with 'sparql_update' (SPARQL 1.1
+# Update), up to triple_store_concurrency requests at the same time.
+triple_store_host = None
+triple_store_port = 8080
+triple_store_path = '/apicrawler/data'
+triple_store_protocol = 'graph_store'
+triple_store_concurrency = 4
+
+# How often the loader looks for new blocks in the triples files in seconds
+triple_store_poll_period = 5
+
+# The triples are also indexed in an SQLite file if triple_index is True,
+# to be looked up with /triples/?subject=...&predicate=...&object=...
+# &campaign_id=..., using at most triple_index_cache_kb KiB of memory. A
+# lookup returns at most triple_index_max_results triples.
+triple_index = False
+triple_index_file = os.path.join(triples_path, 'triples.sqlite')
+triple_index_cache_kb = 64 * 1024
+triple_index_max_results = 1000
+
+# How content items are turned into triples
+# Format is (server, interaction): mapping, a mapping has:
+#   'api': the name of the platform in the triples,
+#   'post': {predicate: field} for the post, if the item is a post,
+#   'from_user': {predicate: field} for the author of the post, or for the
+#       item itself if it is a user,
+#   'to_users': [(list of users, {predicate: field}), ...] for the users the
+#       post is sent to or mentions.
+# A field is either:
+#   a path in the content item, e.g. 'actor.image.url' or 'author.0.name.$t',
+#       optionally followed by a filter, e.g. 'id.$t|last_segment',
+#   a template with paths between braces, e.g. 'http://flickr.com/{owner}',
+#   a list of fields, the first one that is not empty is used.
+# The 'id' field of posts and users is mandatory, it makes their subject,
+# e.g. 'flickr/post/<id>'. The other predicates are:
+#   post: url, title, content, language, publication_date, location
+#   user: url, name, nickname, picture_url, location
+triple_mappings = {
+    ('facebook', 'search'): {
+        'api': 'facebook',
+        'post': {
+            'id':               'id',
+            'url':              'http://www.facebook.com/{id}',
+            'title':            'name',
+            'content':          ['caption', 'message'],
+            'publication_date': 'updated_time'
+        },
+        'from_user': {
+            'id':               'from.id',
+            'url':              'http://www.facebook.com/{from.id}',
+            'name':             'from.name'
+        },
+        'to_users': [
+            ('likes.data', {
+                'id':           'id',
+                'url':          'http://www.facebook.com/{id}',
+                'name':         'name'
+            }),
+            ('to.data', {
+                'id':           'id',
+                'url':          'http://www.facebook.com/{id}',
+                'name':         'name'
+            })
+        ]
+    },
+    ('facebook', 'users'): {
+        'api': 'facebook',
+        'from_user': {
+            'id':               'id',
+            'url':              'http://www.facebook.com/{id}',
+            'name':             'name',
+            'nickname':         'username',
+            'location':         'location'
+        }
+    },
+    ('flickr', 'photos_search'): {
+        'api': 'flickr',
+        'post': {
+            'id':               'id',
+            'url':              'http://www.flickr.com/{owner}/{id}',
+            'title':            'title'
+        },
+        'from_user': {
+            'id':               'owner',
+            'url':              'http://www.flickr.com/{owner}'
+        }
+    },
+    ('google_plus', 'activities_search'): {
+        'api': 'google_plus',
+        'post': {
+            'id':               'id',
+            'url':              'url',
+            'title':            'title',
+            'content':          'object.content',
+            'publication_date': 'published'
+        },
+        'from_user': {
+            'id':               'actor.id',
+            'url':              'actor.url',
+            'name':             'actor.displayName',
+            'picture_url':      'actor.image.url'
+        }
+    },
+    ('twitter-search', 'search'): {
+        'api': 'twitter',
+        'post': {
+            'id':               'id',
+            'url':              'http://twitter.com/{from_user}/status/{id}',
+            'content':          'text',
+            'language':         'iso_language_code',
+            'publication_date': 'created_at',
+            'location':         'geo'
+        },
+        'from_user': {
+            'id':               'from_user_id',
+            'url':              'http://twitter.com/{from_user}/',
+            'name':             'from_user_name',
+            'nickname':         'from_user',
+            'picture_url':      'profile_image_url'
+        },
+        'to_users': [
+            ('entities.user_mentions', {
+                'id':           'id',
+                'url':          'http://twitter.com/{screen_name}',
+                'name':         'name',
+                'nickname':     'screen_name'
+            })
+        ]
+    },
+    ('youtube', 'search'): {
+        'api': 'youtube',
+        'post': {
+            'id':               'id.$t|last_segment',
+            'url':      'http://www.youtube.com/watch?v={id.$t|last_segment}',
+            'title':            'title.$t',
+            'content':          'content.$t',
+            'publication_date': 'published.$t'
+        },
+        'from_user': {
+            'id':               'author.0.name.$t',
+            'url':              'http://www.youtube.com/{author.0.name.$t}',
+            'nickname':         'author.0.name.$t'
+        }
+    }
+}
 
 
 ####################################
@@ -60,6 +312,22 @@ warcs_path = os.path.join(output_path, 'warcs')
 # How ofter the WARCs rate will be logged in seconds
 warcs_rate_period = 300
 
+# Number of writers, each one compresses in its own thread into its own
+# files, and maximum number of responses waiting for each one
+warcs_writers = min(4, multiprocessing.cpu_count())
+warcs_queue_size = 1000
+
+# The files can be split by 'platform' or 'campaign', None to mix them
+warcs_split_by = None
+
+# A new file is started when the current one is bigger than warcs_max_size
+# bytes or older than warcs_max_seconds seconds
+warcs_max_size = 500 * 1024 * 1024
+warcs_max_seconds = 24 * 3600
+
+# gzip compression level, from 1 (fastest) to 9 (smallest)
+warcs_compression_level = 9
+
 
 ####################################
 ####            Outlinks        ####
@@ -68,5 +336,102 @@ warcs_rate_period = 300
 # Outlinks directory
 outlinks_path = os.path.join(output_path, 'outlinks')
 
-# Size of the chunk sent to the crawler
+# A chunk is sent to the crawler when it has outlinks_chunk_size outlinks,
+# outlinks_flush_bytes bytes or when its first outlink is
+# outlinks_flush_seconds old, whichever comes first
 outlinks_chunk_size = 50000
+outlinks_flush_seconds = 5
+outlinks_flush_bytes = 4 * 1024 * 1024
+
+# Maximum number of outlinks waiting for the chunk, the responses processing
+# waits when it is reached
+outlinks_queue_size = 100000
+
+# The outlinks already queued are not queued again. They are remembered in
+# filters of outlinks_dedup_capacity outlinks each, with a false positive
+# rate of outlinks_dedup_error_rate (outlinks wrongly taken for
+# duplicates). The oldest filter is forgotten when they would use more than
+# outlinks_dedup_max_bytes.
+outlinks_dedup = True
+outlinks_dedup_capacity = 1000000
+outlinks_dedup_error_rate = 0.001
+outlinks_dedup_max_bytes = 64 * 1024 * 1024
+
+# File the filters are saved to every outlinks_dedup_save_period seconds
+# and loaded from at startup, None to start afresh every time
+outlinks_dedup_file = os.path.join(outlinks_path, 'dedup.bloom')
+outlinks_dedup_save_period = 300
+
+# Where the outlinks are sent: 'heritrix', 'imf' (the IMF crawler), 'file'
+# (outlinks_file) or 'log' (a segmented log in outlinks_log_path)
+outlinks_sink = 'heritrix'
+
+# The crawlers get at most outlinks_request_size outlinks per request and
+# up to outlinks_sink_concurrency requests at the same time
+outlinks_request_size = 10000
+outlinks_sink_concurrency = 4
+
+# Heritrix endpoint the outlinks are POSTed to
+heritrix_host = 'ia200127.eu.archive.org'
+heritrix_port = 8080
+heritrix_path = '/queue/update/'
+
+# IMF crawler endpoint the outlinks are POSTed to
+imf_host = 'localhost'
+imf_port = 8080
+imf_path = '/outlinks'
+
+# File of the 'file' sink
+outlinks_file = os.path.join(outlinks_path, 'outlinks.txt')
+
+# Directory of the 'log' sink and size of its segments
+outlinks_log_path = os.path.join(outlinks_path, 'log')
+outlinks_log_segment_size = 64 * 1024 * 1024
+
+
+####################################
+####            Spool           ####
+####################################
+
+# Spool directory, the triples and outlinks are written there before being
+# queued and replayed after a restart if they were not delivered
+spool_path = os.path.join(output_path, 'spool')
+
+# Size of a spool segment, the segments are deleted once delivered
+spool_segment_size = 64 * 1024 * 1024
+
+# Forces the spool writes to disk, safer but slower
+spool_fsync = False
+
+
+####################################
+####            Sinks           ####
+####################################
+
+# Keep-alive connections kept to each sink
+sink_pool_size = 2
+
+# Timeout of a request to a sink in seconds
+sink_timeout = 30
+
+# The bodies are streamed in pieces of about sink_piece_size bytes
+sink_piece_size = 64 * 1024
+
+# A chunk is retried sink_retries times, waiting a random delay up to
+# sink_backoff_base * 2^attempt seconds (at most sink_backoff_max) between
+# the attempts
+sink_retries = 3
+sink_backoff_base = 0.5
+sink_backoff_max = 30
+
+# After sink_failure_threshold failures in a row nothing is sent to the
+# sink for sink_reset_seconds seconds
+sink_failure_threshold = 5
+sink_reset_seconds = 60
+
+# Maximum number of chunks waiting for re-delivery, the chunks are written
+# in the backup files when it is reached
+redelivery_queue_size = 100
+
+# Minimum delay between two re-delivery attempts in seconds
+redelivery_period = 30
@@ -0,0 +1,155 @@
+import logging
+import Queue
+from threading import Thread, Event, Lock
+
+"""
+This module is about the 'pool' fetch engine: the requests of all the
+spiders of a platform are executed by a pool of fetcher threads, so a spider
+can have several requests in flight.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+
+def get_failed_response(request):
+    """ Returns the response of a request that could not be executed """
+    return {
+        'successful_interaction': False,
+        'headers': None,
+        'blender_config': {
+            'server': request.server,
+            'interaction': request.interaction
+        }
+    }
+
+
+class FetchRequest:
+    """ A request waiting to be executed by a fetcher, it is completed with
+    the blender response """
+    def __init__(self, server, interaction, url_params):
+        self.server = server
+        self.interaction = interaction
+        self.url_params = url_params
+        self.response = None
+        self.cancelled = False
+        self.done = Event()
+
+    def wait(self):
+        """ Waits for the request to be completed and returns the response
+        """
+        self.done.wait()
+        return self.response
+
+    def cancel(self):
+        """ Cancels the request if it has not been executed yet """
+        self.cancelled = True
+
+    def complete(self, response):
+        """ Sets the response and wakes up the waiting spider """
+        self.response = response
+        self.done.set()
+
+
+class FetchPool:
+    """ A pool of fetcher threads, each one with its own blender """
+    def __init__(self, name, size, blender_factory):
+        self.name = name
+        self.requests_queue = Queue.Queue()
+        # The requests are not queued anymore once the pool is closed
+        self.closed = False
+        self.lock = Lock()
+        self.fetcher_threads = []
+        for i in range(0, size):
+            fetcher_thread = Thread(target=self.fetcher_daemon,
+                                    args=(blender_factory(),))
+            self.fetcher_threads.append(fetcher_thread)
+            fetcher_thread.start()
+        logger.info('Fetch pool started for %s with %d fetchers' %
+                    (self.name, size))
+
+    def submit(self, server, interaction, url_params):
+        """ Queues a request and returns it without waiting, a request
+        submitted once the pool is shut down fails right away """
+        request = FetchRequest(server, interaction, url_params)
+        with self.lock:
+            if not self.closed:
+                self.requests_queue.put(request)
+                return request
+        # Else ..
+        request.complete(get_failed_response(request))
+        return request
+
+    def fetcher_daemon(self, blender):
+        """ Loops and executes the queued requests """
+        while True:
+            request = self.requests_queue.get(True)
+            # Shutdown
+            if request is None:
+                return
+            # Else ..
+            if request.cancelled:
+                request.complete(None)
+                continue
+            # Else ..
+            try:
+                blender.load_server(request.server)
+                blender.load_interaction(request.interaction)
+                blender.set_url_params(request.url_params)
+                response = blender.blend()
+            except Exception as e:
+                logger.error('[Fetch pool] %s: request %s failed, error: %s'
+                             % (self.name, request.url_params, e))
+                response = get_failed_response(request)
+            request.complete(response)
+
+    def shutdown(self, wait=True):
+        """ Stops the fetchers once the requests already queued have been
+        executed, waits for them if wait is True """
+        with self.lock:
+            self.closed = True
+            for fetcher_thread in self.fetcher_threads:
+                self.requests_queue.put(None)
+        if wait:
+            for fetcher_thread in self.fetcher_threads:
+                fetcher_thread.join()
+        logger.info('Fetch pool stopped for %s' % self.name)
+
+    def qsize(self):
+        """ Returns the number of requests waiting for a fetcher """
+        return self.requests_queue.qsize()
+
+
+class PooledBlender:
+    """ Blender-like front end of a fetch pool, used by one spider at a
+    time. blend() waits for the response, submit() does not. """
+    def __init__(self, fetch_pool, window):
+        self.fetch_pool = fetch_pool
+        # Number of pages a spider may fetch at the same time
+        self.window = window
+        self.server = None
+        self.interaction = None
+        self.url_params = {}
+
+    def load_server(self, server):
+        self.server = server
+        self.url_params = {}
+
+    def load_interaction(self, interaction):
+        self.interaction = interaction
+        self.url_params = {}
+
+    def set_url_params(self, url_params):
+        self.url_params.update(url_params)
+
+    def submit(self, url_params=None):
+        """ Submits a request with the current parameters updated with
+        url_params """
+        _url_params = dict(self.url_params)
+        if url_params:
+            _url_params.update(url_params)
+        return self.fetch_pool.submit(self.server, self.interaction,
+                                      _url_params)
+
+    def blend(self):
+        """ Executes the interaction and waits for the response """
+        return self.submit().wait()
@@ -1,16 +1,22 @@
 import datetime
 import Queue
-from threading import Thread
+import collections
+from threading import Thread, Lock
 import logging
 import math
 import datetime
 import time
 import json
+import os
+import re
 
 import apiblender
 
 import config
+import fetch
+import ratelimit
 import responses
+import scheduler
 import spiders
 
 """ 
@@ -31,15 +37,18 @@ class APICrawlerInterface:
         datetime.datetime.strptime('2012-01-01', '%Y-%m-%d')
         logger.info('Starting the APICrawler')
         self.responses_handler = responses.ResponsesHandler()
-        # Containers
-        self.crawls = set()
-        self.campaign_ids = set() 
-        self.platforms = set()
+        # Indexes: crawls by id, platforms by name and crawls by campaign
+        # id, a campaign id is dropped with its last crawl. The crawls are
+        # added and removed by the Web interface threads, hence the lock.
+        self.crawls = {}
+        self.campaign_crawls = {}
+        self.platforms = {}
+        self.lock = Lock()
         # Initializes platforms
         for platform_str in config.platforms:
             logger.info('Starting platform %s' % platform_str)
             platform = Platform(platform_str, self.responses_handler)
-            self.platforms.add(platform)
+            self.platforms[str(platform_str)] = platform
         logger.info('APICrawler is ready')
 
     def add_crawl(  self, 
@@ -54,20 +63,29 @@ class APICrawlerInterface:
                                             # generated
                 ):
         """ Generic method to add a crawl to the API Crawler """
-        # Creates the crawler
+        # Gets the right platform (see below)
+        platform = self.get_platform(platform_name)
+        if not platform:
+            raise ValueError('unknown platform: %s' % platform_name)
+        # Else ..
+        # Creates the crawler, outside of the lock: the dates are parsed
+        # and the first spider is made
         new_crawl = Crawl(platform_name, strategy, parameters,
                 campaign_id, start_date, end_date, period_in_hours,
                 crawl_id)
-        # New spiders are created (cf. Crawl __init___)
-        new_spiders = new_crawl.spiders
-        # Gets the right platform (see below)
-        platform = self.get_platform(platform_name)
+        with self.lock:
+            if new_crawl._id in self.crawls:
+                raise ValueError('crawl id already used: %s' % crawl_id)
+            # Else ..
+            # Add the crawl and the campaign_id
+            self.crawls[new_crawl._id] = new_crawl
+            self.campaign_crawls.setdefault(campaign_id, set()).add(new_crawl)
+        # The first spider is created (cf. Crawl __init___), the next ones
+        # are queued by the platform when the previous one is due
+        new_spiders = new_crawl.get_spiders()
         # Add the spiders to the platform 
         for new_spider in new_spiders:
             platform.add_spider_to_queue(new_spider)
-        # Add the crawl and the campaign_id
-        self.crawls.add(new_crawl)
-        self.campaign_ids.add(campaign_id)
         # Returns the crawl_id
         return new_crawl._id
 
@@ -89,6 +107,11 @@ class APICrawlerInterface:
             return 404
         # Else ..
         http_status = crawl.stop_crawl()
+        # Stopped spiders do not need to stay in the platform's queue
+        platform = self.get_platform(crawl.platform_name)
+        for spider in crawl.get_spiders():
+            if spider.status == 'stopped':
+                platform.rm_spider_from_queue(spider)
         return http_status
 
     #
@@ -96,43 +119,37 @@ class APICrawlerInterface:
     #
     def rm_crawl(self, crawl_id):
         """ Deletes crawl """
-        crawl = self.get_crawl(crawl_id)
-        if not crawl:
-            return 404
-        for spider in crawl.spiders:
-            if not (spider.status == 'stopped' or 'finished'):
-                return 400
-        # Else ..
-        for spider in crawl.spiders:
-            spider.status = 'being removed'
-            del spider
-        self.crawls.remove(crawl)
-        has_still_a_campaign_crawl = False
-        for other_crawl in self.crawls:
-            if other_crawl.campaign_id == crawl.campaign_id:
-                has_still_a_campaign_crawl = True
-                break
-        if not has_still_a_campaign_crawl:
-            self.campaign_ids.remove(crawl.campaign_id)
+        with self.lock:
+            crawl = self.crawls.get(crawl_id)
+            if not crawl:
+                return 404
+            # The spiders of the crawl not kept anymore are done, see
+            # Crawl.next_spider
+            crawl_spiders = crawl.get_spiders()
+            for spider in crawl_spiders:
+                if spider.status not in spiders.DONE_STATUSES:
+                    return 400
+            # Else ..
+            for spider in crawl_spiders:
+                spider.status = 'being removed'
+                del spider
+            del self.crawls[crawl_id]
+            campaign_crawls = self.campaign_crawls[crawl.campaign_id]
+            campaign_crawls.discard(crawl)
+            if not campaign_crawls:
+                del self.campaign_crawls[crawl.campaign_id]
         # del object
         del crawl
         return 200
 
     def get_crawl(self, crawl_id):
         """ Returns a crawl or None from a crawl_id """
-        for crawl in self.crawls:
-            if crawl._id == crawl_id:
-                return crawl
-        return None
+        with self.lock:
+            return self.crawls.get(crawl_id)
 
     def get_platform(self, platform_name):
         """ Returns a platform object from a platform's name string """
-        platform = False
-        for _platform in self.platforms:
-            if str(_platform.name) == str(platform_name):
-                platform = _platform 
-                break
-        return platform
+        return self.platforms.get(str(platform_name), False)
         
 #
 #       Currently not served by the Web interface 
@@ -141,17 +158,51 @@ class APICrawlerInterface:
 
     def get_campaign_crawls(self, campaign_id):
         """ Returns crawls from a campaign_id """
-        return [crawl for crawl in self.crawls if 
-                crawl.campaign_id == campaign_id]
-
+        with self.lock:
+            return list(self.campaign_crawls.get(campaign_id, []))
 
     def get_campaign_ids(self):
         """ Returns the campaign ids """
-        return self.campaign_ids
+        with self.lock:
+            return set(self.campaign_crawls)
 
     def get_platforms_load(self):
         """ Returns load of the different platforms """ 
-        return [platform.queue.qsize() for platform in self.platforms]
+        return [platform.scheduler.qsize() for platform in
+                self.platforms.values()]
+
+    def get_crawls_information(self):
+        """ Returns information about all the crawls, including the
+        concurrency of their platform """
+        with self.lock:
+            crawls = self.crawls.values()
+        crawls_list = []
+        for crawl in crawls:
+            crawl_dict = crawl.get_dict()
+            platform = self.get_platform(crawl.platform_name)
+            crawl_dict['platform_concurrency'] = {
+                    "concurrency": platform.concurrency,
+                    "running_spiders": platform.running_spiders
+            }
+            crawls_list.append(crawl_dict)
+        return crawls_list
+
+    def get_platforms_information(self):
+        """ Returns information about the different platforms """
+        return [platform.get_dict() for platform in self.platforms.values()]
+
+    def get_outputs_information(self):
+        """ Returns information about the output modules """
+        return self.responses_handler.get_dict()
+
+    def find_triples(self, **criteria):
+        """ Returns the triples matching the criteria, see
+        TripleIndex.find, or None if the triples are not indexed """
+        triple_index = self.responses_handler.triple_index
+        if not triple_index:
+            return None
+        # Else ..
+        return triple_index.find(**criteria)
 
 
 #class CampaignStatistics:
@@ -186,35 +237,62 @@ class Platform:
     def __init__(self, name, responses_handler):
         self.name = name
         self.logger = logging.getLogger(self.name)
-        self.queue = Queue.Queue()
-        self.daemon_thread = Thread(target=self.platform_daemon)
-        self.blender =  apiblender.Blender()
+        self.scheduler = scheduler.SpiderScheduler()
         self.responses_handler = responses_handler
-        self.daemon_thread.start()
+        # Number of spiders run at the same time, see config.py
+        self.concurrency = config.platform_concurrency.get(self.name, 1)
+        self.running_spiders = 0
+        self.running_lock = Lock()
+        # The rate limit is shared by all the workers of the platform
+        rate, burst = config.platform_rate_limits[self.name]
+        self.rate_limiter = ratelimit.TokenBucket(rate, burst)
+        # With the 'pool' engine, the requests of the spiders are executed
+        # by a fetch pool, see fetch.py
+        self.engine = config.platform_engines.get(self.name, 'blocking')
+        self.fetch_pool = None
+        if self.engine == 'pool':
+            self.fetch_pool = fetch.FetchPool(self.name,
+                                              config.fetch_pool_size,
+                                              self.new_blender)
+        # Workers running the spiders, each one has its own blender (a
+        # blender is not thread-safe) unless the platform uses a fetch pool
+        self.worker_threads = []
+        for i in range(0, self.concurrency):
+            worker_thread = Thread(target=self.platform_daemon)
+            self.worker_threads.append(worker_thread)
+            worker_thread.start()
+
+    def new_blender(self):
+        """ Returns a new blender using the platform's rate limit """
+        return ratelimit.RateLimitedBlender(apiblender.Blender(),
+                                            self.rate_limiter)
 
     def platform_daemon(self):
         """ Loops and executes spiders """
         self.logger.info('Starting %s daemon' % (self.name))
+        if not self.fetch_pool:
+            blender = self.new_blender()
         while True:
-            spider = self.queue.get()
-            # Processes only waiting spiders 
-            if not spider.status == 'waiting':
-                return
-            # If it is not the time yet, puts the spider at the end of
-            # the queue
-            if spider.start_date:
-                if spider.start_date > datetime.datetime.now():
-                    self.queue.put(spider)
-                    continue
-            # Does not process if the end_date is passed
-            if spider.end_date:
-                if spider.end_date < datetime.datetime.now():
-                    continue
-            # Else ..
+            # Sleeps until a waiting spider is due, spiders whose end_date
+            # is passed are dropped by the scheduler
+            spider = self.scheduler.get()
+            with self.running_lock:
+                self.running_spiders += 1
             self.logger.info('[Starting spider] id: %s' % id(spider))
-            spider.wrapper_run(self.blender, self.responses_handler)
-            output_warc = self.responses_handler.warcs_handler.warc_file_path
-            spider.output_warc = output_warc
+            # The next spider of a periodic crawl is made now that this one
+            # is due
+            if spider.crawl:
+                next_spider = spider.crawl.next_spider()
+                if next_spider:
+                    self.add_spider_to_queue(next_spider)
+            if self.fetch_pool:
+                blender = fetch.PooledBlender(self.fetch_pool,
+                                              config.fetch_window)
+            try:
+                spider.wrapper_run(blender, self.responses_handler)
+            finally:
+                with self.running_lock:
+                    self.running_spiders -= 1
             self.logger.info('[Completed spider] \n%s' % spider)
             if (spider.running_time < 5):
                 logger.warning('Spider duration < 5 seconds for %s' % 
@@ -222,10 +300,36 @@ class Platform:
 
     def add_spider_to_queue(self, spider):
         """ Adds a spider to the platform's queue """
-        self.queue.put(spider)
+        self.scheduler.put(spider)
+
+    def rm_spider_from_queue(self, spider):
+        """ Removes a spider from the platform's queue """
+        return self.scheduler.remove(spider)
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the platform's load """
+        next_due = self.scheduler.next_due()
+        if next_due:
+            next_due_str = next_due.strftime(config.datetime_format)
+        else:
+            next_due_str = 'None'
+        return {
+                "name": self.name,
+                "queue_depth": self.scheduler.qsize(),
+                "next_due": next_due_str,
+                "concurrency": self.concurrency,
+                "engine": self.engine,
+                "running_spiders": self.running_spiders,
+                "rate_limit": self.rate_limiter.get_dict()
+               }
 
 class Crawl:
-    """ A crawl is mostly a container for one or several spiders. """
+    """ A crawl is mostly a container for one or several spiders. A periodic
+    crawl is a recurrence rule: its spiders are made one at a time and only
+    the last ones are kept, so that a long crawl does not take more memory
+    or queue space than a single run. The older spiders are kept as their
+    records (dates, statistics and WARC files), and the older records in
+    the records file of the crawl. """
     def __init__(self, platform_name, strategy, parameters, campaign_id, 
                  start_date, end_date, period_in_hours, crawl_id):
         # Id can be set externally
@@ -271,37 +375,112 @@ class Crawl:
             logger.warning('Period in hours has to be None or > 0. Ignoring period'
                        ' for crawler %s' % self._id)
             self.period_in_hours = None
-        # Creating the spiders
-        self.create_spiders()
+        # Recurrence rule, the spiders are made one at a time
+        self.lock = Lock()
+        self.stopped = False
+        self.number_of_spiders = self.get_number_of_spiders()
+        self.made_spiders = 0
+        self.spiders = collections.deque()
+        # Records of the spiders not kept anymore, oldest first
+        self.past_spiders = collections.deque()
+        # The older records are in the records file, only their statistics
+        # are summed up
+        self.records_file = os.path.join(config.crawls_path, '%s.records' %
+                                         re.sub(r'[^\w.-]', '_',
+                                                '%s' % self._id))
+        self.written_records = 0
+        self.written_statistics = {}
+        # Creating the first spider
+        self.next_spider()
 
-    def create_spiders(self):
-        """ Create one or more spiders depending on start date, end date and period """
-        # Sees how many spiders we need
+    def get_number_of_spiders(self):
+        """ Returns the number of spiders of the crawl, depending on start
+        date, end date and period """
         number_of_spiders = 1
         if self.period_in_hours and self.start_date and self.end_date:
                 crawling_time = self.end_date - self.start_date
                 crawling_time_in_hours = crawling_time.total_seconds()/3600
-                number_of_spiders = \
-                    int(math.ceil(crawling_time_in_hours/self.period_in_hours)) + 1
-        # Creates one or more spiders
-        self.spiders = []
-        for i in range(0, number_of_spiders):
-            if number_of_spiders > 1:
-                timedelta_hours = i * self.period_in_hours
+                number_of_spiders = int(math.ceil(
+                    crawling_time_in_hours/self.period_in_hours)) + 1
+        return number_of_spiders
+
+    def next_spider(self):
+        """ Creates the next spider of the crawl, returns None if they have
+        all been created or if the crawl is stopped """
+        with self.lock:
+            if self.stopped or self.made_spiders >= self.number_of_spiders:
+                return None
+            # Else ..
+            this_start_date = self.start_date
+            if self.made_spiders:
+                timedelta_hours = self.made_spiders * self.period_in_hours
                 this_start_date = \
                 self.start_date + datetime.timedelta(hours=timedelta_hours)
-            else:
-                this_start_date = self.start_date
             # Creates the right spider
-            spider_class = config.spider_mapping[(self.platform_name, self.strategy)]
+            spider_class = config.spider_mapping[(self.platform_name,
+                                                  self.strategy)]
             new_spider = eval('spiders.' + spider_class +
                 '(self.parameters, this_start_date, self.end_date)')
+            new_spider.crawl_id = self._id
+            new_spider.campaign_id = self.campaign_id
+            new_spider.crawl = self
+            # The oldest spiders that are done are only kept as records, a
+            # spider still waiting or running is never dropped
+            while len(self.spiders) >= config.crawl_kept_spiders and \
+                  self.spiders[0].status in spiders.DONE_STATUSES:
+                self.past_spiders.append(
+                        get_spider_record(self.spiders.popleft()))
+                if len(self.past_spiders) > config.crawl_kept_records:
+                    self.write_record(self.past_spiders.popleft())
             self.spiders.append(new_spider)
-        
+            self.made_spiders += 1
+            return new_spider
+
+    def write_record(self, record):
+        """ Appends a record to the records file and adds its statistics to
+        the ones of the records written, the lock has to be held """
+        add_statistics(self.written_statistics, record['statistics'])
+        self.written_records += 1
+        record = dict(record)
+        record['output_warcs'] = record['output_warcs'].get_list()
+        # Two crawl ids can share a file name
+        record['crawl_id'] = self._id
+        try:
+            with open(self.records_file, 'a') as _f:
+                _f.write(json.dumps(record) + '\n')
+        except IOError as e:
+            logger.error('Could not write the record of a spider of crawl '
+                         '%s, error: %s' % (self._id, e))
+
+    def get_statistics(self):
+        """ Returns the statistics of all the spiders made so far """
+        with self.lock:
+            statistics = dict(self.written_statistics)
+            for record in self.past_spiders:
+                add_statistics(statistics, record['statistics'])
+            for spider in self.spiders:
+                add_statistics(statistics, spider.statistics)
+            statistics['spiders'] = self.made_spiders
+        if statistics.get('total_items'):
+            statistics['duplicate_ratio'] = \
+                statistics['duplicate_items'] / \
+                float(statistics['total_items'])
+        return statistics
+
+    def get_spiders(self):
+        """ Returns the last spiders made, oldest first """
+        with self.lock:
+            return list(self.spiders)
+
     def stop_crawl(self):
         """ Stops crawl """
-        http_status = 0
-        for spider in self.spiders:
+        with self.lock:
+            self.stopped = True
+            # The spiders not made yet are stopped too
+            http_status = 0
+            if self.made_spiders < self.number_of_spiders:
+                http_status = 200
+        for spider in self.get_spiders():
             spider_http_status = self.stop_spider(spider)
             # Returns the worst status
             http_status = max(http_status, spider_http_status)
@@ -345,8 +524,18 @@ class Crawl:
         else:
             end_date_str = 'None'
         spiders_list = []
-        for spider in self.spiders:
+        for spider in self.get_spiders():
             spiders_list.append(spider.get_dict())
+        with self.lock:
+            past_spiders = list(self.past_spiders)
+            records_file = None
+            if self.written_records:
+                records_file = self.records_file
+        past_spiders_list = []
+        for record in past_spiders:
+            record = dict(record)
+            record['output_warcs'] = record['output_warcs'].get_list()
+            past_spiders_list.append(record)
         return {
                 "campaign_id": self.campaign_id,
                 "id": self._id,
@@ -357,8 +546,34 @@ class Crawl:
                 "platform": self.platform_name,
                 "strategy": self.strategy,
                 "parameters": self.parameters,
-                "spiders": spiders_list
+                "schedule": {
+                    "period_in_hours": self.period_in_hours,
+                    "number_of_spiders": self.number_of_spiders,
+                    "made_spiders": self.made_spiders,
+                    "stopped": self.stopped
+                },
+                "statistics": self.get_statistics(),
+                "spiders": spiders_list,
+                "past_spiders": past_spiders_list,
+                "records_file": records_file
                }
 
     def __str__(self):
         return json.dumps(self.get_dict(), indent=4, sort_keys=True)
+
+
+def get_spider_record(spider):
+    """ Returns the record kept of a spider that is done, as its dict. The
+    responses of the spider may still be in the output modules, so the
+    record has its statistics and its WARC files (a warcs.SpiderWARCs), not
+    copies of them. """
+    record = spider.get_dict()
+    record['output_warcs'] = spider.output_warcs
+    return record
+
+
+def add_statistics(totals, statistics):
+    """ Adds the counts of a spider's statistics to totals """
+    for key, value in statistics.iteritems():
+        if type(value) is int:
+            totals[key] = totals.get(key, 0) + value
@@ -0,0 +1,137 @@
+import logging
+import sqlite3
+import hashlib
+import struct
+import json
+import threading
+
+import config
+
+"""
+This module is about the content items already processed: a periodic crawl
+or overlapping pages return the same items (e.g. tweets) again, their
+triples and outlinks are only made once, or again when they have changed.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+# State of a content item in the index
+NEW = 'new'
+UNCHANGED = 'unchanged'
+UPDATED = 'updated'
+
+
+def get_content_item_id(content_item):
+    """ Returns the id of a content item and the content item carrying it,
+    None if there is no id """
+    try:
+        return str(content_item['id']), content_item
+    except Exception:
+        try:
+            # Ad hoc add on for facebook users
+            # Not great, IDEA: find a way to improve that
+            for key in content_item:
+                content_item[key]['id']
+                content_item = content_item[key]
+            return str(content_item['id']), content_item
+        except Exception:
+            return None, content_item
+
+
+def get_hash(string):
+    """ Returns a 64 bits hash of a string as a signed integer, as stored by
+    SQLite """
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    return struct.unpack('<q', hashlib.md5(string).digest()[:8])[0]
+
+
+class ItemIndex:
+    """ Disk-backed index of the content items seen so far, by (platform,
+    id), with the hash of their content. Only hashes are stored and SQLite
+    keeps a bounded cache of the index pages, so the memory used does not
+    grow with the number of items. """
+    def __init__(self, file_path, use_content_hash=True):
+        self.file_path = file_path
+        self.use_content_hash = use_content_hash
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        # A negative size is in KiB
+        self.connection.execute('PRAGMA cache_size=-%d' %
+                                config.item_index_cache_kb)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS items '
+                                '(key INTEGER PRIMARY KEY, hash INTEGER)')
+        self.connection.commit()
+        self.checked = 0
+        self.unchanged = 0
+        self.updated = 0
+
+    def check_items(self, platform, content_items):
+        """ Returns the state of each content item, NEW, UNCHANGED or
+        UPDATED, and the index entries of the items that are not UNCHANGED.
+        The index is left as it is: the entries are added by add_entries
+        once the output of the items is saved, so that the items are
+        processed again if it is lost. An item without id is always NEW. """
+        keys = []
+        for content_item in content_items:
+            item_id, content_item = get_content_item_id(content_item)
+            if item_id is None:
+                keys.append((None, None))
+                continue
+            # Else ..
+            content_hash = 0
+            if self.use_content_hash:
+                content_hash = get_hash(json.dumps(content_item,
+                                                   sort_keys=True))
+            keys.append((get_hash('%s\0%s' % (platform, item_id)),
+                         content_hash))
+        states = []
+        entries = []
+        with self.lock:
+            cursor = self.connection.cursor()
+            for key, content_hash in keys:
+                if key is None:
+                    states.append(NEW)
+                    continue
+                # Else ..
+                row = cursor.execute('SELECT hash FROM items WHERE key = ?',
+                                     (key,)).fetchone()
+                if row is None:
+                    state = NEW
+                elif row[0] == content_hash:
+                    state = UNCHANGED
+                else:
+                    state = UPDATED
+                if state != UNCHANGED:
+                    entries.append((key, content_hash))
+                states.append(state)
+            self.checked += len(states)
+            self.unchanged += states.count(UNCHANGED)
+            self.updated += states.count(UPDATED)
+        return states, entries
+
+    def add_entries(self, entries):
+        """ Adds the entries returned by check_items to the index """
+        if not entries:
+            return
+        # Else ..
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO items '
+                                        'VALUES (?, ?)', entries)
+            self.connection.commit()
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the index's state """
+        duplicate_ratio = None
+        if self.checked:
+            duplicate_ratio = self.unchanged / float(self.checked)
+        return {
+                "file": self.file_path,
+                "checked_items": self.checked,
+                "unchanged_items": self.unchanged,
+                "updated_items": self.updated,
+                "duplicate_ratio": duplicate_ratio
+               }
@@ -0,0 +1,284 @@
+import logging
+import os
+import time
+import threading
+import Queue
+from threading import Thread
+
+import config
+import sinks
+import triples
+
+"""
+This module is about loading the triples files in the triple store: the
+blocks are read as the files are written and sent in parallel, a checkpoint
+keeps the position of the blocks loaded so that the loading resumes there
+after a restart. The blocks loaded after a block still in flight are in the
+checkpoint too, they are not sent again. The blocks the triple store rejects
+are moved to a rejects file, in the format of the triples files.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+# Content type of the requests, by protocol
+CONTENT_TYPES = {
+    'graph_store': 'application/n-quads',
+    'sparql_update': 'application/sparql-update'
+}
+
+
+def get_triples_files():
+    """ Returns the names of the triples files, oldest first """
+    return sorted([file_name for file_name in
+                   os.listdir(config.triples_path)
+                   if file_name.endswith('.triples')])
+
+
+def iter_nquads(block_triples, graph):
+    """ Yields the lines of a block as N-Quads, or N-Triples if it has no
+    graph """
+    for triple in block_triples:
+        terms = triples.get_rdf_terms(triple)
+        if not terms:
+            continue
+        # Else ..
+        if graph:
+            yield '%s %s %s %s .\n' % (terms + (graph,))
+        else:
+            yield '%s %s %s .\n' % terms
+
+
+def iter_insert_data(block_triples, graph):
+    """ Yields the lines of a block as a SPARQL INSERT DATA request """
+    yield 'INSERT DATA {\n'
+    if graph:
+        yield 'GRAPH %s {\n' % graph
+    for triple in block_triples:
+        terms = triples.get_rdf_terms(triple)
+        if terms:
+            yield '%s %s %s .\n' % terms
+    if graph:
+        yield '}\n'
+    yield '}\n'
+
+
+# Lines of the body of a request, by protocol
+BODIES = {
+    'graph_store': iter_nquads,
+    'sparql_update': iter_insert_data
+}
+
+
+class TripleStoreLoader:
+    """ Tails the triples files and sends their blocks to the triple store,
+    one request per block and up to config.triple_store_concurrency requests
+    at the same time. The checkpoint is the end of the blocks loaded without
+    gap, followed by the end of the blocks loaded after the gap. """
+    def __init__(self):
+        self.protocol = config.triple_store_protocol
+        self.concurrency = config.triple_store_concurrency
+        self.sink = sinks.HTTPSink('triple_store',
+                                   config.triple_store_host,
+                                   config.triple_store_port,
+                                   config.triple_store_path,
+                                   CONTENT_TYPES[self.protocol],
+                                   pool_size=self.concurrency)
+        self.checkpoint_file = os.path.join(config.triples_path,
+                                            'loader.checkpoint')
+        # Not named .triples, it is not loaded
+        self.rejects_file = os.path.join(config.triples_path,
+                                         'loader.rejects')
+        self.rejects_lock = threading.Lock()
+        # Blocks read but not sent yet, the reader waits when it is full
+        self.blocks_queue = Queue.Queue(2 * self.concurrency)
+        self.lock = threading.Lock()
+        # Blocks in flight by sequence number, as [file name, end offset,
+        # done], a block is done once loaded or rejected
+        self.pending_blocks = {}
+        self.next_sequence = 0
+        self.next_acknowledged = 0
+        # Blocks loaded after the checkpoint before a restart, as (file
+        # name, end offset), they are skipped when read again
+        self.position, self.recovered_blocks = self.read_checkpoint()
+        self.loaded_blocks = 0
+        self.skipped_blocks = 0
+        self.rejected_blocks = 0
+        self.loaded_triples = 0
+        self.skipped_files = 0
+        self.start_daemons()
+        logger.info('Triple store loader started at %s %d' % self.position)
+
+    def start_daemons(self):
+        reader_daemon_thread = Thread(target=self.reader_daemon)
+        reader_daemon_thread.start()
+        for i in range(0, self.concurrency):
+            loading_daemon_thread = Thread(target=self.loading_daemon)
+            loading_daemon_thread.start()
+
+    def read_checkpoint(self):
+        """ Returns the position of the blocks loaded without gap as (file
+        name, offset), and the set of the blocks loaded after it as (file
+        name, end offset) """
+        try:
+            with open(self.checkpoint_file) as _f:
+                positions = [line.split() for line in _f if line.strip()]
+            positions = [(file_name, int(offset))
+                         for file_name, offset in positions]
+        except (IOError, ValueError):
+            return ('', 0), set()
+        if not positions:
+            return ('', 0), set()
+        # Else ..
+        return positions[0], set(positions[1:])
+
+    def write_checkpoint(self, position, loaded_positions):
+        """ Writes the position of the blocks loaded without gap and the
+        ones of the blocks loaded after it, atomically """
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as _f:
+            _f.write('%s %d\n' % position)
+            for loaded_position in loaded_positions:
+                _f.write('%s %d\n' % loaded_position)
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def reader_daemon(self):
+        """ Reads the blocks of the triples files in order, from the
+        checkpoint, and queues them for the loading daemons """
+        file_name, offset = self.position
+        while True:
+            file_names = get_triples_files()
+            newer_files = [_file_name for _file_name in file_names
+                           if _file_name > file_name]
+            if file_name in file_names:
+                offset = self.read_blocks(file_name, offset)
+            if not newer_files:
+                # The file is still being written
+                time.sleep(config.triple_store_poll_period)
+                continue
+            # Else ..
+            # The newer files were there before the file was read, nothing
+            # will be added to it anymore
+            file_path = os.path.join(config.triples_path, file_name)
+            if file_name in file_names and \
+               offset < os.path.getsize(file_path):
+                logger.warning('[Loader] Skipping the end of %s from %d, '
+                               'the block is corrupted' % (file_name, offset))
+                self.skipped_files += 1
+            file_name, offset = newer_files[0], 0
+
+    def read_blocks(self, file_name, offset):
+        """ Queues the blocks of a file from offset, returns the offset of
+        the end of the last complete block """
+        file_path = os.path.join(config.triples_path, file_name)
+        with open(file_path, 'rb') as _f:
+            _f.seek(offset)
+            while True:
+                try:
+                    block = triples.read_backup_block(_f)
+                except ValueError as e:
+                    # Either still being written or corrupted, it is skipped
+                    # once there is a newer file
+                    logger.debug('[Loader] Stopped reading %s at %d: %s' %
+                                 (file_name, offset, e))
+                    return offset
+                if block is None:
+                    return offset
+                # Else ..
+                offset = _f.tell()
+                with self.lock:
+                    sequence = self.next_sequence
+                    self.next_sequence += 1
+                    # Loaded before the restart
+                    loaded = (file_name, offset) in self.recovered_blocks
+                    self.pending_blocks[sequence] = [file_name, offset,
+                                                     loaded]
+                    if loaded:
+                        self.recovered_blocks.discard((file_name, offset))
+                        self.skipped_blocks += 1
+                        self.move_checkpoint()
+                if not loaded:
+                    self.blocks_queue.put((sequence, block))
+
+    def loading_daemon(self):
+        """ Sends the queued blocks to the triple store, a block is sent
+        again until it has been loaded or rejected """
+        while True:
+            sequence, (block_header, block_triples) = self.blocks_queue.get()
+            graph = triples.get_context_graph(block_header['crawl_id'],
+                                              block_header['campaign_id'])
+            get_body = lambda: sinks.iter_pieces(
+                                BODIES[self.protocol](block_triples, graph))
+            loaded = True
+            while True:
+                try:
+                    self.sink.send(get_body)
+                    break
+                except sinks.RejectedError as e:
+                    logger.error('[Loader] The triple store rejected a '
+                                 'block of %d triples, moved to %s: %s' %
+                                 (len(block_triples), self.rejects_file, e))
+                    self.reject(block_header, block_triples)
+                    loaded = False
+                    break
+                except sinks.SinkError as e:
+                    logger.warning('[Loader] Failed to load a block, will '
+                                   'try again: %s' % e)
+                    time.sleep(max(config.triple_store_poll_period,
+                                   self.sink.circuit_breaker.retry_in()))
+            self.acknowledge(sequence, len(block_triples), loaded)
+
+    def reject(self, block_header, block_triples):
+        """ Appends a block to the rejects file """
+        chunk = triples.TripleBatch()
+        context = [block_header['crawl_id'], block_header['campaign_id']]
+        chunk.extend([triple + context for triple in block_triples])
+        with self.rejects_lock:
+            with open(self.rejects_file, 'ab') as _f:
+                triples.write_backup(_f, chunk, block_header['time'])
+            self.rejected_blocks += 1
+
+    def acknowledge(self, sequence, number_of_triples, loaded=True):
+        """ Marks a block as done, loaded or rejected, and writes the
+        checkpoint """
+        with self.lock:
+            self.pending_blocks[sequence][2] = True
+            if loaded:
+                self.loaded_blocks += 1
+                self.loaded_triples += number_of_triples
+            self.move_checkpoint()
+
+    def move_checkpoint(self):
+        """ Moves the checkpoint to the end of the blocks loaded without
+        gap and writes it with the blocks loaded after the gap, the lock
+        has to be held """
+        while self.pending_blocks.get(self.next_acknowledged,
+                                      [None, None, False])[2]:
+            file_name, offset, _ = \
+                self.pending_blocks.pop(self.next_acknowledged)
+            self.position = (file_name, offset)
+            self.next_acknowledged += 1
+        # The blocks read again after a restart are in recovered_blocks
+        # until then, the ones the checkpoint went past are forgotten
+        self.recovered_blocks = set([recovered_block for recovered_block
+                                     in self.recovered_blocks
+                                     if recovered_block > self.position])
+        loaded_positions = sorted([(file_name, offset) for file_name,
+                                   offset, loaded in
+                                   self.pending_blocks.itervalues()
+                                   if loaded] + list(self.recovered_blocks))
+        self.write_checkpoint(self.position, loaded_positions)
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the loader's state """
+        with self.lock:
+            return {
+                    "protocol": self.protocol,
+                    "position": '%s %d' % self.position,
+                    "pending_blocks": len(self.pending_blocks),
+                    "loaded_blocks": self.loaded_blocks,
+                    "skipped_blocks": self.skipped_blocks,
+                    "rejected_blocks": self.rejected_blocks,
+                    "loaded_triples": self.loaded_triples,
+                    "skipped_files": self.skipped_files,
+                    "sink": self.sink.get_dict()
+                   }
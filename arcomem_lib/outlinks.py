@@ -1,14 +1,28 @@
 import logging
-import Queue
-import httplib
 import json
+import re
 from threading import Thread
+import Queue
 import datetime
 import os
+import time
 
 import config
+import batchqueue
+import spool
+import sinks
+import bloom
 
 logger = logging.getLogger('outlinks')
+
+# Matches the URLs in a string as (scheme, host, path and query, fragment),
+# a URL stops at a white space, a quote or a character not allowed in URLs
+URL_PATTERN = re.compile(r'''(https?)://([^\s"'<>\\^`{|}\[\]/?#]+)'''
+                         r'''([^\s"'<>\\^`{|}\[\]#]*)(#[^\s"'<>\\^`{|}\[\]]*)?''',
+                         re.I)
+# Punctuation ending a sentence rather than a URL
+TRAILING_CHARACTERS = '.,;:!?'
+
 #
 # IDEA: Could have a backup file change mecanism (like for outlinks), see
 # if this is relevant
@@ -17,7 +31,26 @@ class OutlinksManager:
     """ Extracts outlinks from API responses and sends them to the crawler
     or writes it into a backup file """
     def __init__(self):
-        self.outlinks_queue = Queue.Queue()
+        # The outlinks are spooled on disk until they have been delivered
+        self.outlinks_queue = spool.SpooledBatchQueue(
+                                config.outlinks_queue_size,
+                                spool.Spool('outlinks'))
+        self.flush_policy = batchqueue.FlushPolicy(
+                                config.outlinks_chunk_size,
+                                config.outlinks_flush_seconds,
+                                config.outlinks_flush_bytes)
+        self.sink = OUTLINKS_SINKS[config.outlinks_sink]()
+        self.redeliverer = sinks.Redeliverer('outlinks', self.sink)
+        # Remembers the outlinks already queued so that they are sent once
+        self.dedup = None
+        if config.outlinks_dedup:
+            self.dedup = bloom.SlidingBloomFilter(
+                                config.outlinks_dedup_capacity,
+                                config.outlinks_dedup_error_rate,
+                                config.outlinks_dedup_max_bytes)
+            if config.outlinks_dedup_file:
+                self.dedup.load(config.outlinks_dedup_file)
+        self.dedup_saved_time = time.time()
         self.start_daemon()
         logger.info('Outlinks Manager started')
         # The backup file is used for outlinks that where not successfully
@@ -35,59 +68,344 @@ class OutlinksManager:
         t.start()
 
     def add_outlinks(self, outlinks):
-        """ Adds outlinks to the queue """
-        for outlink in outlinks:
-            self.outlinks_queue.put(outlink)
+        """ Adds outlinks to the queue, except the ones already queued """
+        if self.dedup:
+            outlinks = [outlink for outlink in outlinks if not
+                        self.dedup.add(outlink)]
+        self.outlinks_queue.put_many(list(outlinks))
+
+    def save_dedup(self):
+        """ Saves the outlinks already queued every
+        config.outlinks_dedup_save_period seconds """
+        if not self.dedup or not config.outlinks_dedup_file or \
+           time.time() - self.dedup_saved_time < \
+           config.outlinks_dedup_save_period:
+            return
+        # Else ..
+        self.dedup.save(config.outlinks_dedup_file)
+        self.dedup_saved_time = time.time()
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the manager's state """
+        return {
+                "queue_size": self.outlinks_queue.qsize(),
+                "flush": self.flush_policy.get_dict(),
+                "spool": self.outlinks_queue.spool.get_dict(),
+                "sink": self.sink.get_dict(),
+                "redelivery": self.redeliverer.get_dict(),
+                "dedup": self.dedup and self.dedup.get_dict()
+               }
 
     def outlinks_daemon(self):
         """ Loops and takes care of outlinks in the queue """
-        outlinks_chunk = []
-        chunk_size = config.outlinks_chunk_size
-        save_backup = False
         while True:
-            # Waits for the chunk to be full
-            while len(outlinks_chunk) < chunk_size:
-                outlinks_chunk.append(self.outlinks_queue.get(True))
+            # A new list for each chunk, the re-delivery queue keeps the
+            # chunks that could not be sent
+            outlinks_chunk = []
+            save_backup = False
+            # Waits for the chunk to be full, big or old enough
+            while not self.flush_policy.is_due():
+                outlinks = self.outlinks_queue.get_many(
+                                self.flush_policy.items_needed(),
+                                self.flush_policy.timeout())
+                outlinks_chunk.extend(outlinks)
+                self.flush_policy.add(len(outlinks),
+                                      sum([len(outlink) for outlink in
+                                           outlinks]))
+            chunk_size = len(outlinks_chunk)
+            latency = self.flush_policy.flushed()
             # Sends the chunk
             logger.info('[In progress] Sending %s outlinks to the crawler'\
-                        % chunk_size)
+                        ', flush latency: %.1f s' % (chunk_size, latency))
+            undelivered = None
             try:
-                # TODO: sends to heritrix so far, IMF crawler?
-                self.send_outlinks_to_heritrix(outlinks_chunk)
+                self.sink.send(outlinks_chunk)
                 logger.warning('[Success] Sent %s outlinks to the crawler'\
                         % chunk_size)
-            except Exception as e:
+            except sinks.SinkError as e:
                 logger.warning('[Failure] Exception occured during an '
                                'attempt to send the outlinks: %s' % e)
-                save_backup = True
+                # The outlinks are sent again once the crawler is back
+                undelivered = e.undelivered or outlinks_chunk
+                save_backup = not self.redeliverer.add(undelivered)
             if save_backup:
                 logger.info('[In progress] Saving outlinks to backup file')
                 with open(self.backup_file, 'a') as _backup_file:
                     _backup_file.write( ' ** Backup **\nDate: ' + \
                     datetime.datetime.now().strftime(config.datetime_format)\
                     + '\n')
-                    _backup_file.write(json.dumps(outlinks_chunk) + '\n')
+                    _backup_file.write(json.dumps(undelivered) + '\n')
                 logger.info('[Success] Saved outlinks to backup file')
-            # Cleans variables
-            del outlinks_chunk[:]
-            save_backup = False
+            # The chunk has been delivered, it does not need to be replayed
+            self.outlinks_queue.acknowledge()
+            self.save_dedup()
+
+
+def extract_outlinks(content):
+    """ Extracts the outlinks of a content (e.g. a tweet), including the
+    ones in text fields, in one iterative pass. Returns a set of normalized
+    outlinks: lower case scheme and host, no fragment. """
+    outlinks = set()
+    stack = [content]
+    while stack:
+        item = stack.pop()
+        item_type = type(item)
+        if item_type is dict:
+            stack.extend(item.itervalues())
+        elif item_type is list:
+            stack.extend(item)
+        elif item_type is unicode or item_type is str:
+            # Escaped slashes, e.g. http:\/\/
+            if '\\' in item:
+                item = item.replace('\\/', '/')
+            # Most of the strings have no URL at all
+            if '://' not in item:
+                continue
+            # Else ..
+            if '&' in item:
+                item = item.replace('&quot;', ' ').replace('&amp;', '&')
+            for scheme, host, path, fragment in URL_PATTERN.findall(item):
+                if not fragment:
+                    # The punctuation after a URL is not part of it
+                    path = path.rstrip(TRAILING_CHARACTERS)
+                    while path.endswith(')') and \
+                          path.count(')') > path.count('('):
+                        path = path[:-1].rstrip(TRAILING_CHARACTERS)
+                    if not path:
+                        host = host.rstrip(TRAILING_CHARACTERS)
+                if not host:
+                    continue
+                # Else ..
+                outlinks.add('%s://%s%s' % (scheme.lower(), host.lower(),
+                                            path or '/'))
+    return outlinks
+
+
+#
+#       Outlink sinks, the one used is set by outlinks_sink in config.py. A
+#       sink has a send(outlinks) method raising sinks.SinkError and a
+#       circuit_breaker, so that it can be used by a sinks.Redeliverer.
+#
+
+def to_utf8(string):
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+
+class OutlinksSink:
+    """ Base of the local outlink sinks, write(outlinks) has to be
+    implemented """
+    name = None
+
+    def __init__(self):
+        self.circuit_breaker = sinks.CircuitBreaker(
+                                    config.sink_failure_threshold,
+                                    config.sink_reset_seconds)
+        self.sent_outlinks = 0
+
+    def send(self, outlinks):
+        """ Writes outlinks, raises sinks.SinkError if it failed """
+        if not self.circuit_breaker.allow():
+            raise sinks.CircuitOpenError('%s: circuit open' % self.name)
+        # Else ..
+        try:
+            self.write(outlinks)
+        except (IOError, OSError) as e:
+            self.circuit_breaker.failure()
+            raise sinks.SinkError('%s: %s' % (self.name, e))
+        self.circuit_breaker.success()
+        self.sent_outlinks += len(outlinks)
+
+    def write(self, outlinks):
+        raise NotImplementedError
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the sink's state """
+        return {
+                "sink": self.name,
+                "sent_outlinks": self.sent_outlinks,
+                "circuit": self.circuit_breaker.get_dict()
+               }
+
+
+class HTTPOutlinksSink(OutlinksSink):
+    """ POSTs the outlinks on config.outlinks_sink_concurrency connections
+    at the same time. A request carries at most config.outlinks_request_size
+    outlinks and its body is streamed, iter_body has to be implemented. """
+    content_type = None
+
+    def __init__(self, host, port, path):
+        self.concurrency = config.outlinks_sink_concurrency
+        self.http_sink = sinks.HTTPSink(self.name, host, port, path,
+                                        content_type=self.content_type,
+                                        pool_size=self.concurrency)
+        self.circuit_breaker = self.http_sink.circuit_breaker
+        self.sent_outlinks = 0
+        self.rejected_outlinks = 0
+
+    def iter_body(self, outlinks, start, end):
+        """ Returns the pieces of the body for outlinks[start:end] """
+        raise NotImplementedError
+
+    def send(self, outlinks):
+        """ Sends outlinks, raises sinks.SinkError with the outlinks that
+        were not delivered if some requests failed. The outlinks of the
+        requests the crawler rejected are logged and not sent again. """
+        requests = Queue.Queue()
+        for start in xrange(0, len(outlinks), config.outlinks_request_size):
+            requests.put((start, min(len(outlinks),
+                                     start + config.outlinks_request_size)))
+        undelivered = []
+        rejected = []
+        errors = []
+
+        def sender():
+            while True:
+                try:
+                    start, end = requests.get_nowait()
+                except Queue.Empty:
+                    return
+                # Else ..
+                try:
+                    self.http_sink.send(
+                        lambda: self.iter_body(outlinks, start, end))
+                except sinks.RejectedError as e:
+                    rejected.extend(outlinks[start:end])
+                    logger.error('%s: %d outlinks rejected, %s' %
+                                 (self.name, end - start, e))
+                except sinks.SinkError as e:
+                    undelivered.extend(outlinks[start:end])
+                    errors.append(e)
+
+        threads = [Thread(target=sender) for i in
+                   range(0, min(self.concurrency, requests.qsize()))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.sent_outlinks += len(outlinks) - len(undelivered) - \
+                              len(rejected)
+        self.rejected_outlinks += len(rejected)
+        if errors:
+            raise sinks.SinkError('%s: %d of %d outlinks not delivered, %s' %
+                                  (self.name, len(undelivered),
+                                   len(outlinks), errors[0]), undelivered)
+
+    def get_dict(self):
+        dict_ = OutlinksSink.get_dict(self)
+        dict_["rejected_outlinks"] = self.rejected_outlinks
+        dict_["http"] = self.http_sink.get_dict()
+        return dict_
+
+
+class HeritrixSink(HTTPOutlinksSink):
+    """ Adds the outlinks to the queue of a Heritrix crawler """
+    name = 'heritrix'
+    content_type = 'text/json; charset=utf-8'
+
+    def __init__(self):
+        HTTPOutlinksSink.__init__(self, config.heritrix_host,
+                                  config.heritrix_port, config.heritrix_path)
+
+    def iter_body(self, outlinks, start, end):
+        """ The body is [{"url": outlink, "score": 1.0}, ...] """
+        yield '['
+        for piece in sinks.iter_pieces(
+                '%s{"url": %s, "score": 1.0}' %
+                (', ' if i > start else '', json.dumps(outlinks[i]))
+                for i in xrange(start, end)):
+            yield piece
+        yield ']'
+
+
+class IMFSink(HTTPOutlinksSink):
+    """ Sends the outlinks to the IMF crawler, one outlink per line """
+    name = 'imf'
+    content_type = 'text/plain; charset=utf-8'
+
+    def __init__(self):
+        HTTPOutlinksSink.__init__(self, config.imf_host, config.imf_port,
+                                  config.imf_path)
+
+    def iter_body(self, outlinks, start, end):
+        return sinks.iter_pieces(to_utf8(outlinks[i]) + '\n'
+                                 for i in xrange(start, end))
+
+
+class FileSink(OutlinksSink):
+    """ Appends the outlinks to a text file, one outlink per line """
+    name = 'file'
+
+    def write(self, outlinks):
+        with open(config.outlinks_file, 'a') as _f:
+            for piece in sinks.iter_pieces(to_utf8(outlink) + '\n'
+                                           for outlink in outlinks):
+                _f.write(piece)
+
+
+class LogSink(OutlinksSink):
+    """ Appends the outlinks to a log, one outlink per line, like a Kafka
+    topic: the log is split in segments named after the offset of their
+    first outlink, and the consumers keep the offset they have read up to.
+    Old segments have to be deleted by the consumers. """
+    name = 'log'
+
+    def __init__(self):
+        OutlinksSink.__init__(self)
+        self.path = config.outlinks_log_path
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        segments = self.list_segments()
+        self.next_offset = 0
+        if segments:
+            # Carries on with the last segment
+            self.base_offset = segments[-1]
+            with open(self.get_segment_path(self.base_offset)) as _f:
+                self.next_offset = self.base_offset + \
+                                   sum(1 for line in _f)
+        else:
+            self.base_offset = 0
+        self.segment_file = open(self.get_segment_path(self.base_offset),
+                                 'ab')
+        logger.info('Outlinks log: %s, next offset: %d' %
+                    (self.path, self.next_offset))
+
+    def get_segment_path(self, base_offset):
+        return os.path.join(self.path, '%020d.log' % base_offset)
+
+    def list_segments(self):
+        """ Returns the base offsets of the segments, sorted """
+        segments = []
+        for file_name in os.listdir(self.path):
+            if file_name.endswith('.log'):
+                try:
+                    segments.append(int(file_name[:-4]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def write(self, outlinks):
+        if self.segment_file.tell() >= config.outlinks_log_segment_size:
+            self.segment_file.close()
+            self.base_offset = self.next_offset
+            self.segment_file = open(
+                    self.get_segment_path(self.base_offset), 'ab')
+        for piece in sinks.iter_pieces(to_utf8(outlink) + '\n'
+                                       for outlink in outlinks):
+            self.segment_file.write(piece)
+        self.segment_file.flush()
+        self.next_offset += len(outlinks)
+
+    def get_dict(self):
+        dict_ = OutlinksSink.get_dict(self)
+        dict_["next_offset"] = self.next_offset
+        return dict_
+
 
-    def send_outlinks_to_heritrix(self, outlinks):
-        """ Sends outlinks to Heritrix crawler on machine ia200127 """
-        heritrix_connection = httplib.HTTPConnection( \
-                'ia200127.eu.archive.org', 8080, timeout=0.1 )
-        heritrix_connection.connect()
-        outlinks_bulk = []
-        for outlink in outlinks:
-            outlinks_bulk.append({"url": outlink, "score": 1.0})
-        heritrix_headers = {    'Content-Type': 'text/json',
-                                'charset': 'utf-8'  }
-        heritrix_connection.request('POST', 'queue/update/', \
-                        body=json.dumps(outlinks_bulk), \
-                        headers=heritrix_headers)
-        response = heritrix_connection.getresponse()
-        if response.status <> 200:
-            logger.warning('Connexion with Heritrix broken')
-            raise Exception, 'Wrong status code'
-        heritrix_connection.close()
-        del outlinks_bulk[:]
+OUTLINKS_SINKS = {
+    'heritrix':     HeritrixSink,
+    'imf':          IMFSink,
+    'file':         FileSink,
+    'log':          LogSink
+}
@@ -0,0 +1,157 @@
+import logging
+import time
+from threading import Lock
+
+import config
+
+"""
+This module paces the requests sent to an API platform, it is shared by all
+the spiders of the platform.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+# Rate limit headers, lower case, as sent by the different APIs
+REMAINING_HEADERS = ['x-ratelimit-remaining', 'x-rate-limit-remaining',
+                     'x-feature-ratelimit-remaining']
+RESET_HEADERS = ['x-ratelimit-reset', 'x-rate-limit-reset',
+                 'x-feature-ratelimit-reset']
+RETRY_AFTER_HEADERS = ['retry-after']
+
+
+def get_header(headers, names):
+    """ Returns the value of the first header found in names or None,
+    headers can be a dict or a list of (name, value) """
+    if not headers:
+        return None
+    if type(headers) is dict:
+        headers = headers.items()
+    for header in headers:
+        try:
+            name, value = header
+        except (TypeError, ValueError):
+            continue
+        if str(name).lower() in names:
+            return value
+    return None
+
+
+def get_number(value):
+    """ Converts a header value to a float or None """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """ Token bucket: allows rate requests per second on average and bursts
+    of up to burst requests """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.lock = Lock()
+        # Set from the rate limit headers
+        self.adaptive_rate = None
+        self.adaptive_until = 0
+        self.paused_until = 0
+        self.throttled_requests = 0
+
+    def get_rate(self, now):
+        """ Returns the rate currently allowed """
+        if self.adaptive_rate is not None and now < self.adaptive_until:
+            return min(self.rate, self.adaptive_rate)
+        return self.rate
+
+    def refill(self, now):
+        """ Adds the tokens earned since the last refill """
+        elapsed = max(0, now - self.last_refill)
+        self.tokens = min(self.burst,
+                          self.tokens + elapsed * self.get_rate(now))
+        self.last_refill = now
+
+    def acquire(self):
+        """ Blocks until a token is available and takes it """
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    # Else ..
+                    rate = self.get_rate(now)
+                    if rate > 0:
+                        wait = (1 - self.tokens) / rate
+                    else:
+                        wait = max(0.1, self.adaptive_until - now)
+            time.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """ Adapts the rate to the rate limit headers of a response,
+        returns True if the API says we are throttled """
+        remaining = get_number(get_header(headers, REMAINING_HEADERS))
+        reset = get_number(get_header(headers, RESET_HEADERS))
+        retry_after = get_number(get_header(headers, RETRY_AFTER_HEADERS))
+        throttled = False
+        with self.lock:
+            now = time.time()
+            # Reset is either an epoch time or a number of seconds
+            if reset is not None and reset > 1000000000:
+                reset = reset - now
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+                throttled = True
+            if remaining is not None and reset is not None and reset > 0:
+                if remaining < 1:
+                    self.paused_until = max(self.paused_until, now + reset)
+                    throttled = True
+                # Spreads the remaining requests until the reset
+                self.adaptive_rate = remaining / reset
+                self.adaptive_until = now + reset
+            if throttled:
+                self.tokens = 0
+                self.throttled_requests += 1
+        return throttled
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the bucket's state """
+        now = time.time()
+        return {
+                "rate": self.get_rate(now),
+                "burst": self.burst,
+                "paused_for": max(0, self.paused_until - now),
+                "throttled_requests": self.throttled_requests
+               }
+
+
+class RateLimitedBlender:
+    """ Wraps a blender so that each request takes a token from the
+    platform's bucket, throttled requests are retried once the bucket
+    allows it """
+    def __init__(self, blender, bucket):
+        self.blender = blender
+        self.bucket = bucket
+
+    def __getattr__(self, name):
+        return getattr(self.blender, name)
+
+    def blend(self):
+        """ Executes the interaction when the bucket allows it """
+        for attempt in range(0, config.rate_limit_retries + 1):
+            self.bucket.acquire()
+            response = self.blender.blend()
+            throttled = self.bucket.update_from_headers(
+                                            response.get('headers'))
+            if response['successful_interaction'] or not throttled:
+                return response
+            # Else ..
+            logger.warning('[Rate limit] Throttled by %s, retrying (%d/%d)'
+                           % (response.get('blender_config', {}).get('server'),
+                              attempt + 1, config.rate_limit_retries))
+        return response
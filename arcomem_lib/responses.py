@@ -1,43 +1,175 @@
 import logging
-import re
+import datetime
+import Queue
+import multiprocessing
+from threading import Thread
 
 import config
 
 import warcs
 import triples
 import outlinks
+import itemindex
+import loader
+import tripleindex
 
 logger = logging.getLogger('apicrawler')
 
 class ResponsesHandler: 
     """ Handles API responses """
     def __init__(self): 
-        self.triples_handler = triples.TripleManager()
+        # The pool is started first, so that the worker processes are
+        # forked before the other threads are started
+        self.processes = config.processing_processes
+        self.processing_pool = None
+        if self.processes:
+            self.processing_pool = multiprocessing.Pool(self.processes)
+        self.processing_queue = Queue.Queue(config.processing_queue_size)
+        # Batches being processed, in the order they were submitted
+        self.results_queue = Queue.Queue(2 * max(1, self.processes))
+        # Content items already processed
+        self.item_index = None
+        if config.item_index:
+            self.item_index = itemindex.ItemIndex(
+                                    config.item_index_file,
+                                    config.item_index_content_hash)
+        # Triples made so far, for the lookups
+        self.triple_index = None
+        if config.triple_index:
+            self.triple_index = tripleindex.TripleIndex(
+                                    config.triple_index_file)
+        self.triples_handler = triples.TripleManager(self.triple_index)
+        # The triples files are only a backup if there is no triple store
+        self.triple_store_loader = None
+        if config.triple_store_host:
+            self.triple_store_loader = loader.TripleStoreLoader()
         self.warcs_handler = warcs.WARCManager()
         self.outlinks_handler = outlinks.OutlinksManager()
+        self.start_daemons()
 
-    def add_response(self, response):
-        """ Handles a response dispatching it to the different components
-        """
+    def start_daemons(self):
+        processing_daemon_thread = Thread(target=self.processing_daemon)
+        processing_daemon_thread.start()
+        results_daemon_thread = Thread(target=self.results_daemon)
+        results_daemon_thread.start()
+
+    def add_response(self, response, statistics):
+        """ Handles a response dispatching it to the different components,
+        the triples and outlinks are counted in statistics once made.
+        Returns the number of content items found in the response. """
         # The whole response goes as a WARC
         self.warcs_handler.add_response(response)
         # Regarding triples and outlinks, we need to process each item of the
         # response (e.g. a tweet)
         content_items = self.get_content_items(response)
         if not content_items:
-            return 0,0
+            return 0
+        # Else ..
+        number_of_items = len(content_items)
+        states, index_entries = None, None
+        if self.item_index:
+            content_items, states, index_entries = self.skip_duplicates(
+                                content_items,
+                                response['blender_config']['server'],
+                                statistics)
+            if not content_items:
+                return number_of_items
         # Else ..
-        blender_config = response['blender_config']
-        headers = response['headers']
-        total_outlinks, total_triples = 0, 0
-        for content_item in content_items:
-                item_outlinks, item_triples = self.add_content_item(
-                                        content_item, 
-                                        blender_config, 
-                                        headers )
-                total_triples += item_triples
-                total_outlinks += item_outlinks
-        return total_outlinks, total_triples
+        # Blocks if the processing is late, this slows down the spiders
+        self.processing_queue.put((content_items, 
+                                   states,
+                                   response['blender_config'],
+                                   statistics,
+                                   (response.get('crawl_id'),
+                                    response.get('campaign_id')),
+                                   index_entries))
+        return number_of_items
+
+    def skip_duplicates(self, content_items, platform, statistics):
+        """ Returns the content items that are new or have changed, their
+        states and their index entries, counts the duplicates in statistics.
+        The entries are added to the index once the triples and outlinks of
+        the items are spooled, see results_daemon. """
+        states, index_entries = self.item_index.check_items(platform,
+                                                            content_items)
+        statistics['total_items'] += len(states)
+        statistics['duplicate_items'] += states.count(itemindex.UNCHANGED)
+        statistics['updated_items'] += states.count(itemindex.UPDATED)
+        statistics['duplicate_ratio'] = statistics['duplicate_items'] / \
+                                        float(statistics['total_items'])
+        kept_items = [(content_item, state) for content_item, state in
+                      zip(content_items, states)
+                      if state != itemindex.UNCHANGED]
+        return [content_item for content_item, state in kept_items], \
+               [state for content_item, state in kept_items], index_entries
+
+    def processing_daemon(self):
+        """ Sends batches of responses to the worker processes """
+        batch_size = config.processing_batch_size
+        while True:
+            batch = [self.processing_queue.get(True)]
+            while len(batch) < batch_size:
+                try:
+                    batch.append(self.processing_queue.get_nowait())
+                except Queue.Empty:
+                    break
+            work = [(content_items, states, blender_config) for
+                    content_items, states, blender_config, statistics,
+                    context, index_entries in batch]
+            statistics_list = [(statistics, context, index_entries) for
+                               content_items, states, blender_config,
+                               statistics, context, index_entries in batch]
+            if self.processing_pool:
+                result = self.processing_pool.apply_async(process_responses,
+                                                          (work,))
+            else:
+                result = InlineResult(work)
+            # Blocks if all the workers are busy
+            self.results_queue.put((result, statistics_list))
+
+    def results_daemon(self):
+        """ Merges the processed batches back, in the order they were
+        submitted. The content items of a batch are added to the item index
+        once their triples and outlinks are spooled, so that they are
+        processed again if the API Crawler stops before. """
+        while True:
+            result, statistics_list = self.results_queue.get(True)
+            try:
+                processed_responses = result.get()
+            except Exception as e:
+                logger.error('Could not process a batch of %d responses, '
+                             'error: %s' % (len(statistics_list), e))
+                continue
+            batch_index_entries = []
+            for (_triples, _outlinks), (statistics, context,
+                                        index_entries) in \
+                    zip(processed_responses, statistics_list):
+                self.triples_handler.add_triples(_triples, context)
+                self.outlinks_handler.add_outlinks(_outlinks)
+                statistics['total_triples'] += len(_triples)
+                statistics['total_outlinks'] += len(_outlinks)
+                if index_entries:
+                    batch_index_entries.extend(index_entries)
+            if self.item_index:
+                try:
+                    self.item_index.add_entries(batch_index_entries)
+                except Exception as e:
+                    logger.error('Could not add %d items to the item index, '
+                                 'error: %s' % (len(batch_index_entries), e))
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the output modules' state """
+        return {
+                "processing_queue_size": self.processing_queue.qsize(),
+                "item_index": self.item_index and self.item_index.get_dict(),
+                "warcs": self.warcs_handler.get_dict(),
+                "triples": self.triples_handler.get_dict(),
+                "triple_index": self.triple_index and
+                                self.triple_index.get_dict(),
+                "triple_store": self.triple_store_loader and
+                                self.triple_store_loader.get_dict(),
+                "outlinks": self.outlinks_handler.get_dict()
+               }
 
     def get_content_items(self, response):
         """ Finds all the content items (e.g. a tweet) in the response """
@@ -63,55 +195,62 @@ class ResponsesHandler:
                 return []
         return content_items 
 
-    def add_content_item(self, content_item, blender_config, headers):
-        """ Handles a unique content item (e.g. a tweet) """
-        try:
-            str(content_item['id'])
-        except Exception:
-            try:
-                # Ad hoc add on for facebook users
-                # Not great, IDEA: find a way to improve that 
-                for key in content_item:
-                    content_item[key]['id']
-                    content_item = content_item[key]
-            except Exception:
-                logger.error('Processing the output, could not find an id'
-                             'for content item: %s' % (content_item))
-                return None
-        init_outlinks = set()
-        content_item_outlinks = list(self.extract_outlinks( content_item, 
-                                                            init_outlinks))
-        _clean_outlinks = set(self.clean_outlinks(content_item_outlinks))
-        all_outlinks, total_triples = \
-            self.triples_handler.add_content_item(   content_item, 
-                                                blender_config, 
-                                                _clean_outlinks )
-        self.outlinks_handler.add_outlinks(all_outlinks)
-        return len(all_outlinks), total_triples
-
-    def extract_outlinks(self, _content, outlinks):
-        """ Extracts all outlinks in the content """
-        if type(_content) is dict:
-            for key in _content.keys():
-                self.extract_outlinks(_content[key], outlinks)
-        elif type(_content) is list:
-            for item in _content:
-                self.extract_outlinks(item, outlinks)
-        else:
-            try:
-                str_content = str(_content) 
-            except Exception:
-                return outlinks
-            if re.match('https?://', str_content, re.I):
-                outlinks.add(str(_content))
-        return outlinks
-
-    def clean_outlinks(self, outlinks):
-        """ Cleans outlinks that have been extracted """
-        # IDEA: this could be improved, there are still bad outlinks after
-        # this step. Could also possibly filter some not very interesting outlinks.
-        for outlink in outlinks:
-            outlink = outlink.replace("&quot;",'')
-            outlink = outlink.replace('"','')
-            outlink = outlink.replace('\\','')
-        return outlinks
+
+class InlineResult:
+    """ Processes a batch in the calling thread, used when there are no
+    worker processes """
+    def __init__(self, work):
+        self.work = work
+
+    def get(self):
+        return process_responses(self.work)
+
+
+#
+#       The functions below are executed by the worker processes
+#
+
+def process_responses(work):
+    """ Makes the triples and outlinks of a batch of responses given as
+    (content_items, states, blender_config), returns a list of (triples,
+    outlinks). states are the item index states of the content items, None
+    if there is no item index. """
+    processed_responses = []
+    for content_items, states, blender_config in work:
+        if states is None:
+            states = [itemindex.NEW] * len(content_items)
+        response_triples, response_outlinks = [], []
+        for content_item, state in zip(content_items, states):
+            item_triples, item_outlinks = process_content_item(
+                                            content_item, blender_config,
+                                            state == itemindex.UPDATED)
+            response_triples.extend(item_triples)
+            response_outlinks.extend(item_outlinks)
+        processed_responses.append((response_triples, response_outlinks))
+    return processed_responses
+
+
+def process_content_item(content_item, blender_config, updated=False):
+    """ Handles a unique content item (e.g. a tweet), returns its triples and
+    outlinks. The triples of an updated item, one seen before with another
+    content, say when it was updated. """
+    item_id, content_item = itemindex.get_content_item_id(content_item)
+    if item_id is None:
+        logger.error('Processing the output, could not find an id'
+                     'for content item: %s' % (content_item))
+        return [], []
+    content_item_outlinks = outlinks.extract_outlinks(content_item)
+    _triples = []
+    new_outlinks = set()
+    try:
+        _triples, new_outlinks = triples.make_triples(content_item, 
+                                                      blender_config,
+                                                      content_item_outlinks)
+    except Exception as e:
+        logger.error('Could not convert %s, error: %s' % (content_item,e))
+    if updated and _triples:
+        # The first triples are the ones of the content item itself
+        _triples.append([_triples[0][0], 'update_date',
+                         datetime.datetime.now().isoformat()])
+    return _triples, list(content_item_outlinks.union(new_outlinks))
+
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import threading
+import datetime
+import logging
+
+"""
+This module schedules the spiders of a platform according to their start
+date.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+
+class SpiderScheduler:
+    """ Time-ordered queue of spiders: a heap keyed by start date, a
+    spider is only handed out once its start date is reached """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Heap entries are [start_date, count, spider], the count keeps the
+        # insertion order for identical start dates. A removed entry has
+        # its spider replaced by None and is skipped when popped.
+        self.start_heap = []
+        # Entries [end_date, count, start_heap_entry] used to drop expired
+        # spiders without walking the whole start heap
+        self.end_heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+
+    def put(self, spider):
+        """ Adds a spider and wakes up the consumer if needed """
+        with self.condition:
+            start_date = spider.start_date or datetime.datetime.now()
+            count = next(self.counter)
+            entry = [start_date, count, spider]
+            heapq.heappush(self.start_heap, entry)
+            if spider.end_date:
+                heapq.heappush(self.end_heap, [spider.end_date, count, entry])
+            self.entries[id(spider)] = entry
+            self.condition.notify()
+
+    def get(self):
+        """ Blocks until a waiting spider is due and returns it """
+        with self.condition:
+            while True:
+                now = datetime.datetime.now()
+                self.drop_expired(now)
+                self.drop_removed_head()
+                if not self.start_heap:
+                    # Sleeps until a new spider is added
+                    self.condition.wait()
+                    continue
+                # Else ..
+                entry = self.start_heap[0]
+                if entry[0] > now:
+                    # Sleeps until the next spider is due or a new spider is
+                    # added, whichever comes first
+                    self.condition.wait((entry[0] - now).total_seconds())
+                    continue
+                # Else ..
+                heapq.heappop(self.start_heap)
+                spider = entry[2]
+                self.discard_entry(entry)
+                # Stopped spiders are not processed
+                if not spider.status == 'waiting':
+                    continue
+                return spider
+
+    def remove(self, spider):
+        """ Removes a spider from the queue, returns False if it was not
+        queued """
+        with self.condition:
+            entry = self.entries.get(id(spider))
+            if not entry:
+                return False
+            # Else ..
+            self.discard_entry(entry)
+            return True
+
+    def discard_entry(self, entry):
+        """ Marks a heap entry as removed """
+        del self.entries[id(entry[2])]
+        entry[2] = None
+        # Compacts the end heap when it is mostly made of removed entries
+        if len(self.end_heap) > 2 * len(self.entries) + 64:
+            self.end_heap = [end_entry for end_entry in self.end_heap
+                             if end_entry[2][2] is not None]
+            heapq.heapify(self.end_heap)
+
+    def drop_expired(self, now):
+        """ Drops the spiders whose end date is passed, O(log n) each. A
+        waiting spider dropped is marked as expired, it will not run. """
+        while self.end_heap and self.end_heap[0][0] < now:
+            end_date, count, entry = heapq.heappop(self.end_heap)
+            spider = entry[2]
+            if spider is None:
+                continue
+            # Else ..
+            logger.info('[Expired spider] id: %s, end date: %s' %
+                        (id(spider), end_date))
+            if spider.status == 'waiting':
+                spider.status = 'expired'
+            self.discard_entry(entry)
+
+    def drop_removed_head(self):
+        """ Pops the removed entries from the top of the start heap """
+        while self.start_heap and self.start_heap[0][2] is None:
+            heapq.heappop(self.start_heap)
+
+    def qsize(self):
+        """ Returns the number of queued spiders """
+        with self.condition:
+            self.drop_expired(datetime.datetime.now())
+            return len(self.entries)
+
+    def next_due(self):
+        """ Returns the start date of the next queued spider or None """
+        with self.condition:
+            self.drop_expired(datetime.datetime.now())
+            self.drop_removed_head()
+            if not self.start_heap:
+                return None
+            return self.start_heap[0][0]
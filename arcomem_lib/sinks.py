@@ -0,0 +1,339 @@
+import logging
+import httplib
+import socket
+import random
+import time
+import threading
+import Queue
+from threading import Thread
+
+import config
+import spool
+
+"""
+This module is about delivering the outputs (outlinks, triples) to the
+downstream services over HTTP: keep-alive connections, retries with backoff,
+a circuit breaker and the re-delivery of the chunks that failed.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+
+class SinkError(Exception):
+    """ A chunk could not be delivered, undelivered is the part of the
+    chunk that has to be sent again if only a part of it failed """
+    def __init__(self, message, undelivered=None):
+        Exception.__init__(self, message)
+        self.undelivered = undelivered
+
+
+class CircuitOpenError(SinkError):
+    """ The sink is considered down, nothing is sent """
+    pass
+
+
+class RejectedError(SinkError):
+    """ The endpoint refused the chunk, e.g. a 400 on a bad request or a 413
+    on a body too big: sending it again would not help """
+    pass
+
+
+# 4xx statuses that are worth a retry: request timeout, too many requests
+RETRIED_CLIENT_ERRORS = set([408, 429])
+
+
+class ConnectionPool:
+    """ Keeps up to size keep-alive connections to a host """
+    def __init__(self, host, port, size, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle_connections = Queue.Queue()
+        self.semaphore = threading.Semaphore(size)
+
+    def get(self):
+        """ Returns an idle connection or a new one, waits if size
+        connections are in use """
+        self.semaphore.acquire()
+        try:
+            return self.idle_connections.get_nowait()
+        except Queue.Empty:
+            return httplib.HTTPConnection(self.host, self.port,
+                                          timeout=self.timeout)
+
+    def put(self, connection):
+        """ Gives back a connection that can be reused """
+        self.idle_connections.put(connection)
+        self.semaphore.release()
+
+    def discard(self, connection):
+        """ Closes a connection that failed """
+        try:
+            connection.close()
+        finally:
+            self.semaphore.release()
+
+
+class CircuitBreaker:
+    """ Opens after failure_threshold consecutive failures: nothing is sent
+    for reset_seconds, then a single attempt is let through (half open) and
+    its result closes or opens the circuit again """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+
+    def allow(self):
+        """ Returns True if an attempt can be made """
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+               time.time() - self.opened_at >= self.reset_seconds:
+                # Lets a single attempt through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def retry_in(self):
+        """ Returns how many seconds to wait before an attempt is allowed """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.opened_at + self.reset_seconds - time.time())
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info('[Circuit] Closed')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+               (self.state == self.CLOSED and
+                self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.times_opened += 1
+                logger.warning('[Circuit] Opened after %d failures' %
+                               self.failures)
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the breaker's state """
+        with self.lock:
+            return {
+                    "state": self.state,
+                    "consecutive_failures": self.failures,
+                    "times_opened": self.times_opened
+                   }
+
+
+class HTTPSink:
+    """ POSTs chunks to an HTTP endpoint on keep-alive connections, retries
+    with exponential backoff and jitter and stops trying while the circuit
+    is open """
+    def __init__(self, name, host, port, path,
+                 content_type='application/json', timeout=None,
+                 pool_size=None):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.path = path
+        self.headers = {'Content-Type': content_type}
+        self.connection_pool = ConnectionPool(host, port,
+                                              pool_size or
+                                              config.sink_pool_size,
+                                              timeout or config.sink_timeout)
+        self.circuit_breaker = CircuitBreaker(config.sink_failure_threshold,
+                                              config.sink_reset_seconds)
+        self.sent_chunks = 0
+        self.sent_bytes = 0
+        self.failed_attempts = 0
+        self.rejected_chunks = 0
+
+    def request(self, connection, body):
+        """ Sends the request, body is a string or a function returning the
+        pieces of the body, which is then streamed with the chunked transfer
+        encoding. Returns the size of the body. """
+        if not callable(body):
+            connection.request('POST', self.path, body=body,
+                               headers=self.headers)
+            return len(body)
+        # Else ..
+        connection.putrequest('POST', self.path, skip_accept_encoding=True)
+        for header, value in self.headers.iteritems():
+            connection.putheader(header, value)
+        connection.putheader('Transfer-Encoding', 'chunked')
+        connection.endheaders()
+        size = 0
+        for piece in body():
+            if piece:
+                connection.send('%x\r\n%s\r\n' % (len(piece), piece))
+                size += len(piece)
+        connection.send('0\r\n\r\n')
+        return size
+
+    def post(self, body):
+        """ Makes a single attempt, raises SinkError if it failed. Returns
+        the size of the body sent. """
+        connection = self.connection_pool.get()
+        # The connection is closed unless the response was read completely,
+        # whatever the error (e.g. one raised by the body's pieces)
+        reusable = False
+        try:
+            size = self.request(connection, body)
+            response = connection.getresponse()
+            # The response has to be read for the connection to be reused
+            response.read()
+            reusable = not response.will_close
+        except (httplib.HTTPException, socket.error) as e:
+            raise SinkError('%s: %s' % (self.name, e))
+        finally:
+            if reusable:
+                self.connection_pool.put(connection)
+            else:
+                self.connection_pool.discard(connection)
+        # Else ..
+        if 400 <= response.status < 500 and \
+           response.status not in RETRIED_CLIENT_ERRORS:
+            raise RejectedError('%s: rejected, status code %d' %
+                                (self.name, response.status))
+        if not 200 <= response.status < 300:
+            raise SinkError('%s: wrong status code %d' %
+                            (self.name, response.status))
+        return size
+
+    def get_backoff(self, attempt):
+        """ Returns the delay before a retry: exponential, with full jitter
+        so that the retries of several threads do not come together """
+        delay = min(config.sink_backoff_max,
+                    config.sink_backoff_base * 2 ** attempt)
+        return random.uniform(0, delay)
+
+    def send(self, body):
+        """ Sends a chunk, raises SinkError if it could not be delivered
+        after config.sink_retries retries, RejectedError right away if the
+        endpoint refused it. body is a string or a function returning the
+        pieces of the body, called again for each attempt. """
+        for attempt in range(0, config.sink_retries + 1):
+            if not self.circuit_breaker.allow():
+                raise CircuitOpenError('%s: circuit open' % self.name)
+            # Else ..
+            try:
+                size = self.post(body)
+            except RejectedError:
+                # The endpoint is up, the chunk is the problem
+                self.circuit_breaker.success()
+                self.rejected_chunks += 1
+                raise
+            except SinkError as e:
+                self.failed_attempts += 1
+                self.circuit_breaker.failure()
+                logger.warning('[Retry] Attempt %d failed, %s' %
+                               (attempt + 1, e))
+                if attempt < config.sink_retries:
+                    time.sleep(self.get_backoff(attempt))
+                continue
+            # Else ..
+            self.circuit_breaker.success()
+            self.sent_chunks += 1
+            self.sent_bytes += size
+            return
+        raise SinkError('%s: gave up after %d attempts' %
+                        (self.name, config.sink_retries + 1))
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the sink's state """
+        return {
+                "endpoint": 'http://%s:%s%s' % (self.host, self.port,
+                                                self.path),
+                "sent_chunks": self.sent_chunks,
+                "sent_bytes": self.sent_bytes,
+                "failed_attempts": self.failed_attempts,
+                "rejected_chunks": self.rejected_chunks,
+                "circuit": self.circuit_breaker.get_dict()
+               }
+
+
+class Redeliverer:
+    """ Spools the chunks that could not be delivered and sends them again
+    in background once the sink is back. The sink has a send(chunk) method
+    and a circuit_breaker, a chunk is anything marshal can write. """
+    def __init__(self, name, sink, maxsize=None):
+        self.sink = sink
+        self.maxsize = maxsize or config.redelivery_queue_size
+        self.redelivery_queue = spool.SpooledBatchQueue(
+                                    self.maxsize,
+                                    spool.Spool('%s.redelivery' % name))
+        self.redelivered_chunks = 0
+        self.start_daemon()
+
+    def start_daemon(self):
+        t = Thread(target=self.redelivery_daemon)
+        t.start()
+
+    def add(self, chunk):
+        """ Spools a chunk for re-delivery, returns False if there are
+        already maxsize chunks waiting """
+        if self.redelivery_queue.qsize() >= self.maxsize:
+            return False
+        # Else ..
+        self.redelivery_queue.put_many([chunk])
+        return True
+
+    def redelivery_daemon(self):
+        """ Sends the spooled chunks one at a time, in order """
+        while True:
+            chunk = self.redelivery_queue.get_many(1)[0]
+            while True:
+                # Does not try before the circuit lets an attempt through
+                time.sleep(max(config.redelivery_period,
+                               self.sink.circuit_breaker.retry_in()))
+                try:
+                    self.sink.send(chunk)
+                    break
+                except RejectedError as e:
+                    logger.error('[Redelivery] Dropped a chunk the sink '
+                                 'rejected: %s' % e)
+                    break
+                except SinkError as e:
+                    logger.info('[Redelivery] Failed, will try again: %s' % e)
+            self.redelivered_chunks += 1
+            self.redelivery_queue.acknowledge()
+            logger.info('[Redelivery] Sent a chunk to %s' % self.sink.name)
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the re-delivery state """
+        return {
+                "waiting_chunks": self.redelivery_queue.qsize(),
+                "redelivered_chunks": self.redelivered_chunks,
+                "spool": self.redelivery_queue.spool.get_dict()
+               }
+
+
+def iter_pieces(strings, piece_size=None):
+    """ Joins strings into pieces of about piece_size bytes, to stream a
+    body without building it whole """
+    piece_size = piece_size or config.sink_piece_size
+    buffered = []
+    size = 0
+    for string in strings:
+        buffered.append(string)
+        size += len(string)
+        if size >= piece_size:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+    if buffered:
+        yield ''.join(buffered)
@@ -3,11 +3,17 @@ import string
 import urlparse
 import json
 import datetime
+import collections
 
 import config
+import warcs
 
 logger = logging.getLogger('apicrawler')
 
+# Status of the spiders that will not run anymore: stopped by the user,
+# finished, or dropped by the scheduler once their end date was passed
+DONE_STATUSES = ('stopped', 'finished', 'expired')
+
 
 class Spider: 
     """ A spider executes a specific crawling strategy """
@@ -15,7 +21,13 @@ class Spider:
         self.statistics = {
             'total_responses': 0,
             'total_triples': 0,
-            'total_outlinks': 0
+            'total_outlinks': 0,
+            # Content items found, and the ones already processed before
+            # (duplicates) or changed since
+            'total_items': 0,
+            'duplicate_items': 0,
+            'updated_items': 0,
+            'duplicate_ratio': None
         }
         # Constituents
         self.start_date = start_date
@@ -27,20 +39,32 @@ class Spider:
         self.actual_start_date = None
         self.actual_end_date = None
         self.running_time = None
-        self.output_warc = None
+        # Filled by the WARC writers as the responses are written
+        self.output_warcs = warcs.SpiderWARCs()
+        # Set by the crawl, the WARC records carry them
+        self.crawl_id = None
+        self.campaign_id = None
+        # Set by the crawl, makes the next spider of a periodic crawl
+        self.crawl = None
         # Used to stop the run
         self.stop_now = False 
 
     def handle_response(self, response, responses_handler):
-        """ Handles a blender response """
+        """ Handles a blender response, returns the number of content items
+        found in it """
         if not response['successful_interaction']:
-            return
+            return 0
         # Else ..
-        total_outlinks, total_triples = \
-                responses_handler.add_response(response)
+        response['crawl_id'] = self.crawl_id
+        response['spider_id'] = id(self)
+        response['campaign_id'] = self.campaign_id
+        response['output_warcs'] = self.output_warcs
+        # The triples and outlinks are counted once they have been made by
+        # the responses handler
+        number_of_items = responses_handler.add_response(response,
+                                                         self.statistics)
         self.statistics['total_responses'] += 1
-        self.statistics['total_triples'] += total_triples
-        self.statistics['total_outlinks'] += total_outlinks
+        return number_of_items
 
  
     def wrapper_run(self, blender, responses_handler):
@@ -60,6 +84,56 @@ class Spider:
         """ Handled by subclasses """
         pass
 
+    def fetch_pages(self, blender, responses_handler, get_url_params,
+                    first_page=1, last_page=None):
+        """ Fetches and handles pages in order, from first_page to
+        last_page, stops at the first page not successful or empty.
+        get_url_params returns the url parameters of a page number. With the
+        'pool' engine, the next pages are prefetched concurrently. """
+        window = getattr(blender, 'window', 1)
+        if window < 2:
+            p = first_page
+            while not self.stop_now:
+                if last_page is not None and p > last_page:
+                    break
+                # Else ..
+                blender.set_url_params(get_url_params(p))
+                response = blender.blend()
+                if not self.handle_page(response, responses_handler):
+                    break
+                p += 1
+            return
+        # Else ..
+        # Keeps window pages in flight, the responses are handled in order
+        in_flight = collections.deque()
+        next_page = first_page
+        try:
+            while not self.stop_now:
+                while len(in_flight) < window and \
+                      (last_page is None or next_page <= last_page):
+                    in_flight.append(blender.submit(get_url_params(next_page)))
+                    next_page += 1
+                if not in_flight:
+                    break
+                # Else ..
+                response = in_flight.popleft().wait()
+                if not self.handle_page(response, responses_handler):
+                    break
+        finally:
+            # The pages not fetched yet are not needed anymore
+            for request in in_flight:
+                request.cancel()
+
+    def handle_page(self, response, responses_handler):
+        """ Handles the response of a page, returns False if there is no
+        need to fetch the next pages """
+        # Stops here if it was not successful
+        if not response['successful_interaction']:
+            return False
+        # Else ..
+        # An empty page is the last one
+        return self.handle_response(response, responses_handler) > 0
+
     def get_dict(self):
         """ Returns a dict that is easy to JSONify """
         if self.start_date:
@@ -90,7 +164,7 @@ class Spider:
                     "actual_start_date": actual_start_date_str,
                     "actual_end_date": actual_end_date_str
                 },
-                "output_warc": self.output_warc,
+                "output_warcs": self.output_warcs.get_list(),
                 "running time in seconds": self.running_time,
                 "statistics": self.statistics,
                 "status": self.status
@@ -183,29 +257,29 @@ class FlickrSearch(Spider):
     def run(self, blender, responses_handler):
         blender.load_server("flickr")
         blender.load_interaction("photos_search")
-        success = True
-        p = 0
-        pages = 1 
-        while p < pages and not self.stop_now: 
-            # Sets parameters and executes interaction
-            p += 1
-            blender.set_url_params({"tags": self.keywords_str, "page": p})
-            response = blender.blend()
-            # Stops here if it was not successful
-            if not response['successful_interaction']:
-                break
-            # Else..
-            # Handles response
-            self.handle_response(response, responses_handler)
-            # Finds number of pages available
-            # (we just need to do that once)
-            if p == 1:
-                try:
-                    pages = response['loaded_content']['photos']['pages']
-                except KeyError:
-                    logger.error('[FlickR]: Wrong response, check the API is\
-                    properly configured (is there an auth file?).')
-                    break
+        if self.stop_now:
+            return
+        # Else ..
+        # The first page gives the number of pages available
+        blender.set_url_params({"tags": self.keywords_str, "page": 1})
+        response = blender.blend()
+        # Stops here if it was not successful
+        if not response['successful_interaction']:
+            return
+        # Else..
+        # Handles response
+        self.handle_response(response, responses_handler)
+        try:
+            pages = response['loaded_content']['photos']['pages']
+        except KeyError:
+            logger.error('[FlickR]: Wrong response, check the API is\
+            properly configured (is there an auth file?).')
+            return
+        # Else ..
+        # The other pages are known in advance
+        self.fetch_pages(blender, responses_handler,
+                         lambda p: {"tags": self.keywords_str, "page": p},
+                         first_page=2, last_page=int(pages))
 
 class GooglePlusSearch(Spider):
     """ Searches among google plus activities """
@@ -247,21 +321,9 @@ class TwitterSearch(Spider):
     def run(self, blender, responses_handler):
         blender.load_server("twitter-search")
         blender.load_interaction("search")
-        success = True
-        p = 1
-        while success and not self.stop_now: 
-            # Sets parameters and executes interaction
-            blender.set_url_params({"q": self.keywords_str, "page": p})
-            response = blender.blend()
-            # Stops here if it was not successful
-            success = response['successful_interaction']
-            if not success:
-                break
-            # Else ..
-            # Handles response
-            self.handle_response(response, responses_handler)
-            # Increase page number
-            p += 1
+        # Goes through the pages until one is not successful
+        self.fetch_pages(blender, responses_handler,
+                         lambda p: {"q": self.keywords_str, "page": p})
 
 
 class YoutubeSearch(Spider):
@@ -273,22 +335,11 @@ class YoutubeSearch(Spider):
     def run(self, blender, responses_handler):
         blender.load_server("youtube")
         blender.load_interaction("search")
-        success = True
-        p = 1
-        while success and not self.stop_now: 
-            # Sets parameters and executes interaction
-            blender.set_url_params({"q": self.keywords_str, "start-index":\
-                (p-1)*50+1})
-            response = blender.blend()
-            # Stops here if it was not successful
-            success = response['successful_interaction']
-            if not response:
-                break
-            # Else ..
-            # Handles response
-            self.handle_response(response, responses_handler)
-            # Increase page number
-            p += 1
+        # Goes through the pages until one is not successful, 50 results
+        # per page
+        self.fetch_pages(blender, responses_handler,
+                         lambda p: {"q": self.keywords_str,
+                                    "start-index": (p-1)*50+1})
 
 #
 # IDEA : More classes could be added, e.g., 
@@ -0,0 +1,226 @@
+import logging
+import os
+import struct
+import zlib
+import marshal
+import collections
+import threading
+
+import config
+import batchqueue
+
+"""
+This module is about the write-ahead spool of the output modules: the
+triples and outlinks are written on disk before being queued, so that what
+has not been sent yet is replayed after a restart.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+# A record is its length and CRC32 followed by the data
+RECORD_HEADER = struct.Struct('>Ii')
+
+
+class Spool:
+    """ Segmented, append-only file of length-prefixed records. The
+    acknowledged position is checkpointed, the segments before it are
+    deleted. """
+    def __init__(self, name, path=None, segment_size=None, fsync=None):
+        self.name = name
+        self.path = path or config.spool_path
+        self.segment_size = segment_size or config.spool_segment_size
+        if fsync is None:
+            fsync = config.spool_fsync
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.checkpoint_file = os.path.join(self.path,
+                                            '%s.checkpoint' % self.name)
+        self.segment = None
+        self.segment_file = None
+
+    def get_segment_path(self, segment):
+        return os.path.join(self.path,
+                            '%s.%010d.spool' % (self.name, segment))
+
+    def list_segments(self):
+        """ Returns the numbers of the segments on disk, sorted """
+        segments = []
+        prefix = self.name + '.'
+        for file_name in os.listdir(self.path):
+            if file_name.startswith(prefix) and file_name.endswith('.spool'):
+                try:
+                    segments.append(int(file_name[len(prefix):-6]))
+                except ValueError:
+                    continue
+        return sorted(segments)
+
+    def read_checkpoint(self):
+        """ Returns the acknowledged position as (segment, offset) """
+        try:
+            with open(self.checkpoint_file) as _f:
+                segment, offset = _f.read().split()
+            return int(segment), int(offset)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def write_checkpoint(self, position):
+        """ Writes the acknowledged position atomically """
+        tmp_file = self.checkpoint_file + '.tmp'
+        with open(tmp_file, 'w') as _f:
+            _f.write('%d %d\n' % position)
+            if self.fsync:
+                _f.flush()
+                os.fsync(_f.fileno())
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def recover(self):
+        """ Starts a new segment containing only the records that were not
+        acknowledged, the old segments are deleted. Returns these records
+        as a list of (data, end position). """
+        with self.lock:
+            checkpoint_segment, checkpoint_offset = self.read_checkpoint()
+            old_segments = self.list_segments()
+            records = []
+            for segment in old_segments:
+                if segment < checkpoint_segment:
+                    continue
+                # Else ..
+                offset = 0
+                if segment == checkpoint_segment:
+                    offset = checkpoint_offset
+                records.extend(self.read_segment(segment, offset))
+            # Compaction: the records left are written in a new segment
+            self.segment = (old_segments[-1] + 1) if old_segments else 0
+            self.open_segment()
+            positions = []
+            for data in records:
+                self.write_record(data)
+                positions.append((self.segment, self.segment_file.tell()))
+            self.sync()
+            self.write_checkpoint((self.segment, 0))
+            for segment in old_segments:
+                os.remove(self.get_segment_path(segment))
+        if records:
+            logger.info('[Spool] %s: replaying %d records' %
+                        (self.name, len(records)))
+        return zip(records, positions)
+
+    def read_segment(self, segment, offset):
+        """ Returns the records of a segment from offset, stops at the
+        first truncated or corrupted record """
+        records = []
+        with open(self.get_segment_path(segment), 'rb') as _f:
+            _f.seek(offset)
+            while True:
+                header = _f.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                # Else ..
+                data = None
+                if len(header) == RECORD_HEADER.size:
+                    length, crc = RECORD_HEADER.unpack(header)
+                    data = _f.read(length)
+                    if len(data) != length or zlib.crc32(data) != crc:
+                        data = None
+                if data is None:
+                    logger.warning('[Spool] %s: truncated record in segment '
+                                   '%d, ignoring the end of the segment' %
+                                   (self.name, segment))
+                    break
+                # Else ..
+                records.append(data)
+        return records
+
+    def open_segment(self):
+        """ Opens the current segment for appending """
+        if self.segment_file:
+            self.segment_file.close()
+        self.segment_file = open(self.get_segment_path(self.segment), 'ab')
+
+    def write_record(self, data):
+        """ Writes a record in the current segment """
+        self.segment_file.write(RECORD_HEADER.pack(len(data),
+                                                   zlib.crc32(data)))
+        self.segment_file.write(data)
+
+    def sync(self):
+        """ Flushes the current segment to disk """
+        self.segment_file.flush()
+        if self.fsync:
+            os.fsync(self.segment_file.fileno())
+
+    def append(self, data):
+        """ Appends a record, returns its end position as (segment, offset)
+        """
+        with self.lock:
+            if self.segment_file.tell() >= self.segment_size:
+                self.segment += 1
+                self.open_segment()
+            self.write_record(data)
+            self.sync()
+            return self.segment, self.segment_file.tell()
+
+    def acknowledge(self, position):
+        """ Marks the records up to position as acknowledged, deletes the
+        segments that are entirely acknowledged """
+        with self.lock:
+            self.write_checkpoint(position)
+            for segment in self.list_segments():
+                if segment >= position[0]:
+                    break
+                # Else ..
+                os.remove(self.get_segment_path(segment))
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the spool's state """
+        segments = self.list_segments()
+        return {
+                "segments": len(segments),
+                "acknowledged": list(self.read_checkpoint())
+               }
+
+
+class SpooledBatchQueue(batchqueue.BatchQueue):
+    """ BatchQueue whose lists of items are written in a spool before being
+    queued. acknowledge() is called once the items got have been delivered,
+    the items not acknowledged are queued again after a restart. """
+    def __init__(self, maxsize, spool):
+        batchqueue.BatchQueue.__init__(self, maxsize)
+        self.spool = spool
+        self.put_lock = threading.Lock()
+        # (number of items put, spool position) at the end of each record
+        self.records = collections.deque()
+        self.items_put = 0
+        self.items_got = 0
+        # Replays the items that were not acknowledged, they are already
+        # in the spool
+        for data, position in self.spool.recover():
+            items = marshal.loads(data)
+            self.items.extend(items)
+            self.items_put += len(items)
+            self.records.append((self.items_put, position))
+
+    def put_many(self, items):
+        """ Writes a list of items in the spool and queues it """
+        if not items:
+            return
+        # Else ..
+        # The records must be in the same order as the queue
+        with self.put_lock:
+            position = self.spool.append(marshal.dumps(items))
+            self.items_put += len(items)
+            self.records.append((self.items_put, position))
+            batchqueue.BatchQueue.put_many(self, items)
+
+    def get_many(self, max_items, timeout=None):
+        items = batchqueue.BatchQueue.get_many(self, max_items, timeout)
+        self.items_got += len(items)
+        return items
+
+    def acknowledge(self):
+        """ Acknowledges all the items got so far """
+        position = None
+        while self.records and self.records[0][0] <= self.items_got:
+            position = self.records.popleft()[1]
+        if position:
+            self.spool.acknowledge(position)
@@ -0,0 +1,150 @@
+import logging
+import sqlite3
+import json
+import threading
+import time
+
+import config
+import triples
+
+"""
+This module is about querying the triples made so far, e.g. the posts
+mentioning a user or the outlinks of a campaign, without going through the
+triples files: the triples are also written in an SQLite file with an index
+by subject, by predicate and object, by object and by campaign.
+"""
+
+logger = logging.getLogger('apicrawler')
+
+# Columns of the triples table, in the order of the results
+COLUMNS = ['subject', 'predicate', 'object', 'crawl_id', 'campaign_id']
+
+
+def get_stored_value(value):
+    """ Returns an object, crawl id or campaign id as stored in the index:
+    strings as they are, the other values as JSON so that they can be
+    looked up as strings too (e.g. from the Web interface) """
+    if value is None or isinstance(value, basestring):
+        return value
+    # Else ..
+    return json.dumps(value)
+
+
+class TripleIndex:
+    """ Disk-backed index of the triples and their crawl and campaign. The
+    triples are added by chunks, in a single transaction, and the lookups
+    are made on a connection of their own so that they do not wait for the
+    chunks being added. """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.write_connection = self.connect()
+        self.write_connection.executescript('''
+            CREATE TABLE IF NOT EXISTS triples (subject TEXT,
+                predicate INTEGER, object TEXT, crawl_id, campaign_id);
+            CREATE UNIQUE INDEX IF NOT EXISTS spo ON triples
+                (subject, predicate, object, crawl_id);
+            CREATE INDEX IF NOT EXISTS pos ON triples
+                (predicate, object, subject);
+            CREATE INDEX IF NOT EXISTS osp ON triples
+                (object, subject, predicate);
+            CREATE INDEX IF NOT EXISTS campaign ON triples
+                (campaign_id, predicate);
+        ''')
+        self.write_connection.commit()
+        self.read_connection = self.connect()
+        self.indexed_triples = 0
+        self.indexing_seconds = 0
+        self.queries = 0
+        self.query_seconds = 0
+
+    def connect(self):
+        connection = sqlite3.connect(self.file_path,
+                                     check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        # A negative size is in KiB
+        connection.execute('PRAGMA cache_size=-%d' %
+                           config.triple_index_cache_kb)
+        return connection
+
+    def iter_rows(self, chunk):
+        """ Yields the rows of a chunk (a TripleBatch), straight from its
+        columns """
+        subjects = [json.loads(subject) for subject in chunk.subjects]
+        contexts = [(get_stored_value(crawl_id),
+                     get_stored_value(campaign_id))
+                    for crawl_id, campaign_id in chunk.contexts]
+        context_column = chunk.context_column
+        subject_column, predicate_column = chunk.subject_column, \
+                                           chunk.predicate_column
+        object_ends, object_buffer = chunk.object_ends, chunk.object_buffer
+        start = 0
+        for i in xrange(0, len(predicate_column)):
+            end = object_ends[i]
+            crawl_id, campaign_id = contexts[context_column[i]]
+            _object = json.loads(str(object_buffer[start:end]))
+            yield (subjects[subject_column[i]], predicate_column[i],
+                   get_stored_value(_object), crawl_id, campaign_id)
+            start = end
+
+    def add_chunk(self, chunk):
+        """ Indexes the triples of a chunk, the triples already indexed for
+        the same crawl are ignored """
+        start = time.time()
+        with self.write_lock:
+            self.write_connection.executemany('INSERT OR IGNORE INTO triples '
+                                              'VALUES (?, ?, ?, ?, ?)',
+                                              self.iter_rows(chunk))
+            self.write_connection.commit()
+            self.indexed_triples += len(chunk)
+            self.indexing_seconds += time.time() - start
+
+    def find(self, subject=None, predicate=None, _object=None,
+             crawl_id=None, campaign_id=None, limit=None, offset=0):
+        """ Returns the triples matching all the criteria given as
+        [subject, predicate, object, crawl id, campaign id], at most limit
+        (and config.triple_index_max_results) of them from offset """
+        limit = min(limit or config.triple_index_max_results,
+                    config.triple_index_max_results)
+        if predicate is not None:
+            if predicate not in triples.PREDICATE_CODES:
+                return []
+            # Else ..
+            predicate = triples.PREDICATE_CODES[predicate]
+        conditions, values = [], []
+        for column, value in zip(COLUMNS, [subject, predicate,
+                                           get_stored_value(_object),
+                                           get_stored_value(crawl_id),
+                                           get_stored_value(campaign_id)]):
+            if value is not None:
+                conditions.append('%s = ?' % column)
+                values.append(value)
+        query = 'SELECT %s FROM triples' % ', '.join(COLUMNS)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' LIMIT ? OFFSET ?'
+        start = time.time()
+        with self.read_lock:
+            rows = self.read_connection.execute(query, values +
+                                                [limit, offset]).fetchall()
+            self.queries += 1
+            self.query_seconds += time.time() - start
+        return [[row[0], triples.PREDICATES[row[1]]] + list(row[2:])
+                for row in rows]
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the index's state """
+        indexing_rate, query_time = None, None
+        if self.indexing_seconds:
+            indexing_rate = self.indexed_triples / self.indexing_seconds
+        if self.queries:
+            query_time = self.query_seconds / self.queries
+        return {
+                "file": self.file_path,
+                "indexed_triples": self.indexed_triples,
+                "indexing_rate": indexing_rate,
+                "queries": self.queries,
+                "average_query_seconds": query_time
+               }
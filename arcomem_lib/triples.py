@@ -1,23 +1,41 @@
 import logging
-import Queue
 from threading import Thread
 import datetime
 import os
 import json
 import time
+import re
+import array
+import struct
+import zlib
+import urllib
 
 import config
+import batchqueue
+import spool
 
 logger = logging.getLogger('triples')
 
 
 class TripleManager:
-    """ Makes and handles triples """
-    def __init__(self):
-        self.triples_queue = Queue.Queue()
+    """ Makes and handles triples: the chunks of triples are written in the
+    triples files, see loader.py for their loading in the triple store. The
+    chunks are also added to triple_index if there is one. """
+    def __init__(self, triple_index=None):
+        # The triples are spooled on disk until they have been written
+        self.triples_queue = spool.SpooledBatchQueue(
+                                config.triples_queue_size,
+                                spool.Spool('triples'))
+        self.flush_policy = batchqueue.FlushPolicy(
+                                config.triples_chunk_size,
+                                config.triples_flush_seconds,
+                                config.triples_flush_bytes)
+        self.triple_index = triple_index
+        # Chunks that could not be added to the index
+        self.index_errors = 0
+        self.set_new_file()
         self.start_daemon()
         logger.info('Triples Manager started')
-        self.set_new_file()
         self.chunk_counter = 0
 
     def start_daemon(self):
@@ -25,270 +43,559 @@ class TripleManager:
         triples_daemon_thread.start() 
 
     def triples_daemon(self): 
-        """ Looks into the triples queue and sends chunks to the triple
-        store or saves it into the backup file if it failed """
+        """ Looks into the triples queue and writes chunks in the triples
+        file """
         while True:
-            chunk = []
-            chunk_size=config.triples_chunk_size
-            save_backup = False
-            while len(chunk) < chunk_size:
-                # Waits for the chunk to be full
-                chunk.append(self.triples_queue.get(True))
-            logger.info('[In progress] Sending %s triples to the triple store' 
-                        % chunk_size)
+            chunk = TripleBatch()
+            # Waits for the chunk to be full, big or old enough
+            while not self.flush_policy.is_due():
+                triples = self.triples_queue.get_many(
+                                self.flush_policy.items_needed(),
+                                self.flush_policy.timeout())
+                self.flush_policy.add(len(triples), chunk.extend(triples))
+            chunk_size = len(chunk)
+            latency = self.flush_policy.flushed()
+            # Creates a new file if the current one is too big
             try:
-                # TODO: use put_triples method provided by Nikos
-                raise NotImplementedError, 'waiting for Nikos' 
-                logger.info('[Success] Sent %s triples to the triple store' 
-                            % chunk_size)
-            except Exception as e:
-                logger.warning('[Failure] Exception occured during an '
-                               'attempt to send the triples: %s' % e)
-                save_backup = True
-            # Writes non transferred triples in a backup file
-            if save_backup:
-                #
-                # IDEA: there could be a retry mecanism for non transferred
-                # triples
-                #
-                # Creates a new backup file if the current one is too big
+                size = os.path.getsize(self.current_file)
+            except OSError:
+                size = 0
+            if size > 500 * 1024 * 1024:
+                self.set_new_file()
+            logger.info('[In progress] Saving %s triples to the triples '
+                        'file, flush latency: %.1f s' % (chunk_size, latency))
+            with open(self.current_file, 'ab') as _f:
+                write_backup(_f, chunk, time.time())
+            logger.info('[Success] Saved triples to the triples file')
+            # The chunk is on disk, it does not need to be replayed
+            self.triples_queue.acknowledge()
+            if self.triple_index:
+                # The index is only for the lookups, its failures must not
+                # stop the triples files
                 try:
-                    size = os.path.getsize(self.current_file)
-                except OSError:
-                    size = 0
-                if size > 500 * 1024 * 1024:
-                    self.set_new_file()
-                logger.info('[In progress] Saving triples to backup file' )
-                with open(self.current_file, 'a') as _f:
-                    _f.write( ' ** Backup **\nDate: ' + \
-                    datetime.datetime.now().strftime(config.datetime_format)\
-                    + '\n')
-                    for triple in chunk:
-                        _f.write(json.dumps(triple) + '\n')
-                logger.info('[Success] Saved triples to backup file')
+                    self.triple_index.add_chunk(chunk)
+                except Exception as e:
+                    self.index_errors += 1
+                    logger.error('Could not index %d triples, error: %s' %
+                                 (chunk_size, e))
 
     def set_new_file(self):
-        """ Changes the backup file """
+        """ Changes the triples file """
         file_name = \
             datetime.datetime.now().strftime(config.datetime_format) \
-            + '.txt'
+            + '.triples'
         self.current_file = os.path.join(config.triples_path, file_name)
-        logger.info('Backup file: %s' 
+        logger.info('Triples file: %s' 
                      % self.current_file) 
    
-    def add_content_item(self, content_item, blender_config, outlinks):
-        """ Makes triples from a content_item and adds them to the queue """
-        triples = []
-        new_outlinks = set()
-        try:
-            triples, new_outlinks = \
-                    self.make_triples(content_item, blender_config, outlinks)
-        except Exception as e:
-            logger.error('Could not convert %s, error: %s'
-                         % (content_item,e))
+    def add_triples(self, triples, context=None):
+        """ Adds triples to the queue, context is the (crawl id, campaign
+        id) they come from """
+        if context:
+            # The triples become [subject, predicate, object, crawl id,
+            # campaign id]
+            for triple in triples:
+                triple.extend(context)
+        self.triples_queue.put_many(triples)
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the manager's state """
+        return {
+                "queue_size": self.triples_queue.qsize(),
+                "flush": self.flush_policy.get_dict(),
+                "spool": self.triples_queue.spool.get_dict(),
+                "index_errors": self.index_errors
+               }
+
+
+#
+#       Compact representation of the triples
+#
+
+# Predicates of the triples, a predicate is stored as its position in the
+# list so new predicates go at the end
+PREDICATES = ['api', 'type', 'id', 'url', 'title', 'content', 'language',
+              'publication_date', 'location', 'outlink', 'from_user',
+              'to_user', 'name', 'nickname', 'picture_url', 'has_post',
+              'is_mentioned_by', 'update_date']
+PREDICATE_CODES = dict([(predicate, code) for code, predicate in 
+                        enumerate(PREDICATES)])
+PREDICATES_JSON = [json.dumps(predicate) for predicate in PREDICATES]
+
+# Context of the triples whose crawl is not known
+NO_CONTEXT = (None, None)
+
+
+class TripleBatch:
+    """ Column-wise batch of triples: each subject is stored once, the
+    predicates are small integers and the objects are stored as JSON in a
+    single buffer. The (crawl id, campaign id) context of the triples is
+    kept the same way as the subjects. """
+    def __init__(self):
+        # Subjects as JSON, by code, and codes by subject
+        self.subjects = []
+        self.subject_codes = {}
+        # Contexts by code, and codes by context
+        self.contexts = []
+        self.context_codes = {}
+        # One entry per triple
+        self.subject_column = array.array('I')
+        self.predicate_column = array.array('B')
+        self.context_column = array.array('I')
+        # End of each object in the buffer
+        self.object_ends = array.array('I')
+        self.object_buffer = bytearray()
+
+    def __len__(self):
+        return len(self.predicate_column)
+
+    def append(self, triple):
+        """ Adds a [subject, predicate, object] triple, optionally followed
+        by its crawl id and campaign id """
+        subject, predicate, _object = triple[0], triple[1], triple[2]
+        context = NO_CONTEXT
+        if len(triple) > 3:
+            context = (triple[3], triple[4])
+        context_code = self.context_codes.get(context)
+        if context_code is None:
+            context_code = len(self.contexts)
+            self.context_codes[context] = context_code
+            self.contexts.append(context)
+        self.context_column.append(context_code)
+        subject_code = self.subject_codes.get(subject)
+        if subject_code is None:
+            subject_code = len(self.subjects)
+            self.subject_codes[subject] = subject_code
+            self.subjects.append(json.dumps(subject))
+        self.subject_column.append(subject_code)
+        self.predicate_column.append(PREDICATE_CODES[predicate])
+        self.object_buffer.extend(json.dumps(_object))
+        self.object_ends.append(len(self.object_buffer))
+
+    def extend(self, triples):
+        """ Adds a list of triples, returns the number of bytes added """
+        nbytes = self.nbytes()
+        for triple in triples:
+            self.append(triple)
+        return self.nbytes() - nbytes
+
+    def nbytes(self):
+        """ Returns the size of the columns and of the objects buffer """
+        return len(self.object_buffer) + 13 * len(self.predicate_column)
+
+    def iter_json(self):
+        """ Yields the triples as JSON lists, straight from the columns """
+        subjects, subject_column = self.subjects, self.subject_column
+        predicate_column, object_ends = self.predicate_column, \
+                                        self.object_ends
+        object_buffer = self.object_buffer
+        start = 0
+        for i in xrange(0, len(predicate_column)):
+            end = object_ends[i]
+            yield '[%s, %s, %s]' % (subjects[subject_column[i]],
+                                    PREDICATES_JSON[predicate_column[i]],
+                                    object_buffer[start:end])
+            start = end
+
+    def iter_triples(self):
+        """ Yields the triples as [subject, predicate, object] """
+        for triple_json in self.iter_json():
+            yield json.loads(triple_json)
+
+    def get_json_by_context(self):
+        """ Returns the triples as JSON lists grouped by context, as a dict
+        of (crawl id, campaign id): list of JSON lists """
+        contexts, context_column = self.contexts, self.context_column
+        json_by_context = {}
+        for i, triple_json in enumerate(self.iter_json()):
+            context = contexts[context_column[i]]
+            if context not in json_by_context:
+                json_by_context[context] = []
+            json_by_context[context].append(triple_json)
+        return json_by_context
+
+
+#
+#       Triples files: a triples file is a series of blocks, each one holding
+#       up to triples_block_size triples of a same crawl, compressed. They
+#       are sent to the triple store block by block.
+#
+
+BACKUP_MAGIC = 'ATB1'
+# Magic, time of the chunk, number of triples, length of the metadata,
+# length of the compressed triples and their CRC32. The metadata is a JSON
+# dict with the crawl id and campaign id, the triples a JSON list of lists.
+BACKUP_BLOCK_HEADER = struct.Struct('>4sdIIIi')
+
+
+def write_backup(_file, chunk, chunk_time):
+    """ Writes a chunk (a TripleBatch) as blocks, by context """
+    block_size = config.triples_block_size
+    for (crawl_id, campaign_id), triples_json in \
+            chunk.get_json_by_context().iteritems():
+        metadata = json.dumps({"crawl_id": crawl_id,
+                               "campaign_id": campaign_id})
+        for start in xrange(0, len(triples_json), block_size):
+            block_json = triples_json[start:start + block_size]
+            data = zlib.compress('[%s]' % ',\n'.join(block_json),
+                                 config.triples_backup_compression_level)
+            _file.write(BACKUP_BLOCK_HEADER.pack(BACKUP_MAGIC, chunk_time,
+                                                 len(block_json),
+                                                 len(metadata), len(data),
+                                                 zlib.crc32(data)))
+            _file.write(metadata)
+            _file.write(data)
+
+
+def read_backup_block(_file):
+    """ Reads the block at the current position of a triples file, returns
+    (header, triples): header is a dict with the time, crawl_id,
+    campaign_id and number of triples, the triples a list of [subject,
+    predicate, object]. Returns None at the end of the file, raises
+    ValueError if the block is incomplete or corrupted. """
+    header = _file.read(BACKUP_BLOCK_HEADER.size)
+    if not header:
+        return None
+    # Else ..
+    if len(header) != BACKUP_BLOCK_HEADER.size:
+        raise ValueError('incomplete block')
+    # Else ..
+    magic, chunk_time, number_of_triples, metadata_length, \
+        data_length, crc = BACKUP_BLOCK_HEADER.unpack(header)
+    if magic != BACKUP_MAGIC:
+        raise ValueError('not a block')
+    # Else ..
+    metadata = _file.read(metadata_length)
+    data = _file.read(data_length)
+    if len(data) != data_length:
+        raise ValueError('incomplete block')
+    if zlib.crc32(data) != crc:
+        raise ValueError('corrupted block')
+    # Else ..
+    block_header = json.loads(metadata)
+    block_header['time'] = chunk_time
+    block_header['triples'] = number_of_triples
+    return block_header, json.loads(zlib.decompress(data))
+
+
+def iter_backup_blocks(file_path):
+    """ Yields the blocks of a triples file as (header, triples), see
+    read_backup_block. Stops at a truncated or corrupted block. """
+    with open(file_path, 'rb') as _f:
+        while True:
+            try:
+                block = read_backup_block(_f)
+            except ValueError as e:
+                logger.warning('Stopped reading %s: %s' % (file_path, e))
+                return
+            if block is None:
+                return
+            # Else ..
+            yield block
+
+
+def iter_backup_quads(file_path):
+    """ Yields the triples of a triples file as [subject, predicate, object,
+    crawl id, campaign id] """
+    for block_header, triples in iter_backup_blocks(file_path):
+        context = [block_header['crawl_id'], block_header['campaign_id']]
         for triple in triples:
-            self.triples_queue.put(triple)
-        return outlinks.union(new_outlinks), self.triples_queue.qsize()
-        
-
-    #
-    # IDEAs: 
-    # This part could be arranged with separated methods
-    # triples could be marked with a datetime
-    # (has to be discussed with the triple consumers)
-    # harmonize publication_date (raw pub date et harm pub date)
-    # harmonize location (raw location et harm location)
-    # harmonize language (raw location et harm location)
-    #
-    def make_triples(self, content_item, blender_config, outlinks):
-        """ Makes harmonized triples """
+            triple.extend(context)
+            yield triple
+
+
+#
+#       RDF export of the triples, as N-Triples or N-Quads
+#
+
+# Predicates whose objects are subjects of other triples, or URLs
+ENTITY_PREDICATES = set(['from_user', 'to_user', 'has_post',
+                         'is_mentioned_by'])
+URL_PREDICATES = set(['url', 'outlink', 'picture_url'])
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+# Characters left as they are in the IRIs
+IRI_SAFE_CHARACTERS = "!#$%&'()*+,-./:;=?@[]_~"
+
+
+def to_utf8(string):
+    if isinstance(string, unicode):
+        return string.encode('utf-8')
+    return string
+
+
+def get_iri(value):
+    return '<%s>' % urllib.quote(to_utf8(value), IRI_SAFE_CHARACTERS)
+
+
+def get_literal(value):
+    """ Returns a value as an RDF literal, typed if it is not a string """
+    if isinstance(value, bool):
+        return '"%s"^^<%sboolean>' % (str(value).lower(), XSD)
+    elif isinstance(value, (int, long)):
+        return '"%d"^^<%sinteger>' % (value, XSD)
+    elif isinstance(value, float):
+        return '"%r"^^<%sdouble>' % (value, XSD)
+    elif not isinstance(value, basestring):
+        value = json.dumps(value)
+    value = to_utf8(value).replace('\\', '\\\\').replace('"', '\\"') \
+                          .replace('\n', '\\n').replace('\r', '\\r')
+    return '"%s"' % value
+
+
+def get_rdf_terms(triple):
+    """ Returns the subject, predicate and object of a triple as RDF terms,
+    None if the triple has no object """
+    subject, predicate, _object = triple[0], triple[1], triple[2]
+    if _object is None:
+        return None
+    # Else ..
+    if predicate in ENTITY_PREDICATES:
+        object_term = get_iri(config.triples_base_uri + _object)
+    elif predicate in URL_PREDICATES:
+        object_term = get_iri(_object)
+    else:
+        object_term = get_literal(_object)
+    return (get_iri(config.triples_base_uri + subject),
+            get_iri(config.triples_predicate_uri + predicate), object_term)
+
+
+def get_context_graph(crawl_id, campaign_id):
+    """ Returns the named graph of the triples of a crawl and campaign, None
+    if the crawl or campaign is not known """
+    if config.triples_graph_by == 'crawl':
+        graph_id = crawl_id
+    else:
+        graph_id = campaign_id
+    if graph_id is None:
+        return None
+    # Else ..
+    return get_iri('%s%s/%s' % (config.triples_base_uri,
+                                config.triples_graph_by, graph_id))
+
+
+def get_graph(quad):
+    """ Returns the named graph of a [subject, predicate, object, crawl id,
+    campaign id] quad, see get_context_graph """
+    return get_context_graph(quad[3], quad[4])
+
+
+def write_ntriples(triples, _file):
+    """ Writes triples as N-Triples """
+    for triple in triples:
+        terms = get_rdf_terms(triple)
+        if terms:
+            _file.write('%s %s %s .\n' % terms)
+
+
+def write_nquads(quads, _file):
+    """ Writes [subject, predicate, object, crawl id, campaign id] quads as
+    N-Quads, in the graph of their crawl or campaign """
+    for quad in quads:
+        terms = get_rdf_terms(quad)
+        if not terms:
+            continue
+        # Else ..
+        graph = len(quad) > 3 and get_graph(quad)
+        if graph:
+            _file.write('%s %s %s %s .\n' % (terms + (graph,)))
+        else:
+            _file.write('%s %s %s .\n' % terms)
+
+
+#
+#       Mapping of the content items to triples, see triple_mappings in
+#       config.py. The mappings are compiled once into extractor functions.
+#
+# IDEAs: 
+# triples could be marked with a datetime
+# (has to be discussed with the triple consumers)
+# harmonize publication_date (raw pub date et harm pub date)
+# harmonize location (raw location et harm location)
+# harmonize language (raw location et harm location)
+#
+
+# Predicates of posts and users, in the order of the triples
+POST_PREDICATES = ['id', 'url', 'title', 'content', 'language',
+                   'publication_date', 'location']
+USER_PREDICATES = ['id', 'url', 'name', 'nickname', 'picture_url',
+                   'location']
+
+# Filters that can follow a path, e.g. 'id.$t|last_segment'
+FILTERS = {
+    'last_segment': lambda value: value.split('/')[-1]
+}
+
+TEMPLATE_FIELD = re.compile(r'\{([^}]+)\}')
+
+
+def compile_path(path):
+    """ Returns a function getting the value at path in a content item, or
+    '' if there is none """
+    path, _, filter_name = path.partition('|')
+    keys = [int(key) if key.isdigit() else key for key in path.split('.')]
+    _filter = FILTERS[filter_name] if filter_name else None
+    if len(keys) == 1 and not _filter:
+        key = keys[0]
+        def get_value(content_item):
+            try:
+                value = content_item[key]
+            except (KeyError, IndexError, TypeError):
+                return ''
+            if value is None:
+                return ''
+            return value
+        return get_value
+    # Else ..
+    def get_value(content_item):
+        value = content_item
+        try:
+            for key in keys:
+                value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return ''
+        if value is None:
+            return ''
+        if _filter:
+            return _filter(value)
+        return value
+    return get_value
+
+
+def compile_field(field):
+    """ Returns a function getting the value of a field, see config.py """
+    if type(field) is list:
+        getters = [compile_field(_field) for _field in field]
+        def get_first_value(content_item):
+            for getter in getters:
+                value = getter(content_item)
+                if value:
+                    return value
+            return ''
+        return get_first_value
+    # Else ..
+    if '{' not in field:
+        return compile_path(field)
+    # Else ..
+    getters = [compile_path(path) for path in TEMPLATE_FIELD.findall(field)]
+    template = TEMPLATE_FIELD.sub('%s', field.replace('%', '%%'))
+    def get_template_value(content_item):
+        values = tuple([getter(content_item) for getter in getters])
+        if '' in values:
+            return ''
+        return template % values
+    return get_template_value
+
+
+def compile_entity(api, entity_type, fields, predicates):
+    """ Returns a function making (subject, triples) for a post or a user,
+    (None, []) if the entity has no id. Triples with an empty object are
+    left out and the urls are added to new_outlinks. """
+    subject_prefix = '%s/%s/' % (api, entity_type)
+    get_id = compile_field(fields['id'])
+    getters = [(predicate, compile_field(fields[predicate])) for predicate in
+               predicates if predicate in fields]
+    def make_entity(content_item, new_outlinks):
+        _id = get_id(content_item)
+        if _id == '':
+            return None, []
+        # Else ..
+        subject = '%s%s' % (subject_prefix, _id)
+        triples = [[subject, 'api', api], [subject, 'type', entity_type]]
+        for predicate, getter in getters:
+            value = getter(content_item)
+            if value:
+                triples.append([subject, predicate, value])
+                if predicate == 'url':
+                    new_outlinks.add(value)
+        return subject, triples
+    return make_entity
+
+
+def compile_mapping(mapping):
+    """ Returns a function making the triples and new outlinks of a content
+    item from a mapping, see config.py """
+    api = mapping['api']
+    make_post, make_from_user = None, None
+    if 'post' in mapping:
+        make_post = compile_entity(api, 'post', mapping['post'],
+                                   POST_PREDICATES)
+    if 'from_user' in mapping:
+        make_from_user = compile_entity(api, 'user', mapping['from_user'],
+                                        USER_PREDICATES)
+    to_users = [(compile_path(path), compile_entity(api, 'user', fields,
+                                                    USER_PREDICATES))
+                for path, fields in mapping.get('to_users', [])]
+
+    def make_triples(content_item, outlinks):
         triples = []
-        api = '' 
-        post = ['' for i in range(8)]
-        from_user_subject = ''
-        to_user_subjects = []
-        users = []
-        from_user = ['' for i in range(7)]
-        #flickr
-        if  (blender_config['server'], blender_config['interaction']) \
-            == ('flickr', 'photos_search'):
-            api = 'flickr'
-            #post
-            post[0] = 'flickr/post/'  + str(content_item['id'])
-            post[1] = content_item['id']
-            post[2] = 'http://www.flickr.com/%s/%s' % \
-                    (content_item['owner'], content_item['id'])
-            post[3] = content_item['title']
-            #user
-            from_user[0] = 'flickr/user/' + str(content_item['owner'])
-            from_user_subject = from_user[0]
-            from_user[1] = content_item['owner']
-            from_user[2] = 'http://www.flickr.com/%s' % (from_user[1])
-        #twitter
-        if  (blender_config['server'], blender_config['interaction']) \
-            == ('twitter-search', 'search'):
-            api = 'twitter'
-            #post
-            post[0] = 'twitter/post/'  + str(content_item['id'])
-            post[1] = content_item['id']
-            post[2] = 'http://twitter.com/%s/status/%s' % \
-                    (content_item['from_user'], content_item['id'])
-            post[4] = content_item['text']
-            post[5] = content_item['iso_language_code']
-            post[6] = content_item['created_at']
-            post[7] = content_item.get('geo', '')
-            #from user
-            from_user[0] = 'twitter/user/' + str(content_item['from_user_id'])
-            from_user[1] = content_item['from_user_id']
-            from_user[2] =  'http://twitter.com/%s/' % \
-                            (content_item['from_user'])
-            from_user[3] = content_item['from_user_name']
-            from_user[4] = content_item['from_user']
-            from_user[5] = content_item['profile_image_url']
-            #to users
-            entities = content_item.get('entities', {})
-            for item in entities.get('user_mentions', [{}]):
-                if not item:
-                    continue
-                to_user = ['' for i in range(7)]
-                to_user[0] = 'twitter/user/' + str(item['id'])
-                to_user_subjects.append(to_user[0]) 
-                to_user[1] = item['id']
-                to_user[2] = 'http://twitter.com/%s' % (item['screen_name'])
-                to_user[3] = item['name']
-                to_user[4] = item['screen_name']
-                users.append( to_user )
-        if  (blender_config['server'], blender_config['interaction']) \
-            == ('facebook', 'users'):
-                user = ['' for i in range(7)]
-                user[0] = 'facebook/user/'  + str(content_item['id'])
-                user[1] = content_item['id']
-                user[2] = 'http://www.facebook.com/%s' % (content_item['id'])
-                user[3] = content_item['name']
-                user[4] = content_item['username']
-                if content_item.get('location',''):
-                    user[6] = content_item['location']
-                users.append(user)
-        if  (blender_config['server'], blender_config['interaction']) \
-            == ('facebook', 'search'):
-            api = 'facebook'
-            #post
-            post[0] = 'facebook/post/'  + str(content_item['id'])
-            post[1] = content_item['id']
-            post[2] = 'http://www.facebook.com/%s' % \
-                    (content_item['id'])
-            if content_item.get('name',''):
-                post[3] = content_item['name']
-            if content_item.get('message',''):
-                post[4] = content_item['message']
-            if content_item.get('caption',''):
-                post[4] = content_item['caption']
-            post[6] = content_item['updated_time']
-            #from user
-            from_user[0] = 'facebook/user/' + str(content_item['from']['id'])
-            from_user[1] = content_item['from']['id']
-            from_user[2] = 'http://www.facebook.com/%s' % \
-                    (content_item['from']['id'])
-            from_user[3] = content_item['from']['name']
-            #to users
-            if 'likes' in content_item.keys():
-                for item in content_item['likes']['data']:
-                    to_user = ['' for i in range(7)]
-                    to_user[0] = 'facebook/user/' + str(item['id'])
-                    to_user_subjects.append(to_user[0]) 
-                    to_user[1] = item['id']
-                    to_user[2] = 'http://www.facebook.com/%s' % (item['id'])
-                    to_user[3] = item['name']
-                    users.append(to_user)
-            if 'to' in content_item.keys():
-                for item in content_item['to']['data']:
-                    to_user = ['' for i in range(7)]
-                    to_user[0] = 'facebook/user/' + str(item['id'])
-                    to_user_subjects.append(to_user[0]) 
-                    to_user[1] = item['id']
-                    to_user[2] = 'http://www.facebook.com/%s' % (item['id'])
-                    to_user[3] = item['name']
-                    users.append(to_user)
-        if  (blender_config['server'], blender_config['interaction']) \
-            == ('google_plus', 'activities_search'):
-            api = 'google_plus'
-            #post
-            post[0] = 'google_plus/post/'  + str(content_item['id'])
-            post[1] = content_item['id']
-            post[2] = content_item['url']
-            post[3] = content_item['title']
-            post[4] = content_item['object']['content']
-            post[6] = content_item['published']
-            #from user
-            from_user[0] =  'google_plus/user/' + \
-                            str(content_item['actor']['id'])
-            from_user[1] = content_item['actor']['id']
-            from_user[2] = content_item['actor']['url'] 
-            from_user[3] = content_item['actor']['displayName']
-            if 'image' in content_item['actor'].keys():
-                from_user[5] = content_item['actor']['image']['url']
-            #to users
-            #Not available at the moment
-        if  (blender_config['server'], blender_config['interaction']) \
-            == ('youtube', 'search'):
-            api = 'youtube'
-            #post
-            post[1] = content_item['id']['$t'].split('/')[-1]
-            post[0] = 'youtube/post/'  + str(post[1])
-            post[2] = 'http://www.youtube.com/watch?v=' + str(post[1])
-            post[3] = content_item['title']['$t']
-            post[4] = content_item['content']['$t']
-            post[6] = content_item['published']['$t']
-            #from user
-            from_user[1] = content_item['author'][0]['name']['$t']
-            from_user[0] = 'youtube/user/' + str(from_user[1])
-            from_user[2] = 'http://www.youtube.com/' + str(from_user[1])
-            from_user[4] = content_item['author'][0]['name']['$t']
-            #to users
-            #Not available at the moment
-        users.append(from_user)
-        from_user_subject = from_user[0]
-        #Post
-        if not post[0]:
-            return []
-        triples.extend([
-                [ post[0], 'api', api ],
-                [ post[0], 'type', 'post' ],
-                [ post[0], 'id', post[1] ],
-                [ post[0], 'url', post[2] ],
-                [ post[0], 'title', post[3] ],
-                [ post[0], 'content', post[4] ],
-                [ post[0], 'language', post[5] ],
-                [ post[0], 'publication_date', post[6] ],
-                [ post[0], 'location', post[7] ] ])
-        # Outlinks
-        for outlink in outlinks:
-            triples.append([ post[0], 'outlink', outlink ])
-        # Post from user / to users
-        triples.append([ post[0], 'from_user', from_user_subject ])
-        for to_user_subject in to_user_subjects:
-            triples.append( [ post[0], 'to_user', to_user_subject ])
-        # Users
-        for user in users:
-            if not user[0]:
+        new_outlinks = set()
+        post_subject, post_triples = None, []
+        if make_post:
+            post_subject, post_triples = make_post(content_item, new_outlinks)
+            if not post_subject:
+                return [], set()
+        from_user_subject, from_user_triples = None, []
+        if make_from_user:
+            from_user_subject, from_user_triples = \
+                make_from_user(content_item, new_outlinks)
+        to_user_subjects, to_users_triples = [], []
+        for get_users, make_to_user in to_users:
+            users = get_users(content_item)
+            if type(users) is not list:
                 continue
-            triples.extend([
-                [ user[0], 'api', api ],
-                [ user[0], 'type', 'user' ],
-                [ user[0], 'id', user[1] ],
-                [ user[0], 'url', user[2] ],
-                [ user[0], 'name', user[3] ],
-                [ user[0], 'nickname', user[4] ],
-                [ user[0], 'picture_url', user[5] ],
-                [ user[0], 'location', user[6] ] ])
+            for user in users:
+                to_user_subject, to_user_triples = make_to_user(user,
+                                                                new_outlinks)
+                if to_user_subject:
+                    to_user_subjects.append(to_user_subject)
+                    to_users_triples.extend(to_user_triples)
+        # Post
+        if post_subject:
+            triples.extend(post_triples)
+            # Outlinks
+            for outlink in outlinks:
+                triples.append([post_subject, 'outlink', outlink])
+            # Post from user / to users
+            if from_user_subject:
+                triples.append([post_subject, 'from_user', from_user_subject])
+            for to_user_subject in to_user_subjects:
+                triples.append([post_subject, 'to_user', to_user_subject])
+        # Users
+        triples.extend(to_users_triples)
+        triples.extend(from_user_triples)
         # Inverse relations, user has post / is mentionned
-        triples.append([from_user_subject, 'has_post', post[0]])
-        for to_user_subject in to_user_subjects:
-            triples.append( [ to_user_subject, 'is_mentioned_by', post[0] ])
-        triples = [triple for triple in triples if triple[2]]
-        new_outlinks = set([triple[2] for triple in triples if \
-                        str(triple[1]) == 'url'])
+        if post_subject:
+            if from_user_subject:
+                triples.append([from_user_subject, 'has_post', post_subject])
+            for to_user_subject in to_user_subjects:
+                triples.append([to_user_subject, 'is_mentioned_by',
+                                post_subject])
         return triples, new_outlinks
+    return make_triples
+
+
+def compile_mappings(mappings):
+    """ Compiles the mappings of config.py, by (server, interaction) """
+    compiled_mappings = {}
+    for server_interaction, mapping in mappings.items():
+        compiled_mappings[server_interaction] = compile_mapping(mapping)
+    return compiled_mappings
+
+compiled_mappings = compile_mappings(config.triple_mappings)
+
+
+def make_triples(content_item, blender_config, outlinks):
+    """ Makes harmonized triples, returns the triples and the new outlinks
+    found (the urls of posts and users) """
+    try:
+        _make_triples = compiled_mappings[(blender_config['server'],
+                                           blender_config['interaction'])]
+    except KeyError:
+        logger.error('No triple mapping for %s, check config.py' %
+                     ((blender_config['server'],
+                       blender_config['interaction']),))
+        return [], set()
+    return _make_triples(content_item, outlinks)
 
 #
 #       Deprecated socket communication
@@ -1,9 +1,14 @@
 import logging
 import Queue
-from threading import Thread
+from threading import Thread, Lock
 import datetime
 import time
 import os
+import re
+import zlib
+import hashlib
+import urllib
+from cStringIO import StringIO
 
 import warc
 
@@ -11,19 +16,51 @@ import config
 
 logger = logging.getLogger('warcs')
 
+# Headers added to the response records, with the response key they come
+# from
+RECORD_ID_HEADERS = [('Arcomem-Crawl-ID', 'crawl_id'),
+                     ('Arcomem-Spider-ID', 'spider_id'),
+                     ('Arcomem-Campaign-ID', 'campaign_id')]
+
+# Fields of the index written alongside each WARC file, one line per record
+INDEX_FIELDS = ['record_id', 'target_uri', 'date', 'offset', 'length',
+                'platform', 'crawl_id', 'spider_id']
+# Characters left as they are in the index values, the others (e.g. white
+# spaces) are percent-encoded
+INDEX_SAFE_CHARACTERS = "!$&'()*+,-./:;<=>?@_~"
+
+
+def to_utf8(value):
+    """ Returns a header or index value as a UTF-8 string """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def get_index_value(value):
+    """ Returns a value as written in an index file, '-' if there is none
+    """
+    if value is None or value == '':
+        return '-'
+    # Else ..
+    index_value = urllib.quote(to_utf8(value), INDEX_SAFE_CHARACTERS)
+    if index_value == '-':
+        # Not to be read as None
+        return '%2D'
+    return index_value
+
+
 class WARCManager:
-    """ Writes API responses into a WARC file """
+    """ Writes API responses into WARC files with a pool of writers, each
+    one compressing in its own thread into its own files """
     def __init__(self):
-        self.warcinfo_id = None
-        self.responses_queue = Queue.Queue()
+        self.writers = [WARCWriter(number) for number in 
+                        range(0, config.warcs_writers)]
         self.start_daemons()
-        logger.info('WARCs Manager started')
-        self.open_warc()
-        self.response_counter = 0
+        logger.info('WARCs Manager started with %d writers' % 
+                    len(self.writers))
 
     def start_daemons(self):
-        warcs_daemon_thread = Thread(target=self.warcs_daemon)
-        warcs_daemon_thread.start() 
         writing_rate_thread = Thread(target=self.writing_rate_daemon)
         writing_rate_thread.start() 
 
@@ -32,66 +69,167 @@ class WARCManager:
         _period = config.warcs_rate_period
         while True:
             time.sleep(_period)
+            response_counter = 0
+            for writer in self.writers:
+                response_counter += writer.response_counter
+                writer.response_counter = 0
             logger.info('In the last %d s, I processed %d responses' %
-                    (_period, self.response_counter))
-            self.response_counter = 0
+                    (_period, response_counter))
+
+    def add_response(self, response):
+        """ Gives an API response to a writer: the one of its platform or
+        campaign if the files are split, the least busy one otherwise """
+        split_key = self.get_split_key(response)
+        if split_key is None:
+            writer = min(self.writers, 
+                         key=lambda writer: writer.responses_queue.qsize())
+        else:
+            writer = self.writers[zlib.crc32(split_key) % len(self.writers)]
+        writer.add_response(response, split_key)
+
+    def get_split_key(self, response):
+        """ Returns what the WARC files are split by for a response, None if
+        they are not split """
+        if config.warcs_split_by == 'platform':
+            return response['blender_config']['server']
+        elif config.warcs_split_by == 'campaign':
+            return str(response.get('campaign_id'))
+        return None
+
+    def get_active_files(self):
+        """ Returns the paths of the WARC files being written """
+        active_files = []
+        for writer in self.writers:
+            active_files.extend(writer.get_active_files())
+        return sorted(active_files)
+
+    def get_dict(self):
+        """ Returns a JSON friendly dict of the writers' state """
+        return {
+                "queue_size": sum([writer.responses_queue.qsize() for 
+                                   writer in self.writers]),
+                "writers": len(self.writers),
+                "active_files": self.get_active_files()
+               }
+
+
+class WARCWriter:
+    """ Writes the responses it is given into its own WARC files, one per
+    split key, and rotates them by size and age """
+    def __init__(self, number):
+        self.number = number
+        self.responses_queue = Queue.Queue(config.warcs_queue_size)
+        # WARC files by split key
+        self.warc_files = {}
+        self.file_counter = 0
+        self.response_counter = 0
+        self.start_daemon()
+
+    def start_daemon(self):
+        warcs_daemon_thread = Thread(target=self.warcs_daemon)
+        warcs_daemon_thread.start() 
 
     def warcs_daemon(self): 
         """ Looks into the response queue and writes it in the WARC """
         while True:
-            # If the queue is empty, it will wait till a new response is
-            # added to the queue
-            response = self.responses_queue.get(True)
-            self.write_warc(response)
+            # If the queue is empty, it waits till a new response is added
+            # to the queue, checking the files age from time to time
+            try:
+                response, split_key = self.responses_queue.get(True, 60)
+            except Queue.Empty:
+                try:
+                    self.close_old_warcs()
+                except Exception as e:
+                    logger.error('Could not close the old WARC files, '
+                                 'error: %s' % e)
+                continue
+            # Else ..
+            # A response that cannot be written must not stop the writer,
+            # the spiders would wait for it forever
+            try:
+                self.write_warc(response, split_key)
+            except Exception as e:
+                logger.error('Could not write a response of %s in a WARC '
+                             'file, error: %s' %
+                             (response.get('blender_config'), e))
 
-    def add_response(self, response):
-        """ Adds an API responses into the queue """
-        self.responses_queue.put(response)
+    def add_response(self, response, split_key):
+        """ Adds an API response into the queue, waits if it is full """
+        self.responses_queue.put((response, split_key))
+
+    def get_active_files(self):
+        return [warc_file.path for warc_file in self.warc_files.values()]
+
+    def get_warc(self, split_key):
+        """ Returns the WARC file of a split key, opens a new one if there
+        is none or if it is too big or too old """
+        warc_file = self.warc_files.get(split_key)
+        if warc_file and warc_file.is_full():
+            warc_file.close()
+            warc_file = None
+        if not warc_file:
+            warc_file = self.open_warc(split_key)
+            self.warc_files[split_key] = warc_file
+        return warc_file
 
-    def open_warc(self):
+    def close_old_warcs(self):
+        """ Closes the WARC files that are too old """
+        for split_key, warc_file in self.warc_files.items():
+            if warc_file.is_full():
+                warc_file.close()
+                del self.warc_files[split_key]
+
+    def open_warc(self, split_key):
         """ Opens a new WARC file """
-        self.warc_file_path = os.path.join (
-                config.warcs_path,
-                "apicrawler.%s.warc.gz" % (
-                datetime.datetime.now().strftime(config.datetime_format)))
-                
-        logger.info("Writing new WARC file: %s" % self.warc_file_path)
-        self.warc_file = warc.open(self.warc_file_path, "w")
-        #
-        # Write WARCInfo record
-        #
-        warc_header = warc.WARCHeader(
-                {   "WARC-Type": "warcinfo",
-                    "Content-Type": "application/warc-fields",
-                    "WARC-Filename": os.path.basename(self.warc_file_path)  },
-                defaults = True)
-        warc_payload = 'software: apicrawler\nhostname: ia200127'
-        warc_record = warc.WARCRecord(warc_header, warc_payload)
-        self.warc_file.write_record(warc_record)
-        self.warcinfo_id = warc_header['WARC-RECORD-ID']
-        logger.info("New WARC id: %s" % self.warcinfo_id)
+        self.file_counter += 1
+        name_parts = ['apicrawler']
+        if split_key is not None:
+            name_parts.append(re.sub(r'[^\w.-]', '_', split_key))
+        name_parts.append(
+                datetime.datetime.now().strftime(config.datetime_format))
+        name_parts.append('%d-%d' % (self.number, self.file_counter))
+        file_name = '%s.warc.gz' % '.'.join(name_parts)
+        warc_file = WARCFile(os.path.join(config.warcs_path, file_name))
+        logger.info("Writing new WARC file: %s" % warc_file.path)
+        logger.info("New WARC id: %s" % warc_file.warcinfo_id)
+        return warc_file
 
-    def write_warc(self, response):
+    def write_warc(self, response, split_key):
         """ Writes a response into a WARC file """
+        warc_file = self.get_warc(split_key)
         #
         # Write response record
         #
-        target_uri = response['blender_config']['request_url'] 
+        target_uri = to_utf8(response['blender_config']['request_url'])
         warc_header = warc.WARCHeader(
             {   
                 "WARC-Type": "response",
                 "Content-Type": "application/json",
-                "WARC-Warcinfo-ID": self.warcinfo_id,
+                "WARC-Warcinfo-ID": warc_file.warcinfo_id,
                 "WARC-Target-URI": target_uri,
                 "WARC-Identified-Payload-Type": "application/json"  
             },
             defaults = True )
+        # Which crawl, spider and campaign the response comes from
+        for name, key in RECORD_ID_HEADERS:
+            if response.get(key) is not None:
+                warc_header[name] = to_utf8(response[key])
         payload = response['raw_content']
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
         fake_http_header = (" 200 OK\r\nContent-length: %d\r\n\r\n" %
                             len(payload))
-        warc_payload = '%s%s' % (fake_http_header, payload)
-        warc_record = warc.WARCRecord(warc_header, warc_payload)
-        self.warc_file.write_record(warc_record)
+        # The response is not copied into a bigger string, the header and
+        # the response are given separately
+        offset, length = warc_file.write_record(warc_header,
+                                [fake_http_header, payload],
+                                response['blender_config']['server'],
+                                response.get('crawl_id'),
+                                response.get('spider_id'))
+        # Tells the spider where its response is
+        if response.get('output_warcs'):
+            response['output_warcs'].add_record(warc_file.path, offset,
+                                                length)
 #
 #
 #       # Write metadata record (Deprecated)
@@ -116,11 +254,149 @@ class WARCManager:
 #        self.warc_file.write_record(warc_record)
 #
 #
-        if self.warc_file.tell() > 500 * 1024 * 1024:
-            self.close_warc()
-            self.open_warc()
         self.response_counter += 1
 
-    def close_warc(self):
-        """ Closes the current WARC file """
-        self.warc_file.close()
+
+class SpiderWARCs:
+    """ WARC files a spider's responses were written to, with the (offset,
+    length) of each of its records, in the order they were written. The
+    writers share the files between spiders, so the records of a spider
+    are not contiguous. Filled by the writers, which run in other threads.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.files = {}
+
+    def add_record(self, path, offset, length):
+        with self.lock:
+            self.files.setdefault(path, []).append((offset, length))
+
+    def get_list(self):
+        """ Returns a JSON friendly list of the files, sorted by path, with
+        the records as [offset, length] """
+        with self.lock:
+            return [{
+                     "path": path,
+                     "records": [list(record) for record in records]
+                    } for path, records in sorted(self.files.items())]
+
+
+class WARCFile:
+    """ WARC file starting with a warcinfo record, each record is written
+    as its own gzip member so that it can be read alone. The offset and
+    length of the records are written in an index file, path + '.cdx'. """
+    def __init__(self, path):
+        self.path = path
+        self.fileobj = open(path, 'wb')
+        self.index_fileobj = open(get_index_path(path), 'w')
+        self.index_fileobj.write('#%s\n' % ' '.join(INDEX_FIELDS))
+        self.opened_time = time.time()
+        # Bytes written so far, the file is never read back to know it
+        self.size = 0
+        #
+        # Write WARCInfo record
+        #
+        warc_header = warc.WARCHeader(
+                {   "WARC-Type": "warcinfo",
+                    "Content-Type": "application/warc-fields",
+                    "WARC-Filename": os.path.basename(self.path)  },
+                defaults = True)
+        warc_payload = 'software: apicrawler\nhostname: ia200127'
+        self.write_record(warc_header, [warc_payload])
+        self.warcinfo_id = warc_header['WARC-RECORD-ID']
+
+    def write_record(self, warc_header, payload_pieces, platform=None,
+                     crawl_id=None, spider_id=None):
+        """ Compresses and writes a record and its index line, returns its
+        (offset, length) in the file. The payload is given as a list of
+        strings that are never joined: Content-Length and the digest are
+        computed piece by piece, then the header and the pieces are fed to
+        the compressor one after the other. """
+        # The header comes first, so it is completed before compressing
+        digest = hashlib.sha1()
+        content_length = 0
+        for piece in payload_pieces:
+            digest.update(piece)
+            content_length += len(piece)
+        warc_header['Content-Length'] = str(content_length)
+        warc_header['WARC-Payload-Digest'] = 'sha1:' + digest.hexdigest()
+        compressor = zlib.compressobj(config.warcs_compression_level,
+                                      zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed_pieces = [compressor.compress(str(warc_header))]
+        for piece in payload_pieces:
+            compressed_pieces.append(compressor.compress(piece))
+        compressed_pieces.append(compressor.compress('\r\n\r\n'))
+        compressed_pieces.append(compressor.flush())
+        self.fileobj.writelines(compressed_pieces)
+        length = sum([len(piece) for piece in compressed_pieces])
+        offset = self.size
+        self.size += length
+        index_values = [warc_header.record_id,
+                        warc_header.get('WARC-Target-URI'),
+                        warc_header.date, offset, length,
+                        platform, crawl_id, spider_id]
+        self.index_fileobj.write('%s\n' % ' '.join([
+                get_index_value(value) for value in index_values]))
+        return offset, length
+
+    def is_full(self):
+        """ Returns True if the file is too big or too old """
+        return self.size >= config.warcs_max_size or \
+               time.time() - self.opened_time >= config.warcs_max_seconds
+
+    def close(self):
+        """ Closes the WARC file """
+        self.fileobj.close()
+        self.index_fileobj.close()
+
+
+#
+#       Reading the records back, with the index files
+#
+
+def get_index_path(warc_path):
+    return warc_path + '.cdx'
+
+
+def read_index(warc_path):
+    """ Returns the index entries of a WARC file, as dicts with the
+    INDEX_FIELDS as keys and UTF-8 strings as values """
+    entries = []
+    with open(get_index_path(warc_path)) as _f:
+        for line in _f:
+            if line.startswith('#'):
+                continue
+            # Else ..
+            values = line.split()
+            if len(values) != len(INDEX_FIELDS):
+                # The last line of a file being written can be incomplete
+                continue
+            # Else ..
+            entry = dict(zip(INDEX_FIELDS, [None if value == '-' else
+                                            urllib.unquote(value)
+                                            for value in values]))
+            entry['offset'] = int(entry['offset'])
+            entry['length'] = int(entry['length'])
+            entries.append(entry)
+    return entries
+
+
+def find_records(warc_path, **criteria):
+    """ Returns the index entries of a WARC file matching all criteria, e.g.
+    find_records(path, spider_id='1234') """
+    return [entry for entry in read_index(warc_path) if 
+            all([entry[field] == to_utf8(value) for field, value in 
+                 criteria.iteritems()])]
+
+
+def read_record(warc_path, offset, length):
+    """ Reads a single record of a WARC file, only its gzip member is read
+    and decompressed. Returns its header (a warc.WARCHeader) and payload.
+    """
+    with open(warc_path, 'rb') as _f:
+        _f.seek(offset)
+        member = _f.read(length)
+    data = zlib.decompress(member, 16 + zlib.MAX_WBITS)
+    warc_record = warc.WARCFile(fileobj=StringIO(data),
+                                compress=False).read_record()
+    return warc_record.header, warc_record.payload.read()
@@ -0,0 +1,510 @@
+""" Micro benchmarks of the hot loops of the API Crawler, run on content
+items shaped like the ones of the different platforms """
+#
+# Ad hoc benchmarks, run with: python bench_apicrawler.py
+#
+import re
+import time
+import copy
+import os
+import tempfile
+
+from arcomem_lib import config
+from arcomem_lib import outlinks
+from arcomem_lib import triples
+from arcomem_lib import loader
+from arcomem_lib import tripleindex
+from test_sinks import StubServer
+
+
+# Content items by (server, interaction), as found by the responses handler
+content_items = {
+    ('twitter-search', 'search'): {
+        "created_at": "Thu, 20 Sep 2012 10:12:45 +0000",
+        "entities": {
+            "hashtags": [{"indices": [40, 48], "text": "helium"}],
+            "urls": [{
+                "display_url": "greenpeace.org/helium",
+                "expanded_url": "http://www.greenpeace.org/helium",
+                "indices": [50, 70],
+                "url": "http://t.co/AbCdEf12"
+            }],
+            "user_mentions": [{
+                "id": 783214, "id_str": "783214", "indices": [0, 8],
+                "name": "Twitter", "screen_name": "twitter"
+            }]
+        },
+        "from_user": "greenpeace",
+        "from_user_id": 3459051,
+        "from_user_id_str": "3459051",
+        "from_user_name": "Greenpeace",
+        "geo": None,
+        "id": 248731829341892608,
+        "id_str": "248731829341892608",
+        "iso_language_code": "en",
+        "metadata": {"result_type": "recent"},
+        "profile_image_url":
+            "http://a0.twimg.com/profile_images/1/gp_normal.png",
+        "profile_image_url_https":
+            "https://si0.twimg.com/profile_images/1/gp_normal.png",
+        "source": "&lt;a href=&quot;http://www.hootsuite.com&quot;&gt;"
+                  "HootSuite&lt;/a&gt;",
+        "text": "@twitter Helium shortage, what now? #helium "
+                "http://t.co/AbCdEf12 (via http://WWW.Example.COM/a#top).",
+        "to_user": None,
+        "to_user_id": 0
+    },
+    ('facebook', 'search'): {
+        "id": "100000_200000",
+        "from": {"name": "Some Page", "category": "Cause", "id": "100000"},
+        "to": {"data": [{"name": "Friend", "id": "300000"}]},
+        "message": "Read this: http://www.example.org/helium?ref=fb "
+                   "and this https://example.net/a_(b)",
+        "picture": "http://photos-a.ak.fbcdn.net/photos/1_s.jpg",
+        "link": "http://www.example.org/helium?ref=fb",
+        "name": "Helium is running out",
+        "caption": "www.example.org",
+        "description": "A long description of the linked page " * 5,
+        "icon": "http://static.ak.fbcdn.net/rsrc.php/v2/yD/r/link.gif",
+        "actions": [
+            {"name": "Comment",
+             "link": "http://www.facebook.com/100000/posts/200000"},
+            {"name": "Like",
+             "link": "http://www.facebook.com/100000/posts/200000"}
+        ],
+        "type": "link",
+        "created_time": "2012-09-20T10:00:00+0000",
+        "updated_time": "2012-09-20T10:00:00+0000",
+        "likes": {"data": [{"name": "Liker", "id": "400000"}], "count": 1}
+    },
+    ('flickr', 'photos_search'): {
+        "id": "8003953744", "owner": "12345678@N00",
+        "secret": "abcdef1234", "server": "8036", "farm": 9,
+        "title": "Helium balloons", "ispublic": 1, "isfriend": 0,
+        "isfamily": 0
+    },
+    ('google_plus', 'activities_search'): {
+        "kind": "plus#activity",
+        "title": "Helium, a noble gas",
+        "published": "2012-09-20T10:00:00.000Z",
+        "updated": "2012-09-20T10:00:00.000Z",
+        "id": "z12abcdefghijklmn",
+        "url": "https://plus.google.com/1234567890/posts/AbCdEfGhIjK",
+        "actor": {
+            "id": "1234567890",
+            "displayName": "Someone",
+            "url": "https://plus.google.com/1234567890",
+            "image": {"url": "https://lh3.googleusercontent.com/photo.jpg"}
+        },
+        "verb": "post",
+        "object": {
+            "objectType": "note",
+            "content": "Helium is a noble gas, see "
+                       "&lt;a href=&quot;http://en.wikipedia.org/wiki/Helium"
+                       "&quot;&gt;Wikipedia&lt;/a&gt;",
+            "url": "https://plus.google.com/1234567890/posts/AbCdEfGhIjK",
+            "replies": {"totalItems": 0},
+            "plusoners": {"totalItems": 3},
+            "resharers": {"totalItems": 1},
+            "attachments": [{
+                "objectType": "article",
+                "displayName": "Helium",
+                "url": "http://en.wikipedia.org/wiki/Helium"
+            }]
+        },
+        "provider": {"title": "Google+"},
+        "access": {"kind": "plus#acl", "description": "Public"}
+    },
+    ('youtube', 'search'): {
+        "id": {"$t": "http://gdata.youtube.com/feeds/api/videos/AbCdEfGh"},
+        "published": {"$t": "2012-09-20T10:00:00.000Z"},
+        "updated": {"$t": "2012-09-20T10:00:00.000Z"},
+        "category": [{
+            "scheme": "http://schemas.google.com/g/2005#kind",
+            "term": "http://gdata.youtube.com/schemas/2007#video"
+        }],
+        "title": {"$t": "Helium voice", "type": "text"},
+        "content": {"$t": "Funny helium voice, more on "
+                          "http://www.example.com/helium", "type": "text"},
+        "link": [
+            {"rel": "alternate", "type": "text/html",
+             "href": "http://www.youtube.com/watch?v=AbCdEfGh&feature=y"},
+            {"rel": "self", "type": "application/atom+xml",
+             "href": "http://gdata.youtube.com/feeds/api/videos/AbCdEfGh"}
+        ],
+        "author": [{
+            "name": {"$t": "someone"},
+            "uri": {"$t": "http://gdata.youtube.com/feeds/api/users/someone"}
+        }],
+        "media$group": {
+            "media$thumbnail": [
+                {"url": "http://i.ytimg.com/vi/AbCdEfGh/0.jpg"},
+                {"url": "http://i.ytimg.com/vi/AbCdEfGh/1.jpg"}
+            ]
+        }
+    }
+}
+
+
+def get_rate(function, items, repeat=3):
+    """ Runs function on every item, returns the best rate in items per
+    second """
+    best = None
+    for i in range(0, repeat):
+        start = time.time()
+        for item in items:
+            function(item)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return len(items) / best
+
+
+def bench(name, function, items, repeat=3):
+    """ Prints the best rate of function in items per second """
+    print '%-45s %10.0f items/s' % (name, get_rate(function, items, repeat))
+
+
+def extract_outlinks_baseline(_content, outlinks=None):
+    """ The recursive outlinks extraction replaced by
+    outlinks.extract_outlinks, kept as the baseline of the benchmark """
+    if outlinks is None:
+        outlinks = set()
+    if type(_content) is dict:
+        for key in _content.keys():
+            extract_outlinks_baseline(_content[key], outlinks)
+    elif type(_content) is list:
+        for item in _content:
+            extract_outlinks_baseline(item, outlinks)
+    else:
+        try:
+            str_content = str(_content)
+        except Exception:
+            return outlinks
+        if re.match('https?://', str_content, re.I):
+            outlinks.add(str(_content))
+    return outlinks
+
+
+def clean_outlinks_baseline(outlinks):
+    """ The outlinks cleaning that went with the baseline extraction """
+    for outlink in outlinks:
+        outlink = outlink.replace("&quot;", '')
+        outlink = outlink.replace('"', '')
+        outlink = outlink.replace('\\', '')
+    return outlinks
+
+
+def baseline_outlinks(content_item):
+    """ What the responses handler did before outlinks.extract_outlinks
+    """
+    return set(clean_outlinks_baseline(list(
+                    extract_outlinks_baseline(content_item))))
+
+
+def bench_outlinks(number_of_items=20000):
+    """ Benchmarks the outlinks extraction against the baseline one """
+    print '-- Outlinks extraction --'
+    print '%-45s %18s %18s' % ('', 'baseline', 'extract_outlinks')
+    for (server, interaction), content_item in sorted(content_items.items()):
+        items = [copy.deepcopy(content_item) for i in range(0,
+                                                            number_of_items)]
+        baseline_rate = get_rate(baseline_outlinks, items)
+        rate = get_rate(outlinks.extract_outlinks, items)
+        print '%-45s %10.0f items/s %10.0f items/s (x%.2f)' % (
+                    '%s/%s' % (server, interaction), baseline_rate, rate,
+                    rate / baseline_rate)
+    print
+
+
+def make_triples_baseline(content_item, blender_config, outlinks):
+    """ The if-chain triples making replaced by the mappings of config.py,
+    kept as the baseline of the benchmark """
+    triples = []
+    api = ''
+    post = ['' for i in range(8)]
+    from_user_subject = ''
+    to_user_subjects = []
+    users = []
+    from_user = ['' for i in range(7)]
+    #flickr
+    if  (blender_config['server'], blender_config['interaction']) \
+        == ('flickr', 'photos_search'):
+        api = 'flickr'
+        #post
+        post[0] = 'flickr/post/'  + str(content_item['id'])
+        post[1] = content_item['id']
+        post[2] = 'http://www.flickr.com/%s/%s' % \
+                (content_item['owner'], content_item['id'])
+        post[3] = content_item['title']
+        #user
+        from_user[0] = 'flickr/user/' + str(content_item['owner'])
+        from_user_subject = from_user[0]
+        from_user[1] = content_item['owner']
+        from_user[2] = 'http://www.flickr.com/%s' % (from_user[1])
+    #twitter
+    if  (blender_config['server'], blender_config['interaction']) \
+        == ('twitter-search', 'search'):
+        api = 'twitter'
+        #post
+        post[0] = 'twitter/post/'  + str(content_item['id'])
+        post[1] = content_item['id']
+        post[2] = 'http://twitter.com/%s/status/%s' % \
+                (content_item['from_user'], content_item['id'])
+        post[4] = content_item['text']
+        post[5] = content_item['iso_language_code']
+        post[6] = content_item['created_at']
+        post[7] = content_item.get('geo', '')
+        #from user
+        from_user[0] = 'twitter/user/' + str(content_item['from_user_id'])
+        from_user[1] = content_item['from_user_id']
+        from_user[2] =  'http://twitter.com/%s/' % \
+                        (content_item['from_user'])
+        from_user[3] = content_item['from_user_name']
+        from_user[4] = content_item['from_user']
+        from_user[5] = content_item['profile_image_url']
+        #to users
+        entities = content_item.get('entities', {})
+        for item in entities.get('user_mentions', [{}]):
+            if not item:
+                continue
+            to_user = ['' for i in range(7)]
+            to_user[0] = 'twitter/user/' + str(item['id'])
+            to_user_subjects.append(to_user[0])
+            to_user[1] = item['id']
+            to_user[2] = 'http://twitter.com/%s' % (item['screen_name'])
+            to_user[3] = item['name']
+            to_user[4] = item['screen_name']
+            users.append( to_user )
+    if  (blender_config['server'], blender_config['interaction']) \
+        == ('facebook', 'users'):
+            user = ['' for i in range(7)]
+            user[0] = 'facebook/user/'  + str(content_item['id'])
+            user[1] = content_item['id']
+            user[2] = 'http://www.facebook.com/%s' % (content_item['id'])
+            user[3] = content_item['name']
+            user[4] = content_item['username']
+            if content_item.get('location',''):
+                user[6] = content_item['location']
+            users.append(user)
+    if  (blender_config['server'], blender_config['interaction']) \
+        == ('facebook', 'search'):
+        api = 'facebook'
+        #post
+        post[0] = 'facebook/post/'  + str(content_item['id'])
+        post[1] = content_item['id']
+        post[2] = 'http://www.facebook.com/%s' % \
+                (content_item['id'])
+        if content_item.get('name',''):
+            post[3] = content_item['name']
+        if content_item.get('message',''):
+            post[4] = content_item['message']
+        if content_item.get('caption',''):
+            post[4] = content_item['caption']
+        post[6] = content_item['updated_time']
+        #from user
+        from_user[0] = 'facebook/user/' + str(content_item['from']['id'])
+        from_user[1] = content_item['from']['id']
+        from_user[2] = 'http://www.facebook.com/%s' % \
+                (content_item['from']['id'])
+        from_user[3] = content_item['from']['name']
+        #to users
+        if 'likes' in content_item.keys():
+            for item in content_item['likes']['data']:
+                to_user = ['' for i in range(7)]
+                to_user[0] = 'facebook/user/' + str(item['id'])
+                to_user_subjects.append(to_user[0])
+                to_user[1] = item['id']
+                to_user[2] = 'http://www.facebook.com/%s' % (item['id'])
+                to_user[3] = item['name']
+                users.append(to_user)
+        if 'to' in content_item.keys():
+            for item in content_item['to']['data']:
+                to_user = ['' for i in range(7)]
+                to_user[0] = 'facebook/user/' + str(item['id'])
+                to_user_subjects.append(to_user[0])
+                to_user[1] = item['id']
+                to_user[2] = 'http://www.facebook.com/%s' % (item['id'])
+                to_user[3] = item['name']
+                users.append(to_user)
+    if  (blender_config['server'], blender_config['interaction']) \
+        == ('google_plus', 'activities_search'):
+        api = 'google_plus'
+        #post
+        post[0] = 'google_plus/post/'  + str(content_item['id'])
+        post[1] = content_item['id']
+        post[2] = content_item['url']
+        post[3] = content_item['title']
+        post[4] = content_item['object']['content']
+        post[6] = content_item['published']
+        #from user
+        from_user[0] =  'google_plus/user/' + \
+                        str(content_item['actor']['id'])
+        from_user[1] = content_item['actor']['id']
+        from_user[2] = content_item['actor']['url']
+        from_user[3] = content_item['actor']['displayName']
+        if 'image' in content_item['actor'].keys():
+            from_user[5] = content_item['actor']['image']['url']
+        #to users
+        #Not available at the moment
+    if  (blender_config['server'], blender_config['interaction']) \
+        == ('youtube', 'search'):
+        api = 'youtube'
+        #post
+        post[1] = content_item['id']['$t'].split('/')[-1]
+        post[0] = 'youtube/post/'  + str(post[1])
+        post[2] = 'http://www.youtube.com/watch?v=' + str(post[1])
+        post[3] = content_item['title']['$t']
+        post[4] = content_item['content']['$t']
+        post[6] = content_item['published']['$t']
+        #from user
+        from_user[1] = content_item['author'][0]['name']['$t']
+        from_user[0] = 'youtube/user/' + str(from_user[1])
+        from_user[2] = 'http://www.youtube.com/' + str(from_user[1])
+        from_user[4] = content_item['author'][0]['name']['$t']
+        #to users
+        #Not available at the moment
+    users.append(from_user)
+    from_user_subject = from_user[0]
+    #Post
+    if not post[0]:
+        return []
+    triples.extend([
+            [ post[0], 'api', api ],
+            [ post[0], 'type', 'post' ],
+            [ post[0], 'id', post[1] ],
+            [ post[0], 'url', post[2] ],
+            [ post[0], 'title', post[3] ],
+            [ post[0], 'content', post[4] ],
+            [ post[0], 'language', post[5] ],
+            [ post[0], 'publication_date', post[6] ],
+            [ post[0], 'location', post[7] ] ])
+    # Outlinks
+    for outlink in outlinks:
+        triples.append([ post[0], 'outlink', outlink ])
+    # Post from user / to users
+    triples.append([ post[0], 'from_user', from_user_subject ])
+    for to_user_subject in to_user_subjects:
+        triples.append( [ post[0], 'to_user', to_user_subject ])
+    # Users
+    for user in users:
+        if not user[0]:
+            continue
+        triples.extend([
+            [ user[0], 'api', api ],
+            [ user[0], 'type', 'user' ],
+            [ user[0], 'id', user[1] ],
+            [ user[0], 'url', user[2] ],
+            [ user[0], 'name', user[3] ],
+            [ user[0], 'nickname', user[4] ],
+            [ user[0], 'picture_url', user[5] ],
+            [ user[0], 'location', user[6] ] ])
+    # Inverse relations, user has post / is mentionned
+    triples.append([from_user_subject, 'has_post', post[0]])
+    for to_user_subject in to_user_subjects:
+        triples.append( [ to_user_subject, 'is_mentioned_by', post[0] ])
+    triples = [triple for triple in triples if triple[2]]
+    new_outlinks = set([triple[2] for triple in triples if \
+                    str(triple[1]) == 'url'])
+    return triples, new_outlinks
+
+
+def bench_triples(number_of_items=20000):
+    """ Benchmarks the triples making against the baseline one """
+    print '-- Triples making --'
+    print '%-45s %18s %18s' % ('', 'baseline', 'make_triples')
+    for (server, interaction), content_item in sorted(content_items.items()):
+        blender_config = {'server': server, 'interaction': interaction}
+        items = [copy.deepcopy(content_item) for i in range(0,
+                                                            number_of_items)]
+        item_outlinks = outlinks.extract_outlinks(content_item)
+        baseline_rate = get_rate(
+                lambda item: make_triples_baseline(item, blender_config,
+                                                   item_outlinks),
+                items)
+        rate = get_rate(
+                lambda item: triples.make_triples(item, blender_config,
+                                                  item_outlinks),
+                items)
+        print '%-45s %10.0f items/s %10.0f items/s (x%.2f)' % (
+                    '%s/%s' % (server, interaction), baseline_rate, rate,
+                    rate / baseline_rate)
+    print
+
+
+def bench_loader(number_of_items=20000):
+    """ Benchmarks the loading of the triples files in a local stand-in of
+    the triple store, for each protocol """
+    print '-- Triple store loading --'
+    chunk = triples.TripleBatch()
+    for (server, interaction), content_item in sorted(content_items.items()):
+        blender_config = {'server': server, 'interaction': interaction}
+        item_outlinks = outlinks.extract_outlinks(content_item)
+        for i in range(0, number_of_items):
+            item_triples, _ = triples.make_triples(content_item,
+                                                   blender_config,
+                                                   item_outlinks)
+            chunk.extend([triple + [i % 10, 1] for triple in item_triples])
+    server = StubServer(keep_bodies=False)
+    config.triple_store_host = 'localhost'
+    config.triple_store_port = server.server_address[1]
+    config.triple_store_poll_period = 0.1
+    for protocol in sorted(loader.BODIES):
+        config.triples_path = tempfile.mkdtemp()
+        config.triple_store_protocol = protocol
+        with open(os.path.join(config.triples_path, '1.triples'), 'wb') as _f:
+            triples.write_backup(_f, chunk, time.time())
+        start = time.time()
+        triple_store_loader = loader.TripleStoreLoader()
+        while triple_store_loader.loaded_triples < len(chunk):
+            time.sleep(0.01)
+        print '%-45s %10.0f triples/s' % (protocol, len(chunk) /
+                                          (time.time() - start))
+    print
+
+
+def bench_triple_index(number_of_chunks=10, number_of_items=2000,
+                       number_of_lookups=1000):
+    """ Benchmarks the indexing of the triples and their lookups """
+    print '-- Triple index --'
+    triple_index = tripleindex.TripleIndex(
+                        os.path.join(tempfile.mkdtemp(), 'triples.sqlite'))
+    start = time.time()
+    for i in range(0, number_of_chunks):
+        chunk = triples.TripleBatch()
+        for (server, interaction), content_item in \
+                sorted(content_items.items()):
+            blender_config = {'server': server, 'interaction': interaction}
+            item_outlinks = outlinks.extract_outlinks(content_item)
+            item_triples, _ = triples.make_triples(content_item,
+                                                   blender_config,
+                                                   item_outlinks)
+            for j in range(0, number_of_items):
+                # Other posts, by other users, in 10 campaigns
+                chunk.extend([[triple[0] + '-%d-%d' % (i, j), triple[1],
+                               triple[2], i, j % 10]
+                              for triple in item_triples])
+        triple_index.add_chunk(chunk)
+    print '%-45s %10.0f triples/s' % ('indexing', triple_index.indexed_triples
+                                                 / (time.time() - start))
+    subject = triple_index.find(limit=1)[0][0]
+    lookups = [('subject', {'subject': subject}),
+               ('predicate and object', {'predicate': 'api',
+                                         '_object': 'twitter'}),
+               ('campaign', {'campaign_id': 3, 'predicate': 'outlink'})]
+    for name, criteria in lookups:
+        start = time.time()
+        for i in range(0, number_of_lookups):
+            triple_index.find(limit=100, **criteria)
+        print '%-45s %10.2f ms' % ('lookup by %s' % name, 1000 *
+                                   (time.time() - start) / number_of_lookups)
+    print
+
+
+if __name__ == '__main__':
+    bench_outlinks()
+    bench_triples()
+    bench_loader()
+    bench_triple_index()
+    # The loader daemons never stop
+    os._exit(0)
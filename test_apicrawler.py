@@ -48,6 +48,11 @@ tests = [
     [ 
         'Crawls information', '/crawls', 'GET', '', 200
     ],
+    [ 
+        'Looks up the outlinks of a campaign',
+        '/triples?predicate=outlink&campaign_id=my_campaign', 'GET', '',
+        200 if config.triple_index else 404
+    ],
     [ 
         'Adding a crawl ending one hour ago', '/crawl/add_direct', 'POST', 
         ['twitter', 'search', ['helium'], 'my_campaign',
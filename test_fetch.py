@@ -0,0 +1,225 @@
+""" Tests the fetching of the pages against a local stub HTTP server: the
+fetch pool, the sliding window of the spiders, the scheduling of the
+spiders and the rate limit """
+#
+# Ad hoc and basic testing at the moment, run with: python test_fetch.py
+#
+import httplib
+import urllib
+import urlparse
+import json
+import time
+import datetime
+import os
+
+from arcomem_lib import fetch
+from arcomem_lib import spiders
+from arcomem_lib import scheduler
+from arcomem_lib import ratelimit
+from test_sinks import StubServer, check
+
+# Pages of the stub API, the next ones are empty
+NUMBER_OF_PAGES = 8
+# Page answered with an error, the stub blender raises an exception
+ERROR_PAGE = 3
+
+
+class StubBlender:
+    """ Blender-like client of the stub server, a page is a JSON list of
+    content items """
+    def __init__(self, port):
+        self.port = port
+        self.server = None
+        self.interaction = None
+        self.url_params = {}
+
+    def load_server(self, server):
+        self.server = server
+        self.url_params = {}
+
+    def load_interaction(self, interaction):
+        self.interaction = interaction
+        self.url_params = {}
+
+    def set_url_params(self, url_params):
+        self.url_params.update(url_params)
+
+    def blend(self):
+        connection = httplib.HTTPConnection('localhost', self.port)
+        connection.request('GET', '/%s/%s?%s' % (
+                                self.server, self.interaction,
+                                urllib.urlencode(self.url_params)))
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        if response.status >= 500:
+            raise IOError('server error %d' % response.status)
+        # Else ..
+        return {
+            'successful_interaction': response.status == 200,
+            'headers': response.getheaders(),
+            'loaded_content': json.loads(body) if body else None,
+            'blender_config': {'server': self.server,
+                               'interaction': self.interaction}
+        }
+
+
+class StubResponsesHandler:
+    """ Keeps the pages handled by a spider, in order """
+    def __init__(self):
+        self.pages = []
+
+    def add_response(self, response, statistics):
+        content_items = response['loaded_content']
+        if content_items:
+            self.pages.append(content_items[0]['page'])
+        return len(content_items)
+
+
+def get_stub_page(path, requested_pages, errors=False):
+    """ Returns the page of a path, the first pages are the slowest so that
+    the pages are fetched out of order """
+    query = urlparse.parse_qs(urlparse.urlparse(path).query)
+    page = int(query['page'][0])
+    requested_pages.append(page)
+    if errors and page == ERROR_PAGE:
+        return 500, ''
+    # Else ..
+    if page > NUMBER_OF_PAGES:
+        time.sleep(0.1)
+        return 200, '[]'
+    # Else ..
+    time.sleep(0.02 * (NUMBER_OF_PAGES - page))
+    return 200, json.dumps([{'page': page}])
+
+
+def fetch_stub_pages(pool, window):
+    """ Fetches the stub pages with a spider, returns the pages handled """
+    spider = spiders.Spider([], None, None)
+    responses_handler = StubResponsesHandler()
+    blender = fetch.PooledBlender(pool, window)
+    blender.load_server('stub')
+    blender.load_interaction('search')
+    spider.fetch_pages(blender, responses_handler,
+                       lambda page: {'page': page})
+    return responses_handler.pages
+
+
+class StubAPI:
+    """ Blender-like API answering the responses given, in order """
+    def __init__(self, responses):
+        self.responses = responses
+
+    def blend(self):
+        return self.responses.pop(0)
+
+
+class StubSpider:
+    """ What the scheduler needs from a spider """
+    def __init__(self, start_date, end_date=None):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.status = 'waiting'
+
+
+if __name__ == '__main__':
+    # Fetch pool and sliding window
+    server = StubServer()
+    requested_pages = []
+    server.get_page = lambda path: get_stub_page(path, requested_pages)
+    pool = fetch.FetchPool('stub', 4,
+                           lambda: StubBlender(server.server_address[1]))
+    start = time.time()
+    pages = fetch_stub_pages(pool, 4)
+    check('Handles the pages in order under concurrency',
+          pages == range(1, NUMBER_OF_PAGES + 1))
+    # One at a time, the pages would take 0.66 s
+    check('Fetches the pages concurrently', time.time() - start < 0.5)
+    # With a single fetcher, the three pages in the window after the first
+    # empty page are cancelled, but the next one may already be fetched
+    del requested_pages[:]
+    pool_1 = fetch.FetchPool('stub', 1,
+                             lambda: StubBlender(server.server_address[1]))
+    fetch_stub_pages(pool_1, 4)
+    time.sleep(0.5)
+    check('Cancels the pages after the empty one',
+          requested_pages[:NUMBER_OF_PAGES + 1] ==
+          range(1, NUMBER_OF_PAGES + 2) and
+          len(requested_pages) <= NUMBER_OF_PAGES + 2)
+    del requested_pages[:]
+    request_1 = pool_1.submit('stub', 'search', {'page': 1})
+    request_2 = pool_1.submit('stub', 'search', {'page': 2})
+    request_2.cancel()
+    check('Does not fetch a cancelled request',
+          request_1.wait()['successful_interaction'] and
+          request_2.wait() is None and requested_pages == [1])
+    server.get_page = lambda path: get_stub_page(path, requested_pages, True)
+    check('Stops at a page whose request failed',
+          fetch_stub_pages(pool, 4) == range(1, ERROR_PAGE))
+    response = pool.submit('stub', 'search', {'page': ERROR_PAGE}).wait()
+    check('Turns a failed request into an unsuccessful response',
+          not response['successful_interaction'] and
+          response['blender_config'] == {'server': 'stub',
+                                         'interaction': 'search'})
+    queued_request = pool_1.submit('stub', 'search', {'page': 1})
+    pool_1.shutdown()
+    check('Executes the queued requests before shutting down',
+          queued_request.wait()['successful_interaction'])
+    check('Stops the fetchers', not [fetcher_thread for fetcher_thread in
+                                     pool_1.fetcher_threads
+                                     if fetcher_thread.is_alive()])
+    check('Fails the requests submitted after the shutdown',
+          not pool_1.submit('stub', 'search',
+                            {'page': 1}).wait()['successful_interaction'])
+    pool.shutdown()
+    # Scheduler
+    now = datetime.datetime.now()
+    spider_scheduler = scheduler.SpiderScheduler()
+    later_spider = StubSpider(now + datetime.timedelta(hours=1))
+    removed_spider = StubSpider(now - datetime.timedelta(seconds=2))
+    due_spider = StubSpider(now - datetime.timedelta(seconds=1))
+    expired_spider = StubSpider(now - datetime.timedelta(seconds=3),
+                                now - datetime.timedelta(seconds=1))
+    for spider in [later_spider, removed_spider, due_spider, expired_spider]:
+        spider_scheduler.put(spider)
+    check('Drops the expired spiders', spider_scheduler.qsize() == 3)
+    check('Marks the dropped spiders as expired',
+          expired_spider.status == 'expired' and
+          due_spider.status == 'waiting')
+    check('Removes a queued spider', spider_scheduler.remove(removed_spider)
+          and not spider_scheduler.remove(removed_spider))
+    check('Skips the removed spiders for the next due date',
+          spider_scheduler.next_due() == due_spider.start_date)
+    check('Hands out the due spider', spider_scheduler.get() is due_spider)
+    check('Keeps the spider not due yet',
+          spider_scheduler.next_due() == later_spider.start_date and
+          spider_scheduler.qsize() == 1)
+    # Rate limit
+    bucket = ratelimit.TokenBucket(10, 10)
+    check('Is not throttled without rate limit headers',
+          not bucket.update_from_headers({'Content-Type': 'text/html'}))
+    check('Is throttled by Retry-After',
+          bucket.update_from_headers([('Retry-After', '30')]) and
+          29 < bucket.get_dict()['paused_for'] <= 30)
+    bucket = ratelimit.TokenBucket(10, 10)
+    bucket.update_from_headers({'X-Rate-Limit-Remaining': '50',
+                                'X-Rate-Limit-Reset': str(time.time() + 100)})
+    check('Spreads the remaining requests until the reset',
+          abs(bucket.get_dict()['rate'] - 0.5) < 0.01)
+    check('Is throttled when no request remains',
+          bucket.update_from_headers({'x-ratelimit-remaining': '0',
+                                      'x-ratelimit-reset': '20'}) and
+          19 < bucket.get_dict()['paused_for'] <= 20)
+    bucket = ratelimit.TokenBucket(100, 100)
+    blender = ratelimit.RateLimitedBlender(StubAPI([
+                    {'successful_interaction': False,
+                     'headers': [('retry-after', '0.1')]},
+                    {'successful_interaction': True, 'headers': None}]),
+                    bucket)
+    start = time.time()
+    check('Retries a throttled request after Retry-After',
+          blender.blend()['successful_interaction'] and
+          time.time() - start >= 0.1 and
+          bucket.get_dict()['throttled_requests'] == 1)
+    # The stub server threads are not daemons
+    os._exit(0)
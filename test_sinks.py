@@ -0,0 +1,252 @@
+""" Tests the delivery of the outputs against a local stub HTTP server: the
+retries, the circuit breaker, the re-delivery of the failed chunks and the
+loading of the triples files """
+#
+# Ad hoc and basic testing at the moment, run with: python test_sinks.py
+#
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+import tempfile
+import os
+import StringIO
+
+from arcomem_lib import config
+from arcomem_lib import sinks
+from arcomem_lib import triples
+from arcomem_lib import loader
+from arcomem_lib import outlinks
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers the POSTs with the status of the server, keeps the bodies
+    received """
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        """ Reads a body, streamed with the chunked transfer encoding or
+        not """
+        if self.headers.get('Transfer-Encoding') != 'chunked':
+            return self.rfile.read(int(self.headers['Content-Length']))
+        # Else ..
+        pieces = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            if not size:
+                self.rfile.readline()
+                return ''.join(pieces)
+            # Else ..
+            pieces.append(self.rfile.read(size))
+            self.rfile.readline()
+
+    def do_POST(self):
+        try:
+            body = self.read_body()
+        except ValueError:
+            # The client closed the connection in the middle of the body
+            self.close_connection = 1
+            return
+        # Else ..
+        status = self.server.status
+        if status == 200:
+            if self.server.keep_bodies:
+                self.server.bodies.append(body)
+            self.server.received_bytes += len(body)
+        self.server.requests += 1
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        """ Answers with the page the server makes for the path """
+        status, body = self.server.get_page(self.path)
+        self.server.requests += 1
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Local stand-in for a sink or a triple store, status is the status
+    code it answers. Each keep-alive connection is served by its own thread.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, keep_bodies=True):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port),
+                                           StubHandler)
+        self.status = 200
+        self.keep_bodies = keep_bodies
+        self.bodies = []
+        self.received_bytes = 0
+        self.requests = 0
+        # Makes the (status, body) of a GET from its path
+        self.get_page = lambda path: (self.status, '')
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+def check(info, condition):
+    print '%-60s %s' % (info, 'OK' if condition else 'FAILED')
+
+
+if __name__ == '__main__':
+    # Fast retries and a local spool
+    config.sink_backoff_base = 0.01
+    config.sink_failure_threshold = 3
+    config.sink_reset_seconds = 0.5
+    config.redelivery_period = 0.1
+    config.spool_path = tempfile.mkdtemp()
+    server = StubServer()
+    sink = sinks.HTTPSink('stub', 'localhost', server.server_address[1],
+                          '/sink')
+    sink.send('chunk 1')
+    sink.send('chunk 2')
+    check('Sends chunks', server.bodies == ['chunk 1', 'chunk 2'])
+    check('Reuses the connection',
+          sink.connection_pool.idle_connections.qsize() == 1)
+    server.status = 503
+    try:
+        sink.send('chunk 3')
+        check('Gives up after the retries', False)
+    except sinks.SinkError:
+        check('Gives up after the retries', True)
+    check('Opens the circuit',
+          sink.circuit_breaker.state == sinks.CircuitBreaker.OPEN)
+    requests = server.requests
+    try:
+        sink.send('chunk 4')
+    except sinks.CircuitOpenError:
+        pass
+    check('Sends nothing while the circuit is open',
+          server.requests == requests)
+    redeliverer = sinks.Redeliverer('stub', sink)
+    redeliverer.add('chunk 3')
+    redeliverer.add('chunk 4')
+    time.sleep(1)
+    server.status = 200
+    time.sleep(2)
+    check('Re-delivers the chunks once the sink is back',
+          server.bodies[2:] == ['chunk 3', 'chunk 4'])
+    check('Closes the circuit',
+          sink.circuit_breaker.state == sinks.CircuitBreaker.CLOSED)
+    check('Empties the re-delivery spool',
+          redeliverer.get_dict()['waiting_chunks'] == 0)
+    del server.bodies[:]
+    sink.send(lambda: sinks.iter_pieces(['a' * 1000] * 100, 4096))
+    check('Streams a body', server.bodies == ['a' * 100000])
+
+    def iter_failing_pieces():
+        yield 'a' * 1000
+        raise KeyError('piece')
+    try:
+        sink.send(iter_failing_pieces)
+    except KeyError:
+        pass
+    free_slots = 0
+    while sink.connection_pool.semaphore.acquire(False):
+        free_slots += 1
+    for i in range(0, free_slots):
+        sink.connection_pool.semaphore.release()
+    check('Closes the connection when the body fails',
+          sink.connection_pool.idle_connections.qsize() == 0 and
+          free_slots == config.sink_pool_size)
+    # Outlinks written to a file that cannot be opened at first
+    config.outlinks_path = tempfile.mkdtemp()
+    config.outlinks_sink = 'file'
+    config.outlinks_file = os.path.join(config.outlinks_path, 'missing',
+                                        'outlinks.txt')
+    config.outlinks_flush_seconds = 0.1
+    config.outlinks_dedup_file = None
+    outlinks_handler = outlinks.OutlinksManager()
+    outlinks_handler.add_outlinks(['http://a.org/', 'http://b.org/'])
+    time.sleep(0.5)
+    check('Fails to write the outlinks',
+          outlinks_handler.sink.circuit_breaker.failures >= 1 and
+          outlinks_handler.sink.sent_outlinks == 0)
+    os.mkdir(os.path.dirname(config.outlinks_file))
+    time.sleep(1.5)
+    with open(config.outlinks_file) as _f:
+        check('Re-delivers the outlinks that could not be written',
+              _f.read() == 'http://a.org/\nhttp://b.org/\n')
+    # Triple store loader, starting from a checkpoint after the first block
+    # with the third one loaded too
+    config.triples_path = tempfile.mkdtemp()
+    config.triples_block_size = 2
+    config.triple_store_host = 'localhost'
+    config.triple_store_port = server.server_address[1]
+    config.triple_store_poll_period = 0.1
+    chunk = triples.TripleBatch()
+    chunk.extend([['twitter/post/1', 'api', 'twitter', 1, 2],
+                  ['twitter/post/1', 'type', 'post', 1, 2],
+                  ['twitter/post/1', 'id', '1', 1, 2]])
+    blocks = StringIO.StringIO()
+    triples.write_backup(blocks, chunk, time.time())
+    blocks = blocks.getvalue()
+    triples_file = os.path.join(config.triples_path, '1.triples')
+    with open(triples_file, 'wb') as _f:
+        _f.write(blocks * 2)
+    with open(triples_file, 'rb') as _f:
+        block_ends = []
+        while triples.read_backup_block(_f):
+            block_ends.append(_f.tell())
+    with open(os.path.join(config.triples_path, 'loader.checkpoint'),
+              'w') as _f:
+        _f.write('1.triples %d\n1.triples %d\n' % (block_ends[0],
+                                                    block_ends[2]))
+    del server.bodies[:]
+    triple_store_loader = loader.TripleStoreLoader()
+    time.sleep(0.5)
+    check('Resumes from the checkpoint', len(server.bodies) == 2)
+    check('Skips the blocks loaded after the checkpoint',
+          triple_store_loader.skipped_blocks == 1)
+    check('Sends N-Quads in the graph of the campaign',
+          server.bodies[0].endswith(' "1" <%scampaign/2> .\n' %
+                                    config.triples_base_uri))
+    # The end of a file being written is loaded once it is complete
+    with open(triples_file, 'ab') as _f:
+        _f.write(blocks[:-1])
+        _f.flush()
+        time.sleep(0.5)
+        check('Waits for the end of a block', len(server.bodies) == 3)
+        _f.write(blocks[-1])
+    time.sleep(0.5)
+    check('Loads the block once complete', len(server.bodies) == 4)
+    check('Checkpoints the blocks loaded',
+          triple_store_loader.read_checkpoint() ==
+          (('1.triples', os.path.getsize(triples_file)), set()))
+    # The corrupted end of a file is skipped once there is a newer file
+    with open(triples_file, 'ab') as _f:
+        _f.write('garbage')
+    with open(os.path.join(config.triples_path, '2.triples'), 'wb') as _f:
+        _f.write(blocks)
+    time.sleep(0.5)
+    check('Skips a corrupted end of file', len(server.bodies) == 6 and
+          triple_store_loader.skipped_files == 1)
+    # The blocks the triple store rejects are not sent again
+    server.status = 400
+    requests = server.requests
+    with open(os.path.join(config.triples_path, '3.triples'), 'wb') as _f:
+        _f.write(blocks)
+    time.sleep(0.5)
+    check('Moves the rejected blocks to the rejects file',
+          server.requests == requests + 2 and
+          triple_store_loader.rejected_blocks == 2 and
+          len(list(triples.iter_backup_blocks(
+                        triple_store_loader.rejects_file))) == 2)
+    check('Checkpoints the rejected blocks',
+          triple_store_loader.read_checkpoint() ==
+          (('3.triples', len(blocks)), set()))
+    server.status = 200
+    check('Writes SPARQL updates',
+          ''.join(loader.iter_insert_data([['a', 'id', '1']], '<g>')) ==
+          'INSERT DATA {\nGRAPH <g> {\n<%sa> <%sid> "1" .\n}\n}\n' %
+          (config.triples_base_uri, config.triples_predicate_uri))
+    # The re-delivery daemon never stops
+    os._exit(0)